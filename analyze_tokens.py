@@ -0,0 +1,262 @@
+import json
+import os
+import random
+from bisect import bisect_right
+from multiprocessing import Pool
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+
+from train_all_lora import MODEL_ID, DATA_PATH, RESPONSE_MARKER, build_text
+from sft_packing import _first_fit_decreasing
+from sft_sampler import padding_ratio, sequential_batches, token_budget_batches
+
+# =========================================================
+# all_sft.jsonl token 長度統計與 max_length 建議
+# =========================================================
+#
+# 用訓練時的 tokenizer 與 build_text 平行 tokenize 整份資料（不截斷），依來源（diet / biz / brand）
+# 統計長度分佈，並對每個候選 max_length 算：
+#   - 截斷率：超過長度的樣本比例（response 在最後，被截就是 JSON 不完整）
+#   - padding 浪費：固定筆數 batch 與 token budget batch 補齊後 pad 佔的比例
+#   - packing 填充率：first-fit-decreasing 塞進 max_length 大小的 block
+# 最後建議「每個來源截斷率都 <= MAX_TRUNCATION_RATE」的最小候選長度。
+
+TOKENIZER_ID = MODEL_ID
+REPORT_PATH = "token_stats.json"
+
+NUM_WORKERS: Optional[int] = None   # None = 全部 CPU 核心
+CHUNK_ROWS = 2000                   # 每個 worker 一次 tokenize 的筆數
+
+CANDIDATE_LENGTHS = [512, 1024, 1536, 2048, 3072, 4096]
+MAX_TRUNCATION_RATE = 0.005
+BATCH_SIZE = 2                      # 固定筆數 batch（train_all_lora2.py 的 PER_DEVICE_BATCH_SIZE）
+PACKING_SAMPLE = 20_000             # packing 模擬最多取這麼多筆（first-fit 是 O(n × block 數)）
+HIST_BIN_WIDTH = 256
+HIST_BAR_WIDTH = 40
+SEED = 42
+
+
+def known_instructions() -> Dict[str, str]:
+    # instruction → 來源名稱；不認得的 instruction 歸到 "other"
+    import make_biz_sft_offline
+    import make_brand_sft_offline
+    import make_diet_sft
+
+    mapping = {
+        make_diet_sft.build_instruction(goal): "diet"
+        for goal in ("減脂", "增肌", "健康均衡")
+    }
+    mapping[make_biz_sft_offline.INSTRUCTION] = "biz"
+    mapping[make_brand_sft_offline.INSTRUCTION] = "brand"
+    return mapping
+
+
+# ---------------------------------------------------------
+# 平行 tokenize
+# ---------------------------------------------------------
+
+_TOKENIZER = None
+_SOURCES: Dict[str, str] = {}
+
+
+def init_worker(tokenizer_id: str):
+    global _TOKENIZER, _SOURCES
+    # 每個 worker 一個行程，不要再讓 Rust tokenizer 開 thread
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    from transformers import AutoTokenizer
+
+    _TOKENIZER = AutoTokenizer.from_pretrained(tokenizer_id)
+    _SOURCES = known_instructions()
+
+
+def measure_lines(lines: List[str]) -> Tuple[List[str], List[int], List[int]]:
+    # 回傳每筆的 (來源, 總 token 數, prompt token 數)；計法和 sft_tokenize.tokenize_texts 相同
+    rows = [json.loads(line) for line in lines]
+    texts = [build_text(r) for r in rows]
+    sources = [_SOURCES.get(r.get("instruction", ""), "other") for r in rows]
+    fast = getattr(_TOKENIZER, "is_fast", False)
+    enc = _TOKENIZER(texts, return_offsets_mapping=fast)
+
+    totals = [len(ids) for ids in enc["input_ids"]]
+    prompts = []
+    for i, text in enumerate(texts):
+        pos = text.find(RESPONSE_MARKER)
+        if pos < 0:
+            prompts.append(0)
+        elif fast:
+            ends = [end for _, end in enc["offset_mapping"][i]]
+            prompts.append(bisect_right(ends, pos + len(RESPONSE_MARKER)))
+        else:
+            prompts.append(len(_TOKENIZER(text[: pos + len(RESPONSE_MARKER)])["input_ids"]))
+    return sources, totals, prompts
+
+
+def read_chunks(path: str, chunk_rows: int):
+    with open(path, "r", encoding="utf-8") as f:
+        chunk: List[str] = []
+        for line in f:
+            if line.strip():
+                chunk.append(line)
+            if len(chunk) >= chunk_rows:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def tokenize_lengths(path: str, tokenizer_id: str = TOKENIZER_ID, num_workers: Optional[int] = NUM_WORKERS):
+    from transformers import AutoTokenizer
+
+    # 先在主行程載一次：tokenizer 有問題時直接報錯（worker initializer 失敗只會被 Pool 不斷重啟），
+    # 需要下載的話也只下載一次
+    AutoTokenizer.from_pretrained(tokenizer_id)
+
+    sources: List[str] = []
+    totals: List[int] = []
+    prompts: List[int] = []
+    with Pool(num_workers or os.cpu_count() or 1, initializer=init_worker, initargs=(tokenizer_id,)) as pool:
+        for s, t, p in pool.imap(measure_lines, read_chunks(path, CHUNK_ROWS)):
+            sources.extend(s)
+            totals.extend(t)
+            prompts.extend(p)
+    return np.array(sources), np.array(totals, dtype=np.int64), np.array(prompts, dtype=np.int64)
+
+
+# ---------------------------------------------------------
+# 統計
+# ---------------------------------------------------------
+
+def length_summary(lengths: np.ndarray) -> Dict[str, Any]:
+    p50, p90, p99 = np.percentile(lengths, [50, 90, 99])
+    return {
+        "rows": int(len(lengths)),
+        "mean": float(lengths.mean()),
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "max": int(lengths.max()),
+    }
+
+
+def histogram(lengths: np.ndarray, bin_width: int = HIST_BIN_WIDTH) -> List[Tuple[int, int]]:
+    counts = np.bincount(lengths // bin_width)
+    return [(i * bin_width, int(c)) for i, c in enumerate(counts)]
+
+
+def budget_stats(
+    lengths: np.ndarray,
+    prompt_lengths: np.ndarray,
+    sources: np.ndarray,
+    max_length: int,
+    rng: random.Random,
+) -> Dict[str, Any]:
+    clipped = np.minimum(lengths, max_length).tolist()
+    # Trainer 預設每個 epoch 打亂資料，固定筆數 batch 依打亂後的順序切
+    order = list(range(len(clipped)))
+    rng.shuffle(order)
+    shuffled = [[order[i] for i in batch] for batch in sequential_batches(len(order), BATCH_SIZE)]
+    truncated = lengths > max_length
+    stats: Dict[str, Any] = {
+        "truncation_rate": float(truncated.mean()),
+        "truncated_token_share": float(1 - sum(clipped) / lengths.sum()),
+        # prompt 就超過長度：整個 response 都被切掉，這筆完全學不到東西
+        "response_lost_rate": float((prompt_lengths >= max_length).mean()),
+        "truncation_by_source": {
+            name: float(truncated[sources == name].mean()) for name in sorted(set(sources.tolist()))
+        },
+        "pad_waste_fixed_batch": padding_ratio(clipped, shuffled),
+        "pad_waste_token_budget": padding_ratio(
+            clipped, token_budget_batches(clipped, BATCH_SIZE * max_length, seed=SEED)
+        ),
+    }
+
+    sample = clipped if len(clipped) <= PACKING_SAMPLE else rng.sample(clipped, PACKING_SAMPLE)
+    blocks = _first_fit_decreasing(sample, max_length)
+    stats["packing_fill"] = sum(sample) / (len(blocks) * max_length)
+    return stats
+
+
+def recommend(budgets: Dict[int, Dict[str, Any]], threshold: float = MAX_TRUNCATION_RATE) -> Dict[str, Any]:
+    ok = [
+        length for length, b in sorted(budgets.items())
+        if max(b["truncation_by_source"].values()) <= threshold
+    ]
+    length = ok[0] if ok else max(budgets)
+    b = budgets[length]
+    options = {
+        "fixed_batch": 1 - b["pad_waste_fixed_batch"],
+        "token_budget": 1 - b["pad_waste_token_budget"],
+        "packing": b["packing_fill"],
+    }
+    return {
+        "max_length": length,
+        "meets_threshold": bool(ok),
+        "batching": max(options, key=options.get),
+        "useful_token_ratio": options,
+    }
+
+
+def print_histogram(name: str, hist: List[Tuple[int, int]]):
+    peak = max(c for _, c in hist) or 1
+    print(f"  {name}")
+    for start, count in hist:
+        if count:
+            bar = "#" * max(1, round(HIST_BAR_WIDTH * count / peak))
+            print(f"    {start:>6}-{start + HIST_BIN_WIDTH - 1:<6} {count:>8} {bar}")
+
+
+def main():
+    sources, lengths, prompt_lengths = tokenize_lengths(DATA_PATH, TOKENIZER_ID, NUM_WORKERS)
+    if len(lengths) == 0:
+        raise ValueError(f"{DATA_PATH} 沒有資料")
+    names = sorted(set(sources.tolist()))
+
+    report: Dict[str, Any] = {"data_path": DATA_PATH, "tokenizer": TOKENIZER_ID, "sources": {}}
+    print(f"{DATA_PATH}：{len(lengths)} 筆，tokenizer {TOKENIZER_ID}")
+    print("長度分佈（含 prompt）：")
+    for name in names + ["all"]:
+        mask = np.ones(len(lengths), dtype=bool) if name == "all" else sources == name
+        summary = length_summary(lengths[mask])
+        summary["response"] = length_summary((lengths - prompt_lengths)[mask])
+        summary["histogram"] = histogram(lengths[mask])
+        report["sources"][name] = summary
+        print(
+            f"  {name:<6} {summary['rows']:>8} 筆  mean {summary['mean']:.0f}  p50 {summary['p50']:.0f}  "
+            f"p90 {summary['p90']:.0f}  p99 {summary['p99']:.0f}  max {summary['max']}  "
+            f"（response p99 {summary['response']['p99']:.0f}）"
+        )
+    print("直方圖：")
+    for name in names:
+        print_histogram(name, report["sources"][name]["histogram"])
+
+    rng = random.Random(SEED)
+    budgets = {
+        length: budget_stats(lengths, prompt_lengths, sources, length, rng)
+        for length in CANDIDATE_LENGTHS
+    }
+    report["budgets"] = budgets
+    print("候選 max_length：")
+    for length, b in budgets.items():
+        per_source = "、".join(f"{k} {v:.1%}" for k, v in b["truncation_by_source"].items())
+        print(
+            f"  {length:>5}：截斷 {b['truncation_rate']:.2%}（{per_source}），"
+            f"pad 浪費 固定 batch {b['pad_waste_fixed_batch']:.1%} / token budget {b['pad_waste_token_budget']:.1%}，"
+            f"packing 填充率 {b['packing_fill']:.1%}"
+        )
+
+    rec = recommend(budgets)
+    report["recommendation"] = rec
+    if rec["meets_threshold"]:
+        print(f"建議 max_length = {rec['max_length']}（每個來源截斷率都 <= {MAX_TRUNCATION_RATE:.1%}），", end="")
+    else:
+        print(f"沒有候選長度能讓截斷率 <= {MAX_TRUNCATION_RATE:.1%}，最長的 {rec['max_length']} 也不夠，", end="")
+    print(f"batching 用 {rec['batching']}（有效 token 比例 {rec['useful_token_ratio'][rec['batching']]:.1%}）")
+
+    with open(REPORT_PATH, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"已寫入 {REPORT_PATH}")
+
+
+if __name__ == "__main__":
+    main()
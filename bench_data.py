@@ -0,0 +1,310 @@
+import cProfile
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import pstats
+import shutil
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Any, List, Optional
+
+# =========================================================
+# 資料產生 / 合併 pipeline benchmark
+# =========================================================
+#
+# 依序在每個資料量跑：
+#   nutrition  make_nutrition_dataset.write_bulk（菜色數 = 資料量）
+#   diet / biz / brand  make_*_sft 的 make_row 經 run_sharded 寫 JSONL
+#   merge  merge_sft_datasets.merge 合併上面三個輸出（輸入筆數 = 3 × 資料量）
+# 每個 case 在獨立的子行程跑，記錄 rows/sec、峰值 RSS（含 worker 子行程）、寫出的 bytes。
+# PROFILE 開啟時同時輸出 cProfile（.prof + 熱點函數統計）與取樣得到的
+# folded stacks（.folded，flamegraph.pl / speedscope 可直接讀）。
+# 和 BASELINE_PATH 比較，任何 case 的 rows/sec 掉超過 REGRESSION_THRESHOLD 就以非 0 結束。
+
+BENCH_DIR = "bench_results"
+WORK_DIR = os.path.join(BENCH_DIR, "data_work")
+REPORT_JSON = os.path.join(BENCH_DIR, "data_bench.json")
+REPORT_CSV = os.path.join(BENCH_DIR, "data_bench.csv")
+BASELINE_PATH = os.path.join(BENCH_DIR, "data_baseline.json")
+
+SIZES = [1_000, 100_000, 1_000_000]
+CASES = ["nutrition", "diet", "biz", "brand", "merge"]
+NUM_WORKERS = 1            # 1：單行程的 rows/sec，數字最穩定；None = 全部核心
+NUTRITION_FORMAT = "parquet"
+DIET_DB_DISHES = 300       # diet 用的菜色資料表大小（和 make_nutrition_dataset.N_DISHES 相同）
+SEED = 1234
+KEEP_OUTPUTS = False       # False：每個資料量跑完就刪掉輸出，1M 筆時磁碟才夠
+
+PROFILE = False            # 需要 NUM_WORKERS = 1（profile 只看得到主行程）
+PROFILE_DIR = os.path.join(BENCH_DIR, "profiles")
+PROFILE_INTERVAL = 0.002   # folded stacks 的取樣間隔（秒）
+HOT_FUNCTIONS = ["gen_dishes", "build_fake_week_plan", "build_output", "build_brand_from_idea", "normalize_line"]
+
+REGRESSION_THRESHOLD = 0.20   # rows/sec 比 baseline 低超過 20% 算退步
+UPDATE_BASELINE = False       # True：這次的結果直接寫成新的 baseline
+
+SFT_MODULES = {
+    "diet": "make_diet_sft",
+    "biz": "make_biz_sft_offline",
+    "brand": "make_brand_sft_offline",
+}
+
+
+# ---------------------------------------------------------
+# profile
+# ---------------------------------------------------------
+
+class StackSampler:
+    # 每隔 interval 取一次目標 thread 的 call stack，累計成 folded 格式（"a;b;c 次數"）
+    def __init__(self, thread_id: int, interval: float = PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def hot_function_stats(profiler: cProfile.Profile) -> Dict[str, Dict[str, float]]:
+    # HOT_FUNCTIONS 的呼叫次數與累計時間（同名函數合併）
+    stats = pstats.Stats(profiler)
+    total = stats.total_tt or 1.0
+    hot: Dict[str, Dict[str, float]] = {}
+    for (_, _, name), (_, calls, _, cumtime, _) in stats.stats.items():
+        if name in HOT_FUNCTIONS:
+            entry = hot.setdefault(name, {"calls": 0, "cum_seconds": 0.0})
+            entry["calls"] += calls
+            entry["cum_seconds"] += cumtime
+    for entry in hot.values():
+        entry["share"] = entry["cum_seconds"] / total
+    return hot
+
+
+# ---------------------------------------------------------
+# 各個 case（在子行程裡跑）
+# ---------------------------------------------------------
+
+def peak_memory_mb() -> Optional[float]:
+    # 本行程與已結束的 worker 子行程中較大的峰值 RSS（run_sharded 的 Pool 也算進來）
+    try:
+        import resource
+    except ImportError:   # Windows 沒有 resource
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # Linux 單位是 KB，macOS 是 bytes
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def dir_bytes(paths: List[str]) -> int:
+    total = 0
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        elif os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+
+def sft_path(work_dir: str, name: str) -> str:
+    return os.path.join(work_dir, f"{name}_sft.jsonl")
+
+
+def _run_nutrition(n: int, work_dir: str) -> Dict[str, Any]:
+    from make_nutrition_dataset import N_RESTAURANTS, write_bulk
+
+    out_dir = os.path.join(work_dir, "nutrition")
+    db_dir = os.path.join(work_dir, "nutrition.dishdb")
+    write_bulk(N_RESTAURANTS, n, out_dir, fmt=NUTRITION_FORMAT, seed=SEED, db_dir=db_dir)
+    return {"rows": n, "outputs": [out_dir, db_dir]}
+
+
+def _run_sft(name: str, n: int, work_dir: str) -> Dict[str, Any]:
+    import importlib
+    from sft_runner import run_sharded
+
+    mod = importlib.import_module(SFT_MODULES[name])
+    kwargs: Dict[str, Any] = {}
+    if hasattr(mod, "init_worker"):
+        kwargs = {"initializer": mod.init_worker, "initargs": (os.path.join(WORK_DIR, "diet.dishdb"),)}
+    num_shards = NUM_WORKERS or os.cpu_count() or 1
+    stats = run_sharded(
+        mod.make_row,
+        n,
+        sft_path(work_dir, name),
+        num_shards=num_shards,
+        num_workers=num_shards,
+        seed=SEED,
+        **kwargs,
+    )
+    return {"rows": stats["rows"], "outputs": stats["paths"]}
+
+
+def _run_merge(work_dir: str) -> Dict[str, Any]:
+    from merge_sft_datasets import merge
+
+    sources = []
+    for name in SFT_MODULES:
+        sources.extend(sorted(glob.glob(sft_path(work_dir, name).replace(".jsonl", "*.jsonl"))))
+    out_path = os.path.join(work_dir, "all_sft.jsonl")
+    stats = merge(sources, out_path)
+    return {"rows": stats["written"] + stats["duplicates"] + stats["invalid"], "outputs": [out_path]}
+
+
+def run_case(case: str, n: int, work_dir: str, profile: bool = False) -> Dict[str, Any]:
+    if case == "nutrition":
+        run = lambda: _run_nutrition(n, work_dir)
+    elif case == "merge":
+        run = lambda: _run_merge(work_dir)
+    else:
+        run = lambda: _run_sft(case, n, work_dir)
+
+    hot = None
+    start = time.perf_counter()
+    if profile:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler = cProfile.Profile()
+        with StackSampler(threading.get_ident()) as sampler:
+            profiler.enable()
+            out = run()
+            profiler.disable()
+        seconds = time.perf_counter() - start
+        prefix = os.path.join(PROFILE_DIR, f"{case}-{n}")
+        profiler.dump_stats(prefix + ".prof")
+        sampler.write(prefix + ".folded")
+        hot = hot_function_stats(profiler)
+    else:
+        out = run()
+        seconds = time.perf_counter() - start
+
+    return {
+        "case": case,
+        "size": n,
+        "rows": out["rows"],
+        "seconds": seconds,
+        "rows_per_sec": out["rows"] / seconds if seconds > 0 else None,
+        "bytes_written": dir_bytes(out["outputs"]),
+        "peak_rss_mb": peak_memory_mb(),
+        "hot_functions": hot,
+    }
+
+
+# ---------------------------------------------------------
+# baseline 比較
+# ---------------------------------------------------------
+
+def regressions(baseline: List[Dict[str, Any]], results: List[Dict[str, Any]], threshold: float) -> List[str]:
+    old = {(r["case"], r["size"]): r for r in baseline}
+    problems = []
+    for r in results:
+        ref = old.get((r["case"], r["size"]))
+        if not ref or not ref.get("rows_per_sec") or not r["rows_per_sec"]:
+            continue
+        change = r["rows_per_sec"] / ref["rows_per_sec"] - 1
+        line = f"{r['case']} @ {r['size']:,}：{ref['rows_per_sec']:.0f} -> {r['rows_per_sec']:.0f} 筆/秒（{change:+.1%}）"
+        print("  " + line)
+        if change < -threshold:
+            problems.append(line)
+    return problems
+
+
+def prepare_diet_db():
+    # diet 的速度和菜色表大小有關，固定用 DIET_DB_DISHES 道菜，和 nutrition case 的資料量無關
+    from make_nutrition_dataset import N_RESTAURANTS, write_bulk
+
+    db_dir = os.path.join(WORK_DIR, "diet.dishdb")
+    if not os.path.exists(os.path.join(db_dir, "meta.json")):
+        scratch = os.path.join(WORK_DIR, "diet_db_src")
+        write_bulk(N_RESTAURANTS, DIET_DB_DISHES, scratch, fmt="jsonl", seed=SEED, db_dir=db_dir)
+        shutil.rmtree(scratch)
+
+
+def main():
+    if PROFILE and NUM_WORKERS != 1:
+        raise ValueError("PROFILE 需要 NUM_WORKERS = 1")
+    if "merge" in CASES and not all(name in CASES for name in SFT_MODULES):
+        raise ValueError("merge 需要同時跑 diet / biz / brand（合併的是它們的輸出）")
+
+    os.makedirs(WORK_DIR, exist_ok=True)
+    if "diet" in CASES:
+        prepare_diet_db()
+
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    for n in SIZES:
+        size_dir = os.path.join(WORK_DIR, str(n))
+        os.makedirs(size_dir, exist_ok=True)
+        for case in CASES:
+            with ctx.Pool(1) as pool:
+                r = pool.apply(run_case, (case, n, size_dir, PROFILE))
+            results.append(r)
+            peak = f"{r['peak_rss_mb']:.0f} MB" if r["peak_rss_mb"] is not None else "n/a"
+            print(
+                f"{case} @ {n:,}：{r['rows_per_sec']:.0f} 筆/秒（{r['seconds']:.1f} 秒），"
+                f"寫出 {r['bytes_written'] / 2**20:.1f} MB，峰值 RSS {peak}"
+            )
+            for name, h in (r["hot_functions"] or {}).items():
+                print(f"    {name}：{h['calls']} 次，累計 {h['cum_seconds']:.2f} 秒（{h['share']:.0%}）")
+        if not KEEP_OUTPUTS:
+            shutil.rmtree(size_dir)
+
+    with open(REPORT_JSON, "w", encoding="utf-8") as f:
+        json.dump({"num_workers": NUM_WORKERS, "results": results}, f, ensure_ascii=False, indent=2)
+    with open(REPORT_CSV, "w", encoding="utf-8", newline="") as f:
+        fields = [k for k in results[0] if k != "hot_functions"]
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+    print(f"已寫入 {REPORT_JSON}、{REPORT_CSV}")
+
+    baseline: Optional[List[Dict[str, Any]]] = None
+    if os.path.exists(BASELINE_PATH) and not UPDATE_BASELINE:
+        with open(BASELINE_PATH, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    if baseline is None:
+        shutil.copyfile(REPORT_JSON, BASELINE_PATH)
+        print(f"已把這次結果存成 baseline：{BASELINE_PATH}")
+        return
+
+    print(f"和 baseline 比較（門檻 -{REGRESSION_THRESHOLD:.0%}）：")
+    problems = regressions(baseline, results, REGRESSION_THRESHOLD)
+    if problems:
+        print("效能退步：")
+        for line in problems:
+            print("  " + line)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import time
+from dataclasses import dataclass, asdict
+from typing import Dict, Any, List, Optional, Tuple
+
+from lora_sft import PRESETS as SFT_PRESETS
+from train_all_lora import DATA_PATH, build_text
+
+# =========================================================
+# LoRA 訓練吞吐量 benchmark
+# =========================================================
+#
+# 在 CPU 上用一個很小的 causal LM 跑固定步數的訓練，比較 lora_sft 各 preset
+# 的設定（LoRA rank、target modules、max_length、gradient checkpointing）對
+# tokens/sec、每步時間、峰值記憶體的影響。
+# - 資料：DATA_PATH 存在就用，否則用 make_*_sft 的產生器合成 BENCH_DATA_PATH
+#   （沒有 nutrition_dataset.json 時先用 make_nutrition_dataset.write_bulk 產生一個小菜色表給 diet 用）
+# - tokenizer：在資料上訓練一個小的 byte-level BPE（不用下載任何模型）；BENCH_MODEL_ID 有設就改用該模型
+# - 每個設定在獨立的子行程跑，峰值 RSS 才不會互相影響；前 WARMUP_STEPS 步不計時
+# - 每個設定看到的資料順序都一樣；結果寫成 JSON + CSV，並和上一次的報告比較 tokens/sec
+# 要在真的模型 / GPU 上掃 grid 找最快設定，用 python -m lora_sft sweep。
+
+BENCH_DIR = "bench_results"
+BENCH_DATA_PATH = os.path.join(BENCH_DIR, "bench_sft.jsonl")
+BENCH_ROWS_PER_TASK = 200
+BENCH_DB_DIR = os.path.join(BENCH_DIR, "bench.dishdb")
+BENCH_DISHES = 300
+REPORT_JSON = os.path.join(BENCH_DIR, "train_bench.json")
+REPORT_CSV = os.path.join(BENCH_DIR, "train_bench.csv")
+
+BENCH_MODEL_ID: Optional[str] = None   # None：用下面的設定建隨機初始化的小 Llama
+BENCH_VOCAB_SIZE = 4000
+BENCH_MODEL_CONFIG = {
+    "hidden_size": 256,
+    "intermediate_size": 688,
+    "num_hidden_layers": 4,
+    "num_attention_heads": 4,
+    "num_key_value_heads": 2,
+    "max_position_embeddings": 4096,
+}
+
+SEED = 42
+WARMUP_STEPS = 2
+MEASURE_STEPS = 10
+NUM_THREADS: Optional[int] = None      # 固定 torch thread 數，數字比較穩定
+
+BENCH_BATCH_SIZE = 2
+
+
+@dataclass
+class BenchConfig:
+    name: str
+    lora_r: int = 8
+    lora_alpha: int = 16
+    target_modules: Tuple[str, ...] = ("q_proj", "k_proj", "v_proj", "o_proj")
+    max_length: int = 1024
+    gradient_checkpointing: bool = False
+    batch_size: int = BENCH_BATCH_SIZE
+
+
+def preset_config(name: str) -> BenchConfig:
+    # 從 lora_sft 的 preset 取會影響每個 token 成本的參數；batch size 統一，
+    # 量化 / 精度 / device_map 在 CPU 小模型上量不到，不比較
+    cfg = SFT_PRESETS[name]()
+    return BenchConfig(
+        name,
+        lora_r=cfg.lora.r,
+        lora_alpha=cfg.lora.alpha,
+        target_modules=tuple(cfg.lora.target_modules),
+        max_length=cfg.data.max_length,
+        gradient_checkpointing=cfg.model.gradient_checkpointing,
+    )
+
+
+PRESETS = [preset_config(name) for name in SFT_PRESETS]
+
+
+# ---------------------------------------------------------
+# 資料與 tokenizer
+# ---------------------------------------------------------
+
+def prepare_bench_dishes():
+    # make_diet_sft 需要菜色資料表；全新 checkout 沒有 nutrition_dataset.json 時，
+    # 和 bench_data.py 一樣用 write_bulk 產生一個固定的小表，並讓 make_diet_sft 改讀它
+    import make_diet_sft
+
+    if os.path.exists(make_diet_sft.DATA_PATH):
+        return
+    if not os.path.exists(os.path.join(BENCH_DB_DIR, "meta.json")):
+        from make_nutrition_dataset import N_RESTAURANTS, write_bulk
+
+        scratch = os.path.join(BENCH_DIR, "bench_dishes_src")
+        write_bulk(N_RESTAURANTS, BENCH_DISHES, scratch, fmt="jsonl", seed=SEED, db_dir=BENCH_DB_DIR)
+        shutil.rmtree(scratch)
+    make_diet_sft.DB_DIR = BENCH_DB_DIR
+
+
+def ensure_bench_data() -> str:
+    if os.path.exists(DATA_PATH):
+        return DATA_PATH
+    if not os.path.exists(BENCH_DATA_PATH):
+        from json_constrain import SCHEMA_SOURCES, sample_rows
+
+        os.makedirs(BENCH_DIR, exist_ok=True)
+        prepare_bench_dishes()
+        with open(BENCH_DATA_PATH, "w", encoding="utf-8") as f:
+            for module_name in SCHEMA_SOURCES.values():
+                for row in sample_rows(module_name, BENCH_ROWS_PER_TASK, seed=SEED):
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    return BENCH_DATA_PATH
+
+
+def build_tokenizer(texts: List[str], out_dir: str, vocab_size: int = BENCH_VOCAB_SIZE):
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tok = Tokenizer(models.BPE())
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=["<pad>", "<bos>", "<eos>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tok.train_from_iterator(texts, trainer)
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tok, pad_token="<pad>", bos_token="<bos>", eos_token="<eos>"
+    )
+    tokenizer.save_pretrained(out_dir)
+    return tokenizer
+
+
+# ---------------------------------------------------------
+# 單一設定（在子行程裡跑）
+# ---------------------------------------------------------
+
+def peak_memory_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:   # Windows 沒有 resource
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 單位是 KB，macOS 是 bytes
+    return peak / 2**20 if platform.system() == "Darwin" else peak / 2**10
+
+
+def run_benchmark(cfg: BenchConfig, data_path: str, tokenizer_dir: str) -> Dict[str, Any]:
+    import torch
+    from datasets import load_dataset
+    from peft import LoraConfig, get_peft_model
+    from transformers import (
+        AutoModelForCausalLM,
+        AutoTokenizer,
+        DataCollatorForSeq2Seq,
+        LlamaConfig,
+        LlamaForCausalLM,
+        Trainer,
+        TrainerCallback,
+        TrainingArguments,
+    )
+    from sft_tokenize import tokenize_texts
+
+    if NUM_THREADS:
+        torch.set_num_threads(NUM_THREADS)
+    torch.manual_seed(SEED)
+    use_cuda = torch.cuda.is_available()
+
+    tokenizer = AutoTokenizer.from_pretrained(BENCH_MODEL_ID or tokenizer_dir)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    if BENCH_MODEL_ID:
+        model = AutoModelForCausalLM.from_pretrained(BENCH_MODEL_ID, torch_dtype=torch.float32)
+    else:
+        model = LlamaForCausalLM(LlamaConfig(
+            vocab_size=len(tokenizer),
+            pad_token_id=tokenizer.pad_token_id,
+            bos_token_id=tokenizer.bos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            **BENCH_MODEL_CONFIG,
+        ))
+
+    n_rows = (WARMUP_STEPS + MEASURE_STEPS) * cfg.batch_size
+    dataset = load_dataset("json", data_files=data_path)["train"].shuffle(seed=SEED)
+    dataset = dataset.select(range(min(n_rows, len(dataset))))
+    tokenized = dataset.map(
+        lambda batch: tokenize_texts(
+            [build_text(dict(zip(batch.keys(), values))) for values in zip(*batch.values())],
+            tokenizer,
+            max_length=cfg.max_length,
+        ),
+        batched=True,
+        remove_columns=dataset.column_names,
+    )
+
+    model = get_peft_model(model, LoraConfig(
+        r=cfg.lora_r,
+        lora_alpha=cfg.lora_alpha,
+        target_modules=list(cfg.target_modules),
+        lora_dropout=0.05,
+        bias="none",
+        task_type="CAUSAL_LM",
+    ))
+    trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
+
+    collator = DataCollatorForSeq2Seq(tokenizer, padding=True, label_pad_token_id=-100)
+    batch_tokens: List[Tuple[int, int]] = []
+
+    def counting_collator(features):
+        batch = collator(features)
+        batch_tokens.append((int(batch["attention_mask"].sum()), batch["input_ids"].numel()))
+        return batch
+
+    step_times: List[float] = []
+    losses: List[float] = []
+
+    class StepTimer(TrainerCallback):
+        def on_step_begin(self, args, state, control, **kwargs):
+            if use_cuda:
+                torch.cuda.synchronize()
+            self.start = time.perf_counter()
+
+        def on_step_end(self, args, state, control, **kwargs):
+            if use_cuda:
+                torch.cuda.synchronize()
+            step_times.append(time.perf_counter() - self.start)
+
+        def on_log(self, args, state, control, logs=None, **kwargs):
+            if logs and "loss" in logs:
+                losses.append(logs["loss"])
+
+    args = TrainingArguments(
+        output_dir=os.path.join(BENCH_DIR, "tmp"),
+        per_device_train_batch_size=cfg.batch_size,
+        gradient_accumulation_steps=1,
+        max_steps=WARMUP_STEPS + MEASURE_STEPS,
+        learning_rate=2e-4,
+        gradient_checkpointing=cfg.gradient_checkpointing,
+        gradient_checkpointing_kwargs={"use_reentrant": False},
+        use_cpu=not use_cuda,
+        logging_steps=1,
+        save_strategy="no",
+        report_to="none",
+        dataloader_num_workers=0,
+        seed=SEED,
+    )
+    trainer = Trainer(
+        model=model,
+        args=args,
+        train_dataset=tokenized,
+        data_collator=counting_collator,
+        callbacks=[StepTimer()],
+    )
+    if use_cuda:
+        torch.cuda.reset_peak_memory_stats()
+    trainer.train()
+
+    measured = step_times[WARMUP_STEPS:]
+    tokens = batch_tokens[WARMUP_STEPS: WARMUP_STEPS + len(measured)]
+    real_tokens = sum(t for t, _ in tokens)
+    padded_tokens = sum(p for _, p in tokens)
+    ordered = sorted(measured)
+    result = asdict(cfg)
+    result.update({
+        "target_modules": "+".join(cfg.target_modules),
+        "trainable_params": trainable,
+        "steps": len(measured),
+        "mean_step_ms": 1000 * sum(measured) / max(len(measured), 1),
+        "p50_step_ms": 1000 * ordered[len(ordered) // 2] if ordered else None,
+        "tokens_per_sec": real_tokens / sum(measured) if measured else None,
+        "padding_ratio": 1 - real_tokens / padded_tokens if padded_tokens else None,
+        "peak_rss_mb": peak_memory_mb(),
+        "peak_cuda_mb": torch.cuda.max_memory_allocated() / 2**20 if use_cuda else None,
+        "final_loss": losses[-1] if losses else None,
+    })
+    return result
+
+
+# ---------------------------------------------------------
+# 報告
+# ---------------------------------------------------------
+
+def environment() -> Dict[str, Any]:
+    import torch
+    import transformers
+    import peft
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "peft": peft.__version__,
+        "threads": torch.get_num_threads(),
+        "cuda": torch.cuda.is_available(),
+        "model": BENCH_MODEL_ID or BENCH_MODEL_CONFIG,
+        "warmup_steps": WARMUP_STEPS,
+        "measure_steps": MEASURE_STEPS,
+    }
+
+
+def write_report(results: List[Dict[str, Any]]):
+    with open(REPORT_JSON, "w", encoding="utf-8") as f:
+        json.dump({"environment": environment(), "results": results}, f, ensure_ascii=False, indent=2)
+    with open(REPORT_CSV, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def compare(previous: Dict[str, Dict[str, Any]], results: List[Dict[str, Any]]):
+    for r in results:
+        old = previous.get(r["name"])
+        if old and old.get("tokens_per_sec") and r["tokens_per_sec"]:
+            change = r["tokens_per_sec"] / old["tokens_per_sec"] - 1
+            print(f"  {r['name']}: {old['tokens_per_sec']:.0f} -> {r['tokens_per_sec']:.0f} tokens/s（{change:+.1%}）")
+
+
+def main():
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    data_path = ensure_bench_data()
+    tokenizer_dir = os.path.join(BENCH_DIR, "tokenizer")
+    if not BENCH_MODEL_ID and not os.path.exists(os.path.join(tokenizer_dir, "tokenizer.json")):
+        with open(data_path, "r", encoding="utf-8") as f:
+            texts = [build_text(json.loads(line)) for line in f if line.strip()]
+        build_tokenizer(texts, tokenizer_dir)
+
+    previous: Dict[str, Dict[str, Any]] = {}
+    if os.path.exists(REPORT_JSON):
+        with open(REPORT_JSON, "r", encoding="utf-8") as f:
+            previous = {r["name"]: r for r in json.load(f)["results"]}
+
+    configs = PRESETS
+    results = []
+    # spawn：每個設定都是乾淨的行程（峰值記憶體獨立，Windows 也能跑）
+    ctx = multiprocessing.get_context("spawn")
+    for i, cfg in enumerate(configs, 1):
+        with ctx.Pool(1) as pool:
+            r = pool.apply(run_benchmark, (cfg, data_path, tokenizer_dir))
+        results.append(r)
+        peak = f"{r['peak_rss_mb']:.0f} MB" if r["peak_rss_mb"] is not None else "n/a"
+        print(
+            f"[{i}/{len(configs)}] {cfg.name}: {r['tokens_per_sec']:.0f} tokens/s，"
+            f"每步 {r['mean_step_ms']:.0f} ms，峰值 RSS {peak}，可訓練參數 {r['trainable_params']:,}"
+        )
+
+    write_report(results)
+    print(f"已寫入 {REPORT_JSON}、{REPORT_CSV}")
+    if previous:
+        print("和上一次比較：")
+        compare(previous, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+from typing import Dict, Any, List
+
+import numpy as np
+
+from food_db import DishTable
+from meal_planner import MealPlanner
+
+# =========================================================
+# 飲食菜單輸出的精簡格式（compact）與還原
+# =========================================================
+#
+# 完整格式（build_fake_week_plan 的 output）大部分內容都能由 input 與菜色資料表算出來：
+#   - goal / user_profile：input 原樣複製
+#   - daily_calorie_target / daily_protein_target_g：由 user_profile + goal 估算
+#   - meal_type：依一天內的順序（breakfast → lunch → dinner）
+#   - restaurant_id / note：由 dish_id 查表
+#   - total_calories / total_protein_g：當天菜色加總
+#   - 最外層 note：由 goal 決定
+# 精簡格式只留模型真正要決定的東西：每天吃哪幾道菜
+#   {"w": [[dish_id, dish_id, dish_id], [dish_id, dish_id], ...]}   # 7 天，每天 2～3 餐
+# 推論時用 DietExpander 配合 input 與菜色資料表還原成完整格式，結果和直接產生的完整格式完全相同。
+
+COMPACT_KEY = "w"
+MEAL_TYPES = ["breakfast", "lunch", "dinner"]
+GOAL_ZH = {
+    "fat_loss": "減脂",
+    "muscle_gain": "增肌",
+    "general_health": "健康均衡",
+}
+
+
+def plan_note(goal_zh: str) -> str:
+    return f"此菜單為自動產生，用於訓練示範（目標：{goal_zh}）"
+
+
+def assemble_plan(
+    user_profile: Dict[str, Any],
+    goal_zh: str,
+    goal_internal: str,
+    target: int,
+    protein_target: int,
+    planner: MealPlanner,
+    week: List[np.ndarray],
+) -> Dict[str, Any]:
+    # week：每天選到的菜色列號；產生資料與還原精簡格式共用，確保兩邊輸出一致
+    dishes = planner.dishes
+    weekly_menu = []
+
+    for day, picks in enumerate(week, start=1):
+        day_meals = []
+
+        for mt, i in zip(MEAL_TYPES, picks.tolist()):
+            day_meals.append({
+                "meal_type": mt,
+                "dish_id": int(dishes["dish_id"][i]),
+                "restaurant_id": int(dishes["restaurant_id"][i]),
+                "note": planner.notes[i],
+            })
+
+        weekly_menu.append({
+            "day": day,
+            "total_calories": int(planner.cal[picks].sum()),
+            "total_protein_g": int(planner.protein[picks].sum()),
+            "meals": day_meals,
+        })
+
+    return {
+        "goal": goal_internal,
+        "user_profile": user_profile,
+        "daily_calorie_target": target,
+        "daily_protein_target_g": protein_target,
+        "weekly_menu": weekly_menu,
+        "note": plan_note(goal_zh),
+    }
+
+
+def compact_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
+    return {COMPACT_KEY: [[meal["dish_id"] for meal in day["meals"]] for day in plan["weekly_menu"]]}
+
+
+def is_compact(obj: Any) -> bool:
+    return isinstance(obj, dict) and list(obj) == [COMPACT_KEY]
+
+
+class DietExpander:
+    def __init__(self, planner: MealPlanner):
+        self.planner = planner
+
+    @classmethod
+    def load(cls, db_dir: str) -> "DietExpander":
+        return cls(MealPlanner(DishTable.load(db_dir)))
+
+    def expand(self, compact: Dict[str, Any], input_obj: Dict[str, Any]) -> Dict[str, Any]:
+        # make_diet_sft 也 import 這個模組，放在函式裡避免循環 import
+        from make_diet_sft import estimate_daily_calories, estimate_daily_protein
+
+        if not is_compact(compact):
+            raise ValueError(f"不是精簡格式：最外層只能有 {COMPACT_KEY!r}")
+        days = compact[COMPACT_KEY]
+        if not isinstance(days, list) or not all(
+            isinstance(day, list)
+            and 0 < len(day) <= len(MEAL_TYPES)
+            and all(isinstance(d, int) and not isinstance(d, bool) for d in day)
+            for day in days
+        ):
+            raise ValueError(f"{COMPACT_KEY!r} 必須是每天 1～{len(MEAL_TYPES)} 個 dish_id 的 list")
+
+        goal_internal = input_obj["goal"]
+        if goal_internal not in GOAL_ZH:
+            raise ValueError(f"未知的 goal：{goal_internal}")
+        user_profile = input_obj["user_profile"]
+        week = [self.planner.dishes.lookup("dish_id", day) for day in days]
+
+        return assemble_plan(
+            user_profile=user_profile,
+            goal_zh=GOAL_ZH[goal_internal],
+            goal_internal=goal_internal,
+            target=estimate_daily_calories(user_profile, goal_internal),
+            protein_target=estimate_daily_protein(user_profile, goal_internal),
+            planner=self.planner,
+            week=week,
+        )
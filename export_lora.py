@@ -0,0 +1,281 @@
+import json
+import os
+import random
+import shutil
+from typing import Dict, Any, List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM
+from peft import PeftModel
+
+from train_all_lora import MODEL_ID, DATA_PATH, OUTPUT_DIR, MAX_LENGTH, build_text
+
+# =========================================================
+# LoRA 合併 + 匯出（推論時不再多算 adapter 的 matmul）
+# =========================================================
+#
+# save_pretrained 存的是沒合併的 adapter，推論時每個 q/k/v/o_proj（train_all_lora2.py 還有 MLP）
+# 都要多跑兩個小 matmul。這裡：
+#   1. 載 base + adapter，merge_and_unload 把 B @ A * scaling 加回 base 權重
+#   2. 依 QUANTIZE 選擇直接存，或把 Linear 權重量化成 int8 / int4（weight-only，CPU 推論省記憶體）
+#   3. 存成 safetensors 分片（讀取時 mmap，不用整份先讀進記憶體）
+#   4. 從匯出目錄重新載入，和未合併的模型在 DATA_PATH 的樣本上比對 logits
+# 量化過的目錄 from_pretrained 讀不了，用 load_exported() 載入。
+#
+# train_all_lora2.py 的 adapter：MODEL_ID / ADAPTER_DIR 改成那邊的設定即可（LoRA 目標模組不用另外指定）。
+
+ADAPTER_DIR = OUTPUT_DIR
+EXPORT_DIR = "./multi-lora-merged"
+
+EXPORT_DTYPE = torch.float32     # 非量化權重存成的型別；GPU 推論可改 float16 / bfloat16
+QUANTIZE: Optional[str] = None   # None / "int8" / "int4"
+QUANT_GROUP_SIZE = {"int8": None, "int4": 128}   # 每幾個輸入維度共用一個 scale（None：每個輸出 channel 一個）
+QUANT_SKIP = ("lm_head",)        # 不量化的 Linear（名稱結尾比對）
+MAX_SHARD_SIZE = "2GB"
+
+PARITY_SAMPLES = 8
+PARITY_TOKENS = 64               # 每筆只比對最後這麼多個位置（response 的尾段），參考 logits 才存得下
+PARITY_SEED = 42
+PARITY_ATOL = 1e-3               # 沒量化時 logits 最大誤差上限
+PARITY_MIN_TOP1 = {None: 0.99, "int8": 0.95, "int4": 0.80}   # 下一個 token 預測要一致的比例下限
+
+QUANT_CONFIG_NAME = "quantization.json"
+REPORT_NAME = "export_report.json"
+
+
+# ---------------------------------------------------------
+# weight-only 量化
+# ---------------------------------------------------------
+
+def quantize_weight(weight: torch.Tensor, bits: int, group_size: Optional[int]) -> Tuple[torch.Tensor, torch.Tensor]:
+    # 對稱量化：每個 (輸出 channel, 輸入分組) 一個 scale；int4 兩個值塞一個 uint8
+    out_features, in_features = weight.shape
+    group = group_size if group_size and in_features % group_size == 0 else in_features
+    w = weight.detach().float().reshape(out_features, in_features // group, group)
+    qmax = 2 ** (bits - 1) - 1
+    scales = (w.abs().amax(dim=-1, keepdim=True) / qmax).clamp(min=1e-8)
+    q = torch.round(w / scales).clamp(-qmax, qmax).to(torch.int8).reshape(out_features, in_features)
+    if bits == 4:
+        u = (q + 8).to(torch.uint8)
+        q = u[:, 0::2] | (u[:, 1::2] << 4)
+    return q.contiguous(), scales.squeeze(-1).contiguous()
+
+
+def dequantize_weight(qweight: torch.Tensor, scales: torch.Tensor, bits: int) -> torch.Tensor:
+    if bits == 4:
+        low = (qweight & 0x0F).to(torch.int8) - 8
+        high = (qweight >> 4).to(torch.int8) - 8
+        q = torch.stack([low, high], dim=-1).reshape(qweight.shape[0], -1)
+    else:
+        q = qweight
+    out_features, in_features = q.shape
+    groups = scales.shape[1]
+    w = q.float().reshape(out_features, groups, in_features // groups) * scales.unsqueeze(-1)
+    return w.reshape(out_features, in_features)
+
+
+class QuantLinear(nn.Module):
+    # 存 int8 / 打包的 int4 權重，forward 時才還原成 float（省的是記憶體與讀取量，不是計算量）
+    def __init__(self, in_features: int, out_features: int, bias: bool, bits: int, groups: int):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        packed = in_features // 2 if bits == 4 else in_features
+        dtype = torch.uint8 if bits == 4 else torch.int8
+        self.register_buffer("qweight", torch.zeros(out_features, packed, dtype=dtype))
+        self.register_buffer("scales", torch.ones(out_features, groups))
+        self.register_buffer("bias", torch.zeros(out_features) if bias else None)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        weight = dequantize_weight(self.qweight, self.scales, self.bits).to(x.dtype)
+        bias = None if self.bias is None else self.bias.to(x.dtype)
+        return F.linear(x, weight, bias)
+
+
+def quant_targets(model: nn.Module) -> List[str]:
+    return [
+        name
+        for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and not name.endswith(QUANT_SKIP)
+    ]
+
+
+def quantized_state_dict(model: nn.Module, method: str, group_size: Optional[int]) -> Tuple[Dict[str, torch.Tensor], List[str]]:
+    bits = 4 if method == "int4" else 8
+    targets = quant_targets(model)
+    if bits == 4:
+        targets = [n for n in targets if model.get_submodule(n).in_features % 2 == 0]
+    state = {k: v.to(EXPORT_DTYPE) if v.is_floating_point() else v for k, v in model.state_dict().items()}
+    for name in targets:
+        linear = model.get_submodule(name)
+        qweight, scales = quantize_weight(linear.weight, bits, group_size)
+        del state[f"{name}.weight"]
+        state[f"{name}.qweight"] = qweight
+        state[f"{name}.scales"] = scales
+    return state, targets
+
+
+# ---------------------------------------------------------
+# 存 / 讀
+# ---------------------------------------------------------
+
+def save_sharded(state: Dict[str, torch.Tensor], out_dir: str, max_shard_size: str = MAX_SHARD_SIZE):
+    # 和 save_pretrained 相同的分片格式（model-0000x-of-0000y.safetensors + index.json）
+    from huggingface_hub import split_torch_state_dict_into_shards
+    from safetensors.torch import save_file
+
+    # tie 在一起的權重（embed_tokens / lm_head）只存一份，載入後再 tie_weights
+    seen = set()
+    unique = {}
+    for name, tensor in state.items():
+        key = (tensor.data_ptr(), tensor.shape) if tensor.numel() else name
+        if key not in seen:
+            seen.add(key)
+            unique[name] = tensor
+
+    split = split_torch_state_dict_into_shards(unique, max_shard_size=max_shard_size)
+    for filename, names in split.filename_to_tensors.items():
+        save_file(
+            {n: unique[n].contiguous() for n in names},
+            os.path.join(out_dir, filename),
+            metadata={"format": "pt"},
+        )
+    if split.is_sharded:
+        with open(os.path.join(out_dir, "model.safetensors.index.json"), "w", encoding="utf-8") as f:
+            json.dump({"metadata": split.metadata, "weight_map": split.tensor_to_filename}, f, indent=2)
+
+
+def load_exported(export_dir: str, device: str = "cpu", dtype: torch.dtype = EXPORT_DTYPE):
+    quant_path = os.path.join(export_dir, QUANT_CONFIG_NAME)
+    if not os.path.exists(quant_path):
+        return AutoModelForCausalLM.from_pretrained(export_dir, torch_dtype=dtype).to(device).eval()
+
+    from accelerate import init_empty_weights
+    from safetensors.torch import load_file
+
+    with open(quant_path, "r", encoding="utf-8") as f:
+        quant = json.load(f)
+    config = AutoConfig.from_pretrained(export_dir)
+    # 參數先建在 meta 上不佔記憶體，buffer（rotary 等）照常建立
+    with init_empty_weights(include_buffers=False):
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype)
+
+    bits = 4 if quant["method"] == "int4" else 8
+    for name, groups in quant["modules"].items():
+        linear = model.get_submodule(name)
+        parent_name, _, child = name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name else model
+        setattr(parent, child, QuantLinear(linear.in_features, linear.out_features, linear.bias is not None, bits, groups))
+
+    state: Dict[str, torch.Tensor] = {}
+    for filename in sorted(os.listdir(export_dir)):
+        if filename.endswith(".safetensors"):
+            state.update(load_file(os.path.join(export_dir, filename)))
+    model.load_state_dict(state, strict=False, assign=True)
+    model.tie_weights()
+    missing = [n for n, p in list(model.named_parameters()) + list(model.named_buffers()) if p.is_meta]
+    if missing:
+        raise ValueError(f"{export_dir} 缺少權重：{missing[:5]}")
+    return model.to(device).eval()
+
+
+# ---------------------------------------------------------
+# parity 檢查
+# ---------------------------------------------------------
+
+def parity_inputs(tokenizer, path: str = DATA_PATH, n: int = PARITY_SAMPLES, seed: int = PARITY_SEED) -> List[torch.Tensor]:
+    with open(path, "r", encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    rows = random.Random(seed).sample(rows, min(n, len(rows)))
+    return [
+        tokenizer(build_text(r), return_tensors="pt", truncation=True, max_length=MAX_LENGTH)["input_ids"]
+        for r in rows
+    ]
+
+
+@torch.inference_mode()
+def tail_logits(model, inputs: List[torch.Tensor], device: str) -> List[torch.Tensor]:
+    # 一次一筆（不用 padding），只留最後 PARITY_TOKENS 個位置
+    return [model(input_ids=ids.to(device)).logits[0, -PARITY_TOKENS:].float().cpu() for ids in inputs]
+
+
+def compare_logits(reference: List[torch.Tensor], candidate: List[torch.Tensor]) -> Dict[str, Any]:
+    max_diff = 0.0
+    agree = total = 0
+    for ref, cand in zip(reference, candidate):
+        max_diff = max(max_diff, (ref - cand).abs().max().item())
+        agree += (ref.argmax(-1) == cand.argmax(-1)).sum().item()
+        total += ref.shape[0]
+    return {"max_abs_logit_diff": max_diff, "top1_agreement": agree / max(total, 1), "positions": total}
+
+
+def main():
+    if QUANTIZE not in (None, "int8", "int4"):
+        raise ValueError(f"QUANTIZE 只支援 None / int8 / int4，收到 {QUANTIZE}")
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
+    # 合併一律用 float32 算，避免 float16 下 B @ A 的誤差
+    base = AutoModelForCausalLM.from_pretrained(MODEL_ID, torch_dtype=torch.float32).to(device)
+    model = PeftModel.from_pretrained(base, ADAPTER_DIR).eval()
+
+    # 1. 先算未合併模型的參考 logits（合併會直接改 base 權重）
+    inputs = parity_inputs(tokenizer)
+    reference = tail_logits(model, inputs, device)
+
+    # 2. 合併
+    merged = model.merge_and_unload()
+    if os.path.exists(EXPORT_DIR):
+        shutil.rmtree(EXPORT_DIR)
+    os.makedirs(EXPORT_DIR)
+    tokenizer.save_pretrained(EXPORT_DIR)
+
+    # 3. 存檔
+    if QUANTIZE is None:
+        merged.to(EXPORT_DTYPE).save_pretrained(EXPORT_DIR, safe_serialization=True, max_shard_size=MAX_SHARD_SIZE)
+    else:
+        state, targets = quantized_state_dict(merged, QUANTIZE, QUANT_GROUP_SIZE[QUANTIZE])
+        merged.config.torch_dtype = EXPORT_DTYPE
+        merged.config.save_pretrained(EXPORT_DIR)
+        save_sharded(state, EXPORT_DIR)
+        with open(os.path.join(EXPORT_DIR, QUANT_CONFIG_NAME), "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "method": QUANTIZE,
+                    "group_size": QUANT_GROUP_SIZE[QUANTIZE],
+                    "modules": {n: state[f"{n}.scales"].shape[1] for n in targets},
+                },
+                f,
+                indent=2,
+            )
+        print(f"量化 {len(targets)} 個 Linear 成 {QUANTIZE}")
+    del merged, model, base
+
+    size = sum(
+        os.path.getsize(os.path.join(EXPORT_DIR, f)) for f in os.listdir(EXPORT_DIR) if f.endswith(".safetensors")
+    )
+    print(f"已匯出到 {EXPORT_DIR}（safetensors 共 {size / 2**20:.1f} MB）")
+
+    # 4. 從匯出目錄重新載入，和未合併的模型比對
+    exported = load_exported(EXPORT_DIR, device)
+    report = compare_logits(reference, tail_logits(exported, inputs, device))
+    report.update({"quantize": QUANTIZE, "samples": len(inputs), "size_bytes": size})
+    with open(os.path.join(EXPORT_DIR, REPORT_NAME), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(
+        f"parity：logits 最大誤差 {report['max_abs_logit_diff']:.2e}，"
+        f"top-1 一致 {report['top1_agreement']:.2%}（{report['positions']} 個位置）"
+    )
+
+    ok = report["top1_agreement"] >= PARITY_MIN_TOP1[QUANTIZE]
+    if QUANTIZE is None:
+        ok = ok and report["max_abs_logit_diff"] <= PARITY_ATOL
+    if not ok:
+        raise SystemExit("parity 檢查沒通過：匯出的模型和未合併的 adapter 輸出差太多")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+
+# =========================================================
+# 欄位式（columnar）菜色資料表
+# =========================================================
+#
+# nutrition_dataset.json 是 list of dict，每產生一份菜單就要整個掃一遍。
+# 這裡把菜色轉成 NumPy 欄位：
+#   - 數值欄位：一欄一個 array
+#   - 類別欄位（category / cuisine_type / carbon_footprint_label）：整數代碼 + 詞表
+#   - 多值欄位（tags / allergens）：bitmask，查詢就是一次位元運算
+#   - name：一整塊 UTF-8 bytes + offsets
+# 並提供 tag / category / restaurant / 熱量與蛋白質區間的索引，以及依目標快取的候選集合。
+# 存檔格式是一個目錄，每欄一個 .npy，讀回時用 mmap，百萬道菜也是瞬間載入。
+
+NUMERIC_COLUMNS = {
+    "dish_id": np.int64,
+    "restaurant_id": np.int32,
+    "calories_kcal": np.int32,
+    "protein_g": np.int32,
+    "carbs_g": np.int32,
+    "fat_g": np.int32,
+    "carbon_footprint_kg_co2e": np.float32,
+    "is_spicy": np.bool_,
+    "is_vegetarian": np.bool_,
+    "is_vegan": np.bool_,
+}
+CATEGORY_COLUMNS = ("category", "cuisine_type", "carbon_footprint_label")
+MASK_COLUMNS = ("tags", "allergens")
+COLUMN_DTYPES = {
+    **NUMERIC_COLUMNS,
+    **{col: np.int16 for col in CATEGORY_COLUMNS},
+    **{col: np.uint64 for col in MASK_COLUMNS},
+}
+
+FORMAT_VERSION = 1
+
+
+class DishTable:
+    def __init__(self, columns: Dict[str, np.ndarray], vocab: Dict[str, List[str]], name_blob, name_offsets):
+        self.columns = columns
+        self.vocab = vocab
+        self._name_blob = name_blob
+        self._name_offsets = name_offsets
+        self.n = len(columns["dish_id"])
+
+        self._code = {col: {v: i for i, v in enumerate(vocab[col])} for col in vocab}
+        self._postings: Dict[Any, np.ndarray] = {}
+        self._sorted: Dict[str, Any] = {}
+        self._candidates: Dict[str, np.ndarray] = {}
+        self._by_restaurant: Optional[Dict[int, np.ndarray]] = None
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, col: str) -> np.ndarray:
+        return self.columns[col]
+
+    # ---------------------------------------------------------
+    # 建表 / 存讀檔
+    # ---------------------------------------------------------
+
+    @classmethod
+    def from_records(cls, dishes: List[Dict[str, Any]]) -> "DishTable":
+        columns = {
+            col: np.array([d[col] for d in dishes], dtype=dtype)
+            for col, dtype in NUMERIC_COLUMNS.items()
+        }
+
+        vocab: Dict[str, List[str]] = {}
+        for col in CATEGORY_COLUMNS:
+            values = sorted({d[col] for d in dishes})
+            code = {v: i for i, v in enumerate(values)}
+            vocab[col] = values
+            columns[col] = np.array([code[d[col]] for d in dishes], dtype=np.int16)
+
+        for col in MASK_COLUMNS:
+            values = sorted({v for d in dishes for v in d.get(col, [])})
+            if len(values) > 64:
+                raise ValueError(f"{col} 種類超過 64 個，無法用 bitmask 表示")
+            bit = {v: 1 << i for i, v in enumerate(values)}
+            vocab[col] = values
+            columns[col] = np.array(
+                [sum(bit[v] for v in d.get(col, [])) for d in dishes],
+                dtype=np.uint64,
+            )
+
+        return cls.from_columns(columns, vocab, [d["name"] for d in dishes])
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, np.ndarray], vocab: Dict[str, List[str]], names: List[str]) -> "DishTable":
+        # 直接由欄位建表（大量產生資料時不經過 list of dict）；
+        # 類別欄位是 vocab 的 index，多值欄位的第 i 個 bit 對應 vocab[col][i]
+        encoded = [n.encode("utf-8") for n in names]
+        name_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=name_offsets[1:])
+        name_blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(columns, vocab, name_blob, name_offsets)
+
+    @classmethod
+    def from_json(cls, path: str) -> "DishTable":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls.from_records(data["dishes"])
+
+    def save(self, out_dir: str):
+        out = Path(out_dir)
+        out.mkdir(parents=True, exist_ok=True)
+        for col, arr in self.columns.items():
+            np.save(out / f"{col}.npy", np.ascontiguousarray(arr))
+        np.save(out / "name_blob.npy", np.ascontiguousarray(self._name_blob))
+        np.save(out / "name_offsets.npy", self._name_offsets)
+        # meta.json 最後寫，代表整個目錄已經完整
+        with open(out / "meta.json", "w", encoding="utf-8") as f:
+            json.dump(
+                {"version": FORMAT_VERSION, "n": self.n, "vocab": self.vocab},
+                f,
+                ensure_ascii=False,
+            )
+
+    @classmethod
+    def load(cls, db_dir: str, mmap: bool = True) -> "DishTable":
+        src = Path(db_dir)
+        with open(src / "meta.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"{db_dir} 的格式版本 {meta.get('version')} 不支援")
+
+        mode = "r" if mmap else None
+        columns = {
+            col: np.load(src / f"{col}.npy", mmap_mode=mode)
+            for col in list(NUMERIC_COLUMNS) + list(CATEGORY_COLUMNS) + list(MASK_COLUMNS)
+        }
+        return cls(
+            columns,
+            meta["vocab"],
+            np.load(src / "name_blob.npy", mmap_mode=mode),
+            np.load(src / "name_offsets.npy", mmap_mode=mode),
+        )
+
+    # ---------------------------------------------------------
+    # 單筆資料
+    # ---------------------------------------------------------
+
+    def name(self, i: int) -> str:
+        start, end = self._name_offsets[i], self._name_offsets[i + 1]
+        return bytes(self._name_blob[start:end]).decode("utf-8")
+
+    def decode_mask(self, col: str, value: int) -> List[str]:
+        return [v for b, v in enumerate(self.vocab[col]) if int(value) >> b & 1]
+
+    def category_value(self, col: str, i: int) -> str:
+        return self.vocab[col][int(self.columns[col][i])]
+
+    def record(self, i: int) -> Dict[str, Any]:
+        # 還原成 nutrition_dataset.json 的 dict 形式；tags / allergens 是集合，依詞表順序列出
+        rec: Dict[str, Any] = {"name": self.name(i)}
+        for col in NUMERIC_COLUMNS:
+            rec[col] = self.columns[col][i].item()
+        for col in CATEGORY_COLUMNS:
+            rec[col] = self.category_value(col, i)
+        for col in MASK_COLUMNS:
+            rec[col] = self.decode_mask(col, self.columns[col][i])
+        rec["carbon_footprint_kg_co2e"] = round(rec["carbon_footprint_kg_co2e"], 2)
+        return rec
+
+    # ---------------------------------------------------------
+    # 索引查詢（回傳列號 array，結果會快取）
+    # ---------------------------------------------------------
+
+    def bit(self, col: str, value: str) -> int:
+        code = self._code[col].get(value)
+        return 0 if code is None else 1 << code
+
+    def has_mask(self, col: str, values: List[str]) -> np.ndarray:
+        # 布林 array：是否含有 values 中「任一個」
+        bits = 0
+        for v in values:
+            bits |= self.bit(col, v)
+        return (self.columns[col] & np.uint64(bits)) != 0
+
+    def with_tag(self, tag: str) -> np.ndarray:
+        key = ("tags", tag)
+        if key not in self._postings:
+            self._postings[key] = np.flatnonzero(self.has_mask("tags", [tag]))
+        return self._postings[key]
+
+    def in_category(self, category: str) -> np.ndarray:
+        key = ("category", category)
+        if key not in self._postings:
+            code = self._code["category"].get(category, -1)
+            self._postings[key] = np.flatnonzero(self.columns["category"] == code)
+        return self._postings[key]
+
+    def at_restaurant(self, restaurant_id: int) -> np.ndarray:
+        if self._by_restaurant is None:
+            rid = np.asarray(self.columns["restaurant_id"])
+            order = np.argsort(rid, kind="stable")
+            uniq, starts = np.unique(rid[order], return_index=True)
+            bounds = list(starts[1:]) + [len(order)]
+            self._by_restaurant = {
+                int(r): order[s:e] for r, s, e in zip(uniq, starts, bounds)
+            }
+        return self._by_restaurant.get(int(restaurant_id), np.empty(0, dtype=np.int64))
+
+    def _sorted_index(self, col: str) -> Tuple[np.ndarray, np.ndarray]:
+        # (排序用的列號, 排序後的值)，依欄位快取
+        if col not in self._sorted:
+            order = np.argsort(self.columns[col], kind="stable")
+            self._sorted[col] = (order, np.asarray(self.columns[col])[order])
+        return self._sorted[col]
+
+    def in_range(self, col: str, lo: Optional[float] = None, hi: Optional[float] = None) -> np.ndarray:
+        # 閉區間 [lo, hi]；用排序後的 index + searchsorted，不用整欄比較
+        order, values = self._sorted_index(col)
+        start = 0 if lo is None else np.searchsorted(values, lo, side="left")
+        end = len(order) if hi is None else np.searchsorted(values, hi, side="right")
+        return np.sort(order[start:end])
+
+    def lookup(self, col: str, values: List[Any]) -> np.ndarray:
+        # 欄位值 → 列號（例如 dish_id → 列號），順序與 values 相同；有值找不到就丟 KeyError
+        order, sorted_values = self._sorted_index(col)
+        values = np.asarray(values)
+        pos = np.minimum(np.searchsorted(sorted_values, values), len(order) - 1)
+        found = sorted_values[pos] == values
+        if not found.all():
+            raise KeyError(f"{col} 找不到：{values[~found].tolist()}")
+        return order[pos]
+
+    def candidates(self, goal_internal: str) -> np.ndarray:
+        # 和原本 pick_candidate_dishes 的篩選條件相同，依目標快取
+        if goal_internal not in self._candidates:
+            if goal_internal == "fat_loss":
+                cands = np.intersect1d(
+                    self.in_range("calories_kcal", hi=650),
+                    self.with_tag("減脂友善"),
+                    assume_unique=True,
+                )
+            elif goal_internal == "muscle_gain":
+                cands = self.in_range("protein_g", lo=25)
+            else:
+                cands = np.arange(self.n)
+            self._candidates[goal_internal] = cands if len(cands) else np.arange(self.n)
+        return self._candidates[goal_internal]
+
+
+class DishTableWriter:
+    # 分批寫出 DishTable 目錄，記憶體只和每批大小有關（大量產生資料時用）：
+    # 總筆數事先知道，固定長度的欄位先寫好 .npy header，之後逐批把資料 append 在後面；
+    # name 的總長度事先不知道，先逐批 append 到暫存檔，close 時再接上 .npy header。
+    # 寫完的目錄和 DishTable.save 的結果相同。
+    def __init__(self, out_dir: str, n: int, vocab: Dict[str, List[str]]):
+        self.out = Path(out_dir)
+        self.out.mkdir(parents=True, exist_ok=True)
+        # meta.json 代表目錄完整，寫的過程中先拿掉
+        (self.out / "meta.json").unlink(missing_ok=True)
+        self.n = n
+        self.vocab = vocab
+        self.pos = 0
+        self.name_end = 0
+        self._files = {
+            col: self._open_npy(f"{col}.npy", dtype, n) for col, dtype in COLUMN_DTYPES.items()
+        }
+        self._files["name_offsets"] = self._open_npy("name_offsets.npy", np.int64, n + 1)
+        self._files["name_offsets"].write(np.zeros(1, dtype=np.int64).tobytes())
+        self._name_part = open(self.out / "name_blob.part", "wb")
+
+    def _open_npy(self, name: str, dtype, length: int):
+        f = open(self.out / name, "wb")
+        np.lib.format.write_array_header_1_0(
+            f, {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": (length,)}
+        )
+        return f
+
+    def append(self, columns: Dict[str, np.ndarray], names: List[str]):
+        k = len(names)
+        if self.pos + k > self.n:
+            raise ValueError(f"寫入超過預定的 {self.n} 筆")
+        for col, dtype in COLUMN_DTYPES.items():
+            self._files[col].write(np.ascontiguousarray(columns[col], dtype=dtype).tobytes())
+        encoded = [s.encode("utf-8") for s in names]
+        offsets = self.name_end + np.cumsum([len(b) for b in encoded], dtype=np.int64)
+        self._files["name_offsets"].write(offsets.tobytes())
+        self._name_part.write(b"".join(encoded))
+        if k:
+            self.name_end = int(offsets[-1])
+        self.pos += k
+
+    def close(self):
+        if self.pos != self.n:
+            raise ValueError(f"只寫入 {self.pos} 筆，預定 {self.n} 筆")
+        for f in self._files.values():
+            f.close()
+        self._name_part.close()
+
+        part = self.out / "name_blob.part"
+        with open(self.out / "name_blob.npy", "wb") as f:
+            np.lib.format.write_array_header_1_0(
+                f,
+                {
+                    "descr": np.lib.format.dtype_to_descr(np.dtype(np.uint8)),
+                    "fortran_order": False,
+                    "shape": (self.name_end,),
+                },
+            )
+            with open(part, "rb") as src:
+                shutil.copyfileobj(src, f)
+        part.unlink()
+
+        with open(self.out / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({"version": FORMAT_VERSION, "n": self.n, "vocab": self.vocab}, f, ensure_ascii=False)
+
+
+def load_or_build(json_path: str, db_dir: Optional[str] = None) -> DishTable:
+    # 二進位格式比 JSON 舊（或不存在）就重建一次，之後都直接 mmap
+    db_dir = db_dir or os.path.splitext(json_path)[0] + ".dishdb"
+    meta = Path(db_dir) / "meta.json"
+    if not meta.exists() or (
+        os.path.exists(json_path) and os.path.getmtime(json_path) > os.path.getmtime(meta)
+    ):
+        DishTable.from_json(json_path).save(db_dir)
+    return DishTable.load(db_dir)
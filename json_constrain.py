@@ -0,0 +1,691 @@
+import importlib
+import json
+import random
+import re
+from typing import Dict, Any, List, Optional, Tuple
+
+# =========================================================
+# JSON schema 約束解碼（constrained decoding）
+# =========================================================
+#
+# 三個 SFT 任務的 output 都是 json.dumps(obj, ensure_ascii=False)，key 順序固定。
+# 1. schema：直接跑 make_*_sft 的 make_row 取樣，推出每個任務的 JSON schema
+#    （key 順序、必填欄位、陣列長度範圍、選項很少的字串當 enum），存成 SCHEMA_PATH。
+# 2. 狀態機：把 schema 編成 byte 層級的 JSON 自動機，格式固定成 json.dumps 的寫法
+#    （", "、": "），狀態是 hashable 的 tuple stack。
+# 3. token mask：所有 token 的 bytes 建成 trie，從目前狀態沿 trie 做 DFS，
+#    走得通的 token 才允許；mask 依狀態快取，字串內容狀態直接套預先算好的「一般字元 token」集合。
+# 4. 快轉：狀態只有一條路可走時（key、標點、enum 共同前綴、結尾的 response_end），
+#    直接把那段文字 tokenize 接上去，不用一個 token 一個 token 跑 model。
+# 字串長度與數字位數也依樣本設上限（留一些餘裕），所以任何路徑都會在有限長度內結束：
+# max_new_tokens 夠用時，生成結果保證能被 json.loads 解析，也符合 schema。
+
+SCHEMA_PATH = "sft_schemas.json"
+SCHEMA_SOURCES = {
+    "diet": "make_diet_sft",
+    "biz": "make_biz_sft_offline",
+    "brand": "make_brand_sft_offline",
+}
+SCHEMA_SAMPLES = 500     # 每個任務取樣幾筆來推 schema
+SEED = 1234
+
+ENUM_MAX_VALUES = 12     # 字串欄位出現的值不超過這麼多種就當 enum（0 = 不用 enum）
+ENUM_MIN_RATIO = 5       # 且樣本數至少是種類數的這麼多倍，避免樣本太少誤判
+STRING_LENGTH_SLACK = 2  # 自由字串 maxLength = 樣本最長 × 這個倍數
+NUMBER_DIGIT_SLACK = 1   # 整數部分最多比樣本最大值多幾位
+MAX_FRACTION_DIGITS = 6
+MAX_EXPONENT_DIGITS = 3
+
+MAX_FORCED_BYTES = 512
+MASK_CACHE_SIZE = 4096
+STATE_CACHE_SIZE = 4096   # 自動機的 allowed_bytes / 候選字串與快轉結果，各自最多快取幾個狀態
+
+_QUOTE, _BACKSLASH = 0x22, 0x5C
+_DIGITS = frozenset(b"0123456789")
+_HEX = frozenset(b"0123456789abcdefABCDEF")
+_ESCAPES = frozenset(b'"\\/bfnrtu')
+
+
+# ---------------------------------------------------------
+# 由樣本推 schema
+# ---------------------------------------------------------
+
+def _json_type(value: Any) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "integer"
+    if isinstance(value, float):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, list):
+        return "array"
+    if isinstance(value, dict):
+        return "object"
+    raise TypeError(f"不是 JSON 值：{type(value)}")
+
+
+def infer_schema(values: List[Any], enum_max: int = ENUM_MAX_VALUES) -> Dict[str, Any]:
+    by_type: Dict[str, List[Any]] = {}
+    for value in values:
+        by_type.setdefault(_json_type(value), []).append(value)
+    # 整數和小數都出現過就統一當 number
+    if "integer" in by_type and "number" in by_type:
+        by_type["number"] += by_type.pop("integer")
+
+    schemas = [_infer_typed(t, vs, enum_max) for t, vs in by_type.items()]
+    if not schemas:
+        return {}
+    return schemas[0] if len(schemas) == 1 else {"anyOf": schemas}
+
+
+def _infer_typed(json_type: str, values: List[Any], enum_max: int) -> Dict[str, Any]:
+    if json_type == "object":
+        keys: List[str] = []
+        for obj in values:
+            for k in obj:
+                if k not in keys:
+                    keys.append(k)
+        return {
+            "type": "object",
+            "properties": {k: infer_schema([o[k] for o in values if k in o], enum_max) for k in keys},
+            "required": [k for k in keys if all(k in o for o in values)],
+        }
+    if json_type == "array":
+        lengths = [len(v) for v in values]
+        return {
+            "type": "array",
+            "items": infer_schema([x for v in values for x in v], enum_max),
+            "minItems": min(lengths),
+            "maxItems": max(lengths),
+        }
+    if json_type == "string":
+        distinct = sorted(set(values))
+        if len(distinct) <= enum_max and len(values) >= ENUM_MIN_RATIO * len(distinct):
+            return {"type": "string", "enum": distinct}
+        return {"type": "string", "maxLength": max(1, max(len(v) for v in values)) * STRING_LENGTH_SLACK}
+    if json_type in ("integer", "number"):
+        # maximum 在自動機裡只用來限制整數部分的位數
+        schema: Dict[str, Any] = {"type": json_type, "maximum": max(abs(v) for v in values)}
+        if min(values) >= 0:
+            schema["minimum"] = 0
+        return schema
+    return {"type": json_type}
+
+
+def sample_rows(module_name: str, n: int, seed: int = SEED) -> List[Dict[str, Any]]:
+    mod = importlib.import_module(module_name)
+    # make_diet_sft 要先建好菜色資料表、初始化 planner（和 worker 的 initializer 相同）
+    if hasattr(mod, "load_food_db"):
+        mod.load_food_db(mod.DATA_PATH, mod.DB_DIR)
+        mod.init_worker(mod.DB_DIR)
+    random.seed(seed)
+    return [mod.make_row() for _ in range(n)]
+
+
+def build_schemas(n_samples: int = SCHEMA_SAMPLES) -> Dict[str, Any]:
+    schemas: Dict[str, Any] = {}
+    instructions: Dict[str, str] = {}
+    for name, module_name in SCHEMA_SOURCES.items():
+        rows = sample_rows(module_name, n_samples)
+        schemas[name] = infer_schema([json.loads(r["output"]) for r in rows])
+        for r in rows:
+            instructions[r["instruction"]] = name
+    return {"schemas": schemas, "instructions": instructions}
+
+
+def load_schemas(path: str = SCHEMA_PATH) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# ---------------------------------------------------------
+# JSON 自動機（byte 層級）
+# ---------------------------------------------------------
+#
+# 狀態是 frame 的 tuple（最後一個是目前這層），每種 frame：
+#   ("lit", text, pos)                   固定字串
+#   ("enum", nid, consumed)              enum 值（含引號）
+#   ("str", nid, phase, n)               自由字串：-1 等開頭引號、0 內容、1 反斜線後、2~5 \uXXXX；n = 已有幾個字元
+#   ("num", nid, phase, k)               數字：k = 目前這段（整數 / 小數 / 指數）已有幾位
+#   ("obj", nid, idx, any, consumed)     object：idx = 下一個可能的 key（-1 還沒開始），any = 已經有 key
+#   ("arr", nid, count, consumed)        array：count = 已有幾個元素（-1 還沒開始）
+#   ("any", nid)                         anyOf，看第一個 byte 決定走哪個
+
+class JsonAutomaton:
+    def __init__(self, schema: Dict[str, Any], suffix: str = ""):
+        self.nodes: List[Tuple] = []
+        self.root = self._compile(schema)
+        self.suffix = suffix.encode("utf-8")
+        self._candidates: Dict[Tuple, List[Tuple[bytes, Any]]] = {}
+        self._allowed: Dict[Tuple, List[int]] = {}
+
+    def _compile(self, schema: Dict[str, Any]) -> int:
+        nid = len(self.nodes)
+        self.nodes.append(())
+        t = schema.get("type")
+        if "anyOf" in schema:
+            node = ("any", tuple(self._compile(s) for s in schema["anyOf"]))
+        elif "enum" in schema:
+            node = ("enum", tuple(json.dumps(v, ensure_ascii=False).encode("utf-8") for v in schema["enum"]))
+        elif t == "object":
+            required = set(schema.get("required", []))
+            node = ("object", tuple(
+                (json.dumps(k, ensure_ascii=False).encode("utf-8"), self._compile(s), k in required)
+                for k, s in schema.get("properties", {}).items()
+            ))
+        elif t == "array":
+            node = ("array", self._compile(schema.get("items", {})), schema.get("minItems", 0), schema.get("maxItems"))
+        elif t in ("integer", "number"):
+            max_digits = None
+            if "maximum" in schema:
+                max_digits = len(str(int(abs(schema["maximum"])))) + NUMBER_DIGIT_SLACK
+            node = ("number", t == "number", schema.get("minimum", -1) >= 0, max_digits)
+        elif t == "boolean":
+            node = ("enum", (b"true", b"false"))
+        elif t == "null":
+            node = ("enum", (b"null",))
+        else:
+            # "string"，以及樣本裡從沒出現過元素的陣列（items 是空 schema）
+            node = ("string", schema.get("maxLength"))
+        self.nodes[nid] = node
+        return nid
+
+    def _start_frame(self, nid: int) -> Tuple:
+        kind = self.nodes[nid][0]
+        if kind == "enum":
+            return ("enum", nid, b"")
+        if kind == "string":
+            return ("str", nid, -1, 0)
+        if kind == "number":
+            return ("num", nid, 0, 0)
+        if kind == "object":
+            return ("obj", nid, -1, False, b"")
+        if kind == "array":
+            return ("arr", nid, -1, b"")
+        return ("any", nid)
+
+    def start(self) -> Tuple:
+        stack: Tuple = (("lit", self.suffix, 0),) if self.suffix else ()
+        return stack + (self._start_frame(self.root),)
+
+    def _object_candidates(self, nid: int, idx: int, any_key: bool) -> List[Tuple[bytes, Any]]:
+        # 目前位置可以接的固定字串：下一個 key（可跳過選填的）或 "}"
+        key = (nid, idx, any_key)
+        if key not in self._candidates:
+            props = self.nodes[nid][1]
+            if idx < 0:
+                cands = [(b"{" + lit, action) for lit, action in self._object_candidates(nid, 0, False)]
+            else:
+                cands = []
+                for j in range(idx, len(props)):
+                    name, _, required = props[j]
+                    cands.append(((b", " if any_key else b"") + name + b": ", j))
+                    if required:
+                        break
+                else:
+                    cands.append((b"}", None))
+            # idx < 0 會遞迴先放進 (nid, 0, False)，上限要在最後存入前才檢查
+            if len(self._candidates) >= STATE_CACHE_SIZE:
+                self._candidates.clear()
+            self._candidates[key] = cands
+        return self._candidates[key]
+
+    def step(self, stack: Tuple, b: int) -> Optional[Tuple]:
+        # 吃一個 byte，回傳新狀態；不合法回傳 None
+        while stack:
+            top, rest = stack[-1], stack[:-1]
+            kind = top[0]
+
+            if kind == "lit":
+                _, text, pos = top
+                if text[pos] != b:
+                    return None
+                return rest if pos + 1 == len(text) else rest + (("lit", text, pos + 1),)
+
+            if kind == "enum":
+                _, nid, consumed = top
+                cand = consumed + bytes((b,))
+                values = self.nodes[nid][1]
+                if cand in values:
+                    return rest
+                if any(v.startswith(cand) for v in values):
+                    return rest + (("enum", nid, cand),)
+                return None
+
+            if kind == "str":
+                # phase：-1 開頭引號前、0 內容、1 反斜線後、2~5 \u 的 hex、6~8 多 byte 字元還差 1~3 個延續 byte
+                _, nid, phase, n = top
+                if phase == -1:
+                    return rest + (("str", nid, 0, 0),) if b == _QUOTE else None
+                if phase >= 6:
+                    if not 0x80 <= b < 0xC0:
+                        return None
+                    return rest + (("str", nid, 0 if phase == 6 else phase - 1, n),)
+                if phase == 0 and b == _QUOTE:
+                    return rest
+                if b < 0x20:
+                    return None
+                # 只接受完整的 UTF-8 字元，否則 token 可以無限接延續 byte，長度限制就失效了
+                if b >= 0x80 and (phase != 0 or not 0xC2 <= b <= 0xF4):
+                    return None
+                # 每個字元算一個（跳脫序列每個 byte 各算一個，偏保守）
+                max_len = self.nodes[nid][1]
+                if max_len is not None and n >= max_len:
+                    return None
+                n += 1
+                if phase == 0:
+                    if b >= 0xC0:
+                        return rest + (("str", nid, 8 if b >= 0xF0 else 7 if b >= 0xE0 else 6, n),)
+                    return rest + (("str", nid, 1 if b == _BACKSLASH else 0, n),)
+                if phase == 1:
+                    if b not in _ESCAPES:
+                        return None
+                    return rest + (("str", nid, 2 if b == ord("u") else 0, n),)
+                if b not in _HEX:
+                    return None
+                return rest + (("str", nid, 0 if phase == 5 else phase + 1, n),)
+
+            if kind == "num":
+                # phase：0 開頭、1 負號後、2 開頭是 0、3 整數、4 小數點後、5 小數、6 e 後、7 指數正負號後、8 指數
+                _, nid, phase, k = top
+                _, is_float, unsigned, max_digits = self.nodes[nid]
+                nxt = None
+                if phase == 0:
+                    if b == ord("-") and not unsigned:
+                        nxt = 1
+                    elif b == ord("0"):
+                        nxt = 2
+                    elif b in _DIGITS:
+                        nxt = 3
+                elif phase == 1:
+                    nxt = 2 if b == ord("0") else 3 if b in _DIGITS else None
+                elif phase in (2, 3, 5):
+                    if b in _DIGITS and phase != 2:
+                        limit = max_digits if phase == 3 else MAX_FRACTION_DIGITS
+                        if limit is None or k < limit:
+                            return rest + (("num", nid, phase, k + 1),)
+                    elif b == ord(".") and is_float and phase != 5:
+                        nxt = 4
+                    elif b in b"eE" and is_float:
+                        nxt = 6
+                elif phase == 4:
+                    nxt = 5 if b in _DIGITS else None
+                elif phase == 6:
+                    nxt = 7 if b in b"+-" else 8 if b in _DIGITS else None
+                elif phase == 7:
+                    nxt = 8 if b in _DIGITS else None
+                elif phase == 8 and b in _DIGITS and k < MAX_EXPONENT_DIGITS:
+                    return rest + (("num", nid, 8, k + 1),)
+
+                if nxt is not None:
+                    # 進入新的一段：已經吃下第一位數字的話 k = 1
+                    return rest + (("num", nid, nxt, 1 if b in _DIGITS else 0),)
+                if phase in (2, 3, 5, 8):
+                    # 數字在這裡結束，這個 byte 交給外層處理
+                    stack = rest
+                    continue
+                return None
+
+            if kind == "any":
+                for alt in self.nodes[top[1]][1]:
+                    new = self.step(rest + (self._start_frame(alt),), b)
+                    if new is not None:
+                        return new
+                return None
+
+            if kind == "obj":
+                _, nid, idx, any_key, consumed = top
+                cand = consumed + bytes((b,))
+                partial = False
+                for lit, action in self._object_candidates(nid, idx, any_key):
+                    if lit == cand:
+                        if action is None:
+                            return rest
+                        value_nid = self.nodes[nid][1][action][1]
+                        return rest + (("obj", nid, action + 1, True, b""), self._start_frame(value_nid))
+                    partial = partial or lit.startswith(cand)
+                return rest + (("obj", nid, idx, any_key, cand),) if partial else None
+
+            if kind == "arr":
+                _, nid, count, consumed = top
+                _, item_nid, min_items, max_items = self.nodes[nid]
+                if count == -1:
+                    return rest + (("arr", nid, 0, b""),) if b == ord("[") else None
+                if count == 0:
+                    if b == ord("]"):
+                        return rest if min_items == 0 else None
+                    if max_items == 0:
+                        return None
+                    return self.step(rest + (("arr", nid, 1, b""), self._start_frame(item_nid)), b)
+
+                cand = consumed + bytes((b,))
+                more = max_items is None or count < max_items
+                if more and cand == b", ":
+                    return rest + (("arr", nid, count + 1, b""), self._start_frame(item_nid))
+                if cand == b"]" and count >= min_items:
+                    return rest
+                if more and b", ".startswith(cand):
+                    return rest + (("arr", nid, count, cand),)
+                return None
+
+            raise ValueError(f"未知的 frame：{top}")
+        return None
+
+    def accepts(self, data: bytes) -> bool:
+        state: Optional[Tuple] = self.start()
+        for b in data:
+            state = self.step(state, b)
+            if state is None:
+                return False
+        return state == ()
+
+    def allowed_bytes(self, state: Tuple) -> List[int]:
+        if state not in self._allowed:
+            if len(self._allowed) >= STATE_CACHE_SIZE:
+                self._allowed.clear()
+            self._allowed[state] = [b for b in range(256) if self.step(state, b) is not None]
+        return self._allowed[state]
+
+    def forced(self, state: Tuple) -> Tuple[bytes, List[Tuple]]:
+        # 只有一條路可走的 byte 串，以及走完每個 byte 後的狀態
+        out = bytearray()
+        states = []
+        while state and len(out) < MAX_FORCED_BYTES:
+            nxt = self.allowed_bytes(state)
+            if len(nxt) != 1:
+                break
+            state = self.step(state, nxt[0])
+            out.append(nxt[0])
+            states.append(state)
+        return bytes(out), states
+
+
+# ---------------------------------------------------------
+# token trie 與 mask
+# ---------------------------------------------------------
+
+def token_bytes(tokenizer, vocab_size: Optional[int] = None) -> List[Optional[bytes]]:
+    # 每個 token id 對應的原始 bytes；特殊 token 與超出 tokenizer 的 id 為 None
+    vocab_size = vocab_size or len(tokenizer)
+    special = set(tokenizer.all_special_ids) | set(getattr(tokenizer, "added_tokens_decoder", {}))
+    pieces = tokenizer.convert_ids_to_tokens(list(range(min(vocab_size, len(tokenizer)))))
+
+    byte_level = False
+    if getattr(tokenizer, "is_fast", False):
+        decoder = json.loads(tokenizer.backend_tokenizer.to_str()).get("decoder")
+        byte_level = "ByteLevel" in json.dumps(decoder)
+    if byte_level:
+        from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+        byte_decoder = {c: b for b, c in bytes_to_unicode().items()}
+
+    out: List[Optional[bytes]] = []
+    for i, piece in enumerate(pieces):
+        if piece is None or i in special:
+            out.append(None)
+        elif byte_level:
+            try:
+                out.append(bytes(byte_decoder[c] for c in piece))
+            except KeyError:
+                out.append(None)
+        elif re.fullmatch(r"<0x[0-9A-Fa-f]{2}>", piece):
+            # sentencepiece 的 byte fallback
+            out.append(bytes([int(piece[3:5], 16)]))
+        else:
+            out.append(piece.replace("▁", " ").encode("utf-8"))
+    out.extend([None] * (vocab_size - len(out)))
+    return out
+
+
+def _build_trie(items: List[Tuple[int, bytes]]) -> List:
+    # node = [children: {byte: node}, 在這裡結束的 token ids]
+    root: List = [{}, []]
+    for tid, data in items:
+        node = root
+        for b in data:
+            node = node[0].setdefault(b, [{}, []])
+        node[1].append(tid)
+    return root
+
+
+def _is_plain(data: bytes) -> bool:
+    try:
+        data.decode("utf-8")
+    except UnicodeDecodeError:
+        return False
+    return all(x >= 0x20 and x not in (_QUOTE, _BACKSLASH) for x in data)
+
+
+class TokenIndex:
+    def __init__(self, tokenizer, vocab_size: Optional[int] = None):
+        self.tokenizer = tokenizer
+        self.bytes = token_bytes(tokenizer, vocab_size)
+        self.vocab_size = len(self.bytes)
+        items = [(i, b) for i, b in enumerate(self.bytes) if b]
+        # 「一般字元」token：完整的 UTF-8 字元、不含引號、反斜線、控制字元，在字串內容中間只要長度沒超過就合法
+        plain = [(i, b) for i, b in items if _is_plain(b)]
+        plain_set = {i for i, _ in plain}
+        self.trie = _build_trie(items)
+        self.special_trie = _build_trie([(i, b) for i, b in items if i not in plain_set])
+
+        # 每個 token 的字元數（計法和 JsonAutomaton 相同）；非一般字元 token 設成極大值
+        chars = {i: sum(1 for x in b if not 0x80 <= x < 0xC0) for i, b in items}
+        self.max_chars = max(chars.values(), default=0)
+        self.plain_chars = [1 << 30] * self.vocab_size
+        for i, _ in plain:
+            self.plain_chars[i] = chars[i]
+
+
+class JsonConstraint:
+    # 一個 schema 配一個 tokenizer：負責 mask 與快轉，結果都依狀態快取
+    def __init__(self, automaton: JsonAutomaton, index: TokenIndex, device=None):
+        self.automaton = automaton
+        self.index = index
+        self.device = device
+        self._masks: Dict[Tuple, Any] = {}
+        self._forward: Dict[Tuple, Tuple[List[int], Tuple]] = {}
+        self._plain_chars = None
+
+    def start(self) -> Tuple:
+        return self.automaton.start()
+
+    def advance(self, state: Tuple, token_id: int) -> Optional[Tuple]:
+        data = self.index.bytes[token_id]
+        if not data:
+            return None
+        for b in data:
+            state = self.automaton.step(state, b)
+            if state is None:
+                return None
+        return state
+
+    def _string_remaining(self, state: Tuple) -> Optional[int]:
+        # 在自由字串內容中時回傳還能放幾個字元（沒有上限回傳 -1），否則 None
+        top = state[-1] if state else None
+        if top is None or top[0] != "str" or top[2] != 0:
+            return None
+        max_len = self.automaton.nodes[top[1]][1]
+        return -1 if max_len is None else max_len - top[3]
+
+    def _mask_key(self, state: Tuple) -> Tuple:
+        # 字串剩餘長度比任何 token 都長時，長度限制不會影響 mask：統一成同一個狀態，快取才有效
+        remaining = self._string_remaining(state)
+        if remaining is not None and remaining > self.index.max_chars:
+            _, nid, phase, _ = state[-1]
+            max_len = self.automaton.nodes[nid][1]
+            return state[:-1] + (("str", nid, phase, max_len - self.index.max_chars),)
+        return state
+
+    def allowed_ids(self, state: Tuple) -> List[int]:
+        # 字串內容中的一般字元 token 另外用 plain_chars 向量化處理，這裡只回傳 DFS 走得通的
+        step = self.automaton.step
+        ids: List[int] = []
+        if self._string_remaining(state) is not None:
+            trie = self.index.special_trie
+        else:
+            trie = self.index.trie
+
+        todo = [(state, trie)]
+        while todo:
+            cur, node = todo.pop()
+            for b, child in node[0].items():
+                nxt = step(cur, b)
+                if nxt is None:
+                    continue
+                ids.extend(child[1])
+                if child[0]:
+                    todo.append((nxt, child))
+        return ids
+
+    def mask(self, state: Tuple):
+        import torch
+
+        state = self._mask_key(state)
+        if state not in self._masks:
+            if len(self._masks) >= MASK_CACHE_SIZE:
+                self._masks.clear()
+            remaining = self._string_remaining(state)
+            if remaining is None:
+                mask = torch.zeros(self.index.vocab_size, dtype=torch.bool)
+            else:
+                if self._plain_chars is None:
+                    self._plain_chars = torch.tensor(self.index.plain_chars)
+                limit = self.index.max_chars if remaining < 0 else remaining
+                mask = self._plain_chars <= limit
+            ids = self.allowed_ids(state)
+            if ids:
+                mask[torch.tensor(ids)] = True
+            self._masks[state] = mask.to(self.device) if self.device is not None else mask
+        return self._masks[state]
+
+    def fast_forward(self, state: Tuple) -> Tuple[List[int], Tuple]:
+        # 回傳可以直接接上的 token 與之後的狀態；沒有固定路徑（或 tokenize 對不上）就回傳 ([], state)
+        if state not in self._forward:
+            if len(self._forward) >= STATE_CACHE_SIZE:
+                self._forward.clear()
+            data, states = self.automaton.forced(state)
+            # 只切在完整的 UTF-8 字元邊界
+            cut = len(data)
+            while cut > 0:
+                try:
+                    text = data[:cut].decode("utf-8")
+                    break
+                except UnicodeDecodeError:
+                    cut -= 1
+            result: Tuple[List[int], Tuple] = ([], state)
+            if cut > 0:
+                ids = self.index.tokenizer.encode(text, add_special_tokens=False)
+                if b"".join(self.index.bytes[i] or b"\0" for i in ids) == data[:cut]:
+                    result = (ids, states[cut - 1])
+            self._forward[state] = result
+        return self._forward[state]
+
+
+# ---------------------------------------------------------
+# 約束解碼（greedy）
+# ---------------------------------------------------------
+
+def constrained_generate(
+    model,
+    constraints: List[JsonConstraint],
+    input_ids,
+    attention_mask,
+    max_new_tokens: List[int],
+    pad_token_id: int,
+    past_key_values=None,
+    model_kwargs: Optional[Dict[str, Any]] = None,
+) -> List[List[int]]:
+    # input_ids / attention_mask 是整段（含已在 past_key_values 裡的部分）；回傳每列新產生的 token。
+    # 每一輪每列先接 model 選的 token（限制在 mask 內），再接快轉的固定 token；
+    # 各列接的 token 數不同時靠左補 pad（mask 掉），最後一個位置一定是該列真正的最後一個 token。
+    import torch
+    from transformers import DynamicCache
+
+    device = input_ids.device
+    cache = past_key_values if past_key_values is not None else DynamicCache()
+    feed = input_ids[:, cache.get_seq_length():]
+    mask = attention_mask
+    states = [c.start() for c in constraints]
+    outputs: List[List[int]] = [[] for _ in constraints]
+    done = [False] * len(constraints)
+
+    with torch.inference_mode():
+        while True:
+            positions = (mask.long().cumsum(-1) - 1).clamp(min=0)[:, -feed.shape[1]:]
+            logits = model(
+                input_ids=feed,
+                attention_mask=mask,
+                position_ids=positions,
+                past_key_values=cache,
+                use_cache=True,
+                **(model_kwargs or {}),
+            ).logits[:, -1]
+
+            new_tokens: List[List[int]] = []
+            for i, constraint in enumerate(constraints):
+                if done[i]:
+                    new_tokens.append([])
+                    continue
+                tokens, after = constraint.fast_forward(states[i])
+                if not tokens:
+                    allowed = constraint.mask(states[i])
+                    row = logits[i, : allowed.shape[0]].masked_fill(~allowed, float("-inf"))
+                    if not torch.isfinite(row).any():
+                        done[i] = True
+                        new_tokens.append([])
+                        continue
+                    tid = int(row.argmax())
+                    # 選完之後若接著是固定字串，同一輪一起接上
+                    forced, after = constraint.fast_forward(constraint.advance(states[i], tid))
+                    tokens = [tid] + forced
+                states[i] = after
+
+                budget = max_new_tokens[i] - len(outputs[i])
+                tokens = tokens[:budget]
+                outputs[i].extend(tokens)
+                if states[i] == () or len(outputs[i]) >= max_new_tokens[i]:
+                    done[i] = True
+                new_tokens.append(tokens)
+
+            if all(done):
+                break
+            width = max(len(t) for t in new_tokens)
+            feed = torch.tensor(
+                [[pad_token_id] * (width - len(t)) + t for t in new_tokens], device=device
+            )
+            step_mask = torch.tensor(
+                [[0] * (width - len(t)) + [1] * len(t) for t in new_tokens], device=device
+            )
+            mask = torch.cat([mask, step_mask.to(mask.dtype)], dim=1)
+    return outputs
+
+
+def main():
+    registry = build_schemas()
+    with open(SCHEMA_PATH, "w", encoding="utf-8") as f:
+        json.dump(registry, f, ensure_ascii=False, indent=2)
+
+    # 自我檢查：訓練資料的 output 都要被自己的 schema 接受，順便看有多少 byte 可以快轉
+    for name, module_name in SCHEMA_SOURCES.items():
+        automaton = JsonAutomaton(registry["schemas"][name])
+        rows = sample_rows(module_name, 50, seed=SEED + 1)
+        accepted = forced = total = 0
+        for r in rows:
+            data = r["output"].encode("utf-8")
+            accepted += automaton.accepts(data)
+            state = automaton.start()
+            for b in data:
+                forced += len(automaton.allowed_bytes(state)) == 1
+                state = automaton.step(state, b)
+                if state is None:
+                    break
+            total += len(data)
+        print(f"{name}：{accepted}/{len(rows)} 筆樣本符合 schema，固定（可快轉）的 byte 佔 {forced / total:.0%}")
+    print(f"已產生 {SCHEMA_PATH}（{len(registry['schemas'])} 個 schema、{len(registry['instructions'])} 種 instruction）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+# LoRA / QLoRA SFT 訓練：設定（config）、prompt template（text）、訓練流程（train）、throughput sweep（sweep）
+#
+# 這裡只匯出輕量的設定與 template，不 import torch；訓練流程用時再 from lora_sft.train import train。
+
+from .config import (
+    ModelConfig,
+    LoraSettings,
+    DataConfig,
+    TrainConfig,
+    SFTConfig,
+    PRESETS,
+    DEFAULT_PRESET,
+    ConfigError,
+    build_config,
+)
+from .text import SpecialTokens, TOKENS, RESPONSE_MARKER, build_text, build_texts
@@ -0,0 +1,257 @@
+import copy
+import json
+import os
+from dataclasses import dataclass, field, fields, asdict, is_dataclass
+from typing import Dict, Any, List, Optional
+
+# =========================================================
+# 訓練設定：model / lora / data / train 四段，全部可由 YAML / JSON 檔與命令列覆寫
+# =========================================================
+#
+# 設定檔格式（YAML 或 JSON，欄位名稱同下面的 dataclass；沒寫的欄位用 preset 的值）：
+#   preset: qlora-70b
+#   model:
+#     model_id: meta-llama/Meta-Llama-3.1-8B-Instruct
+#   lora:
+#     r: 16
+#   data:
+#     packing: true
+# 命令列再用 --set 區段.欄位=值 覆寫，值用 JSON 解析（解析不了就當字串），例：
+#   --set lora.r=32 --set data.batching=token_budget --set lora.target_modules='["q_proj","v_proj"]'
+# 欄位名稱打錯會直接報錯，避免 sweep 跑了一輪才發現設定沒生效。
+
+QUANTIZATION_CHOICES = (None, "4bit", "8bit")
+PRECISION_CHOICES = ("auto", "fp32", "fp16", "bf16")
+BATCHING_CHOICES = ("token_budget", "length", "none")
+MIX_STOPPING_CHOICES = ("all_exhausted", "first_exhausted")
+
+
+class ConfigError(ValueError):
+    # 設定 / 命令列參數錯誤；python -m lora_sft 只把這類錯誤印成一行訊息，訓練中的錯誤照常帶 traceback
+    pass
+
+
+@dataclass
+class ModelConfig:
+    model_id: str = "meta-llama/Llama-3.2-1B"
+    quantization: Optional[str] = None         # None / "4bit"（QLoRA, nf4）/ "8bit"，需要 bitsandbytes + CUDA
+    precision: str = "auto"                    # "auto"：CUDA 上 fp16、CPU 上 fp32
+    gradient_checkpointing: bool = False
+    attn_implementation: Optional[str] = None  # None = transformers 預設；例如 "sdpa"、"flash_attention_2"
+    device_map: Optional[str] = None           # 量化大模型用 "auto"；None = 整個模型放同一張卡
+
+
+@dataclass
+class LoraSettings:
+    r: int = 8
+    alpha: int = 16
+    dropout: float = 0.05
+    target_modules: List[str] = field(default_factory=lambda: ["q_proj", "k_proj", "v_proj", "o_proj"])
+
+
+@dataclass
+class DataConfig:
+    data_path: str = "all_sft.jsonl"
+    max_length: int = 1024
+    use_token_cache: bool = True               # tokenize 結果快取在 .sft_cache/
+    tokenize_num_proc: Optional[int] = None    # None = 依 CPU 核心數（資料少時自動單行程）
+    response_only_loss: bool = False
+    # 多來源混合（sft_mixing.MixSource 的欄位），有設定時不讀 data_path，例：
+    #   mix_sources: [{name: diet, pattern: "diet_sft*.jsonl", weight: 0.5}, ...]
+    mix_sources: List[Dict[str, Any]] = field(default_factory=list)
+    mix_temperature: float = 1.0
+    mix_stopping_strategy: str = "all_exhausted"   # 或 "first_exhausted"（任一來源取完就停，其餘剩下的不用）
+    packing: bool = False
+    pack_block_size: int = 1024
+    batching: str = "none"                     # packing=false 時："token_budget" / "length" / "none"
+    max_tokens_per_batch: Optional[int] = None  # token_budget 用；None = per_device_batch_size × max_length
+    # 串流模式（sft_stream.py）：逐行讀 data_path（可用 glob 指多個分片），在 DataLoader worker 裡
+    # tokenize / packing，不轉 Arrow、不用快取；訓練長度用 train.max_steps 指定
+    streaming: bool = False
+    shuffle_buffer: int = 2_000                # 每個 worker 的 shuffle buffer；0 = 不打散，照讀到的順序
+    stream_workers: int = 2
+
+
+@dataclass
+class TrainConfig:
+    output_dir: str = "./multi-lora"
+    per_device_batch_size: int = 1
+    gradient_accumulation_steps: int = 8
+    learning_rate: float = 2e-4
+    num_train_epochs: float = 3
+    max_steps: int = -1                        # > 0 時取代 num_train_epochs（throughput 測試跑幾步就好）
+    optim: str = "adamw_torch"
+    logging_steps: int = 10
+    save_steps: int = 500
+    save_total_limit: Optional[int] = 2
+    async_checkpoint: bool = False             # sft_checkpoint.AsyncCheckpointCallback（只存 adapter、背景寫）
+    resume: bool = False                       # output_dir 有 checkpoint 就從最新的續跑
+    metrics_path: Optional[str] = "train_metrics.jsonl"   # 相對於 output_dir；None = 不記錄
+    seed: int = 42
+
+
+@dataclass
+class SFTConfig:
+    model: ModelConfig = field(default_factory=ModelConfig)
+    lora: LoraSettings = field(default_factory=LoraSettings)
+    data: DataConfig = field(default_factory=DataConfig)
+    train: TrainConfig = field(default_factory=TrainConfig)
+
+    def validate(self) -> "SFTConfig":
+        if self.model.quantization not in QUANTIZATION_CHOICES:
+            raise ConfigError(f"model.quantization 只能是 {QUANTIZATION_CHOICES}，收到 {self.model.quantization!r}")
+        if self.model.precision not in PRECISION_CHOICES:
+            raise ConfigError(f"model.precision 只能是 {PRECISION_CHOICES}，收到 {self.model.precision!r}")
+        if self.data.batching not in BATCHING_CHOICES:
+            raise ConfigError(f"data.batching 只能是 {BATCHING_CHOICES}，收到 {self.data.batching!r}")
+        if self.data.mix_stopping_strategy not in MIX_STOPPING_CHOICES:
+            raise ConfigError(
+                f"data.mix_stopping_strategy 只能是 {MIX_STOPPING_CHOICES}，收到 {self.data.mix_stopping_strategy!r}"
+            )
+        if not self.lora.target_modules:
+            raise ConfigError("lora.target_modules 不能是空的")
+        if self.data.streaming:
+            if self.train.max_steps <= 0:
+                raise ConfigError("data.streaming 不知道資料總筆數，要設 train.max_steps > 0")
+            if self.data.mix_sources:
+                raise ConfigError("data.streaming 目前不支援 mix_sources，請用 data_path（可用 glob）")
+            if not self.data.packing and self.data.batching != "none":
+                raise ConfigError("data.streaming 拿不到全部樣本長度，batching 只能是 none（或開 packing）")
+            if self.data.shuffle_buffer < 0:
+                raise ConfigError(f"data.shuffle_buffer 不能是負數（0 = 不打散），收到 {self.data.shuffle_buffer}")
+        return self
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+# ---------------------------------------------------------
+# preset：原本兩支訓練腳本的設定
+# ---------------------------------------------------------
+
+def lora_1b() -> SFTConfig:
+    # train_all_lora.py：單卡 LoRA，CUDA 上 fp16
+    return SFTConfig()
+
+
+def qlora_70b() -> SFTConfig:
+    # train_all_lora2.py：A100/H100 80GB 上 4-bit QLoRA
+    return SFTConfig(
+        model=ModelConfig(
+            model_id="meta-llama/Meta-Llama-3.1-70B-Instruct",
+            quantization="4bit",
+            precision="bf16",
+            gradient_checkpointing=True,
+            device_map="auto",
+        ),
+        lora=LoraSettings(
+            r=64,
+            alpha=128,
+            target_modules=["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"],
+        ),
+        data=DataConfig(max_length=2048, pack_block_size=2048, batching="token_budget"),
+        train=TrainConfig(
+            output_dir="./llama-3.1-70b-lora",
+            per_device_batch_size=2,
+            learning_rate=1e-4,
+            optim="paged_adamw_32bit",
+            logging_steps=5,
+            save_steps=50,
+            async_checkpoint=True,
+            resume=True,
+        ),
+    )
+
+
+PRESETS = {
+    "lora-1b": lora_1b,
+    "qlora-70b": qlora_70b,
+}
+DEFAULT_PRESET = "lora-1b"
+
+
+# ---------------------------------------------------------
+# 讀設定檔 / 覆寫
+# ---------------------------------------------------------
+
+def _update(obj, values: Dict[str, Any], prefix: str = ""):
+    names = {f.name: f for f in fields(obj)}
+    for key, value in values.items():
+        if key not in names:
+            raise ConfigError(f"未知的設定 {prefix}{key}，可用：{', '.join(sorted(names))}")
+        current = getattr(obj, key)
+        if is_dataclass(current):
+            if not isinstance(value, dict):
+                raise ConfigError(f"{prefix}{key} 是一個區段，要給 mapping")
+            _update(current, value, f"{prefix}{key}.")
+        else:
+            setattr(obj, key, copy.deepcopy(value))
+
+
+def read_config_file(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+    except OSError as e:
+        raise ConfigError(f"讀不到設定檔 {path}：{e.strerror or e}")
+    if os.path.splitext(path)[1].lower() in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError(f"讀 {path} 需要 PyYAML（pip install pyyaml），或改用 JSON 設定檔")
+        try:
+            data = yaml.safe_load(text) or {}
+        except yaml.YAMLError as e:
+            raise ConfigError(f"{path} 不是合法的 YAML：{e}")
+    else:
+        try:
+            data = json.loads(text)
+        except ValueError as e:
+            raise ConfigError(f"{path} 不是合法的 JSON：{e}")
+    if not isinstance(data, dict):
+        raise ConfigError(f"{path} 最外層必須是 mapping")
+    return data
+
+
+def parse_value(text: str) -> Any:
+    try:
+        return json.loads(text)
+    except ValueError:
+        lowered = text.strip().lower()
+        if lowered in ("none", "null"):
+            return None
+        if lowered in ("true", "false"):
+            return lowered == "true"
+        return text
+
+
+def parse_overrides(items: List[str]) -> Dict[str, Any]:
+    # ["lora.r=16", "data.packing=true"] → {"lora": {"r": 16}, "data": {"packing": True}}
+    nested: Dict[str, Any] = {}
+    for item in items:
+        key, sep, value = item.partition("=")
+        if not sep or not key.strip():
+            raise ConfigError(f"覆寫格式是 區段.欄位=值，收到 {item!r}")
+        parts = key.strip().split(".")
+        node = nested
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = parse_value(value)
+    return nested
+
+
+def build_config(
+    preset: Optional[str] = None,
+    config_path: Optional[str] = None,
+    overrides: Optional[List[str]] = None,
+) -> SFTConfig:
+    # 優先順序：--set > 設定檔 > preset（參數或設定檔裡的 preset:）> 預設
+    data = read_config_file(config_path) if config_path else {}
+    name = preset or data.pop("preset", None) or DEFAULT_PRESET
+    data.pop("preset", None)
+    if name not in PRESETS:
+        raise ConfigError(f"未知的 preset：{name}，可用：{', '.join(PRESETS)}")
+    cfg = PRESETS[name]()
+    _update(cfg, data)
+    _update(cfg, parse_overrides(overrides or []))
+    return cfg.validate()
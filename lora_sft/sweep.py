@@ -0,0 +1,148 @@
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, Any, List, Optional
+
+from .config import ConfigError, build_config, read_config_file
+
+# =========================================================
+# throughput sweep：同一份基本設定，逐一試 grid 裡的組合，各跑幾步比真實 tokens/s
+# =========================================================
+#
+# grid 檔（YAML / JSON）：設定路徑 → 候選值，全部組合都跑，例：
+#   data.packing: [false, true]
+#   data.batching: [token_budget, none]
+#   model.gradient_checkpointing: [true, false]
+#   train.per_device_batch_size: [1, 2, 4]
+# 每個組合在獨立子行程跑 python -m lora_sft train（OOM 等失敗不影響其他組合，顯存也會完全釋放），
+# 用 sft_metrics 的每步紀錄、去掉前 WARMUP_STEPS 步算穩態吞吐量。跑失敗的組合標成不可行，
+# 跑完但紀錄裡沒有 token 數的組合標成未量到（tokens_per_s 為 None，排在可行組合之後），
+# 其餘依 tokens/s 排序寫進 sweep_results.json；同一份 grid 在每種機器上各跑一次，就能挑出各自最快的設定。
+
+SWEEP_DIR = "sweep_runs"
+SWEEP_STEPS = 20
+WARMUP_STEPS = 3
+METRICS_FILE = "train_metrics.jsonl"
+ERROR_TAIL_LINES = 20
+
+
+def grid_combinations(grid: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    keys = list(grid)
+    for key in keys:
+        if not isinstance(grid[key], list) or not grid[key]:
+            raise ConfigError(f"grid 的 {key} 要是非空的 list")
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+
+def read_metrics(path: str) -> List[Dict[str, Any]]:
+    if not os.path.isfile(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def steady_throughput(records: List[Dict[str, Any]], warmup: int = WARMUP_STEPS) -> Dict[str, Any]:
+    steps = [r for r in records if "step" in r]
+    steady = steps[warmup:] or steps
+    seconds = sum(r["step_s"] for r in steady)
+    real = sum(r.get("real_tokens", 0) for r in steady)
+    tokens = sum(r.get("tokens", 0) for r in steady)
+    gpu = [r["gpu_peak_mb"] for r in steps if "gpu_peak_mb" in r]
+    measured = any("real_tokens" in r for r in steady)
+    return {
+        "steps": len(steps),
+        "measured": measured,
+        "tokens_per_s": (real / seconds if seconds > 0 else 0.0) if measured else None,
+        "step_s": seconds / len(steady) if steady else None,
+        "pad_fraction": 1 - real / tokens if tokens else None,
+        "gpu_peak_mb": max(gpu, default=None),
+    }
+
+
+def run_sweep(
+    grid: Dict[str, List[Any]],
+    preset: Optional[str] = None,
+    config_path: Optional[str] = None,
+    overrides: Optional[List[str]] = None,
+    steps: int = SWEEP_STEPS,
+    out_dir: str = SWEEP_DIR,
+) -> List[Dict[str, Any]]:
+    base = []
+    if preset:
+        base += ["--preset", preset]
+    if config_path:
+        base += ["--config", config_path]
+    for item in overrides or []:
+        base += ["--set", item]
+
+    combos = grid_combinations(grid)
+    trials = []
+    for i, combo in enumerate(combos):
+        run_dir = os.path.join(out_dir, f"trial-{i:03d}")
+        trial = [f"{k}={json.dumps(v)}" for k, v in combo.items()] + [
+            f"train.output_dir={json.dumps(run_dir)}",
+            f"train.max_steps={steps}",
+            f"train.save_steps={steps + 1}",
+            "train.async_checkpoint=false",
+            "train.resume=false",
+            f"train.metrics_path={json.dumps(METRICS_FILE)}",
+        ]
+        # 先把每個組合的設定都檢查一遍，打錯的欄位或值不用等前面的組合跑完才發現
+        build_config(preset, config_path, (overrides or []) + trial)
+        trials.append((combo, run_dir, trial))
+
+    os.makedirs(out_dir, exist_ok=True)
+    results = []
+    for i, (combo, run_dir, trial) in enumerate(trials):
+        cmd = [sys.executable, "-m", "lora_sft", "train"] + base + [arg for item in trial for arg in ("--set", item)]
+
+        print(f"[{i + 1}/{len(trials)}] {combo}")
+        if os.path.exists(os.path.join(run_dir, METRICS_FILE)):
+            os.remove(os.path.join(run_dir, METRICS_FILE))
+        start = time.perf_counter()
+        proc = subprocess.run(cmd, capture_output=True, text=True, encoding="utf-8", errors="replace")
+        result: Dict[str, Any] = {
+            "trial": i,
+            "settings": combo,
+            "ok": proc.returncode == 0,
+            "wall_s": time.perf_counter() - start,
+            "run_dir": run_dir,
+        }
+        if proc.returncode == 0:
+            result.update(steady_throughput(read_metrics(os.path.join(run_dir, METRICS_FILE))))
+            if result["measured"]:
+                print(f"    {result['tokens_per_s']:.0f} tokens/s")
+            else:
+                print("    跑完了，但訓練紀錄裡沒有 token 數，無法比較吞吐量")
+        else:
+            tail = proc.stderr.strip().splitlines()[-ERROR_TAIL_LINES:]
+            result["error"] = "\n".join(tail)
+            print(f"    失敗（exit {proc.returncode}）：{tail[-1] if tail else ''}")
+        results.append(result)
+
+    results.sort(key=lambda r: (not r["ok"], not r.get("measured"), -(r.get("tokens_per_s") or 0.0)))
+    with open(os.path.join(out_dir, "sweep_results.json"), "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+
+def print_results(results: List[Dict[str, Any]]):
+    print("結果（依真實 tokens/s 排序）：")
+    for r in results:
+        if r["ok"] and not r["measured"]:
+            print(f"  {'未量到':>10}           {r['settings']}")
+        elif r["ok"]:
+            gpu = f"，GPU 峰值 {r['gpu_peak_mb']:.0f} MB" if r.get("gpu_peak_mb") else ""
+            print(f"  {r['tokens_per_s']:>10.0f} tokens/s  {r['settings']}{gpu}")
+        else:
+            print(f"  {'不可行':>10}           {r['settings']}")
+    best = next((r for r in results if r["ok"] and r["measured"]), None)
+    if best:
+        print(f"最快可行設定：{best['settings']}")
+
+
+def load_grid(path: str) -> Dict[str, List[Any]]:
+    return read_config_file(path)
@@ -0,0 +1,59 @@
+from dataclasses import dataclass
+from typing import Dict, Any, List
+
+# =========================================================
+# 訓練 / 推論共用的 prompt template
+# =========================================================
+#
+# 不 import torch / transformers：資料工具、token 統計、推論服務都從這裡取 template。
+# template 只寫在 build_texts 一處（訓練時 batched map 整批組），build_text 是單筆版，
+# 推論與訓練的 prompt 不會各改各的；tokenize 快取的 key 也只要看 build_texts。
+
+
+@dataclass
+class SpecialTokens:
+    bos: str = "<s>"
+    eos: str = "</s>"
+    instruction_start: str = "<instruction>\n"
+    instruction_end: str = "\n</instruction>\n"
+    input_start: str = "<input>\n"
+    input_end: str = "\n</input>\n"
+    response_start: str = "<response>\n"
+    response_end: str = "\n</response>"
+
+
+TOKENS = SpecialTokens()
+
+# response 內容從這個字串之後開始（response_only_loss 時，之前的 token labels 設 -100）
+RESPONSE_MARKER = TOKENS.input_end + TOKENS.response_start
+
+
+def build_texts(batch: Dict[str, List[Any]], tokens: SpecialTokens = TOKENS) -> List[str]:
+    # batched map 的欄位 list 直接組出整批 text，不逐筆轉 dict
+    head = tokens.bos + tokens.instruction_start
+    after_instruction = tokens.instruction_end + tokens.input_start
+    after_input = tokens.input_end + tokens.response_start
+    tail = tokens.response_end + tokens.eos
+    n = len(batch["instruction"])
+    inputs = batch.get("input") or [""] * n
+    return [
+        "".join((
+            head,
+            instruction,
+            after_instruction,
+            value if isinstance(value, str) else str(value),
+            after_input,
+            output if isinstance(output, str) else str(output),
+            tail,
+        ))
+        for instruction, value, output in zip(batch["instruction"], inputs, batch["output"])
+    ]
+
+
+def build_text(example: Dict[str, Any]) -> str:
+    batch = {
+        "instruction": [example["instruction"]],
+        "input": [example.get("input", "")],
+        "output": [example["output"]],
+    }
+    return build_texts(batch)[0]
@@ -0,0 +1,284 @@
+import os
+from dataclasses import asdict
+from typing import Dict, Any, List, Optional
+
+import torch
+from datasets import load_dataset
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    BitsAndBytesConfig,
+    DataCollatorForSeq2Seq,
+    TrainingArguments,
+)
+from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
+
+from sft_packing import pack_dataset, packing_efficiency, PackedDataCollator
+from sft_cache import load_tokenized, tokenizer_fingerprint, function_fingerprint
+from sft_tokenize import SFTTokenizeFn, drop_response_lost, require_fast_tokenizer, resolve_num_proc
+from sft_mixing import MixSource, load_mixture
+from sft_sampler import ShuffledBatchSampler, TokenBudgetBatchSampler, padding_ratio, sequential_batches
+from sft_trainer import BatchSamplerTrainer
+from sft_checkpoint import AsyncCheckpointCallback, latest_checkpoint, restore_data_state
+from sft_metrics import TrainMetricsCallback
+from sft_stream import StreamingSFTDataset
+
+from .config import SFTConfig
+from .text import TOKENS, RESPONSE_MARKER, build_texts
+
+# =========================================================
+# 依 SFTConfig 跑 LoRA / QLoRA 訓練（原本 train_all_lora.py 與 train_all_lora2.py 的共同流程）
+# =========================================================
+
+DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def resolve_precision(precision: str, use_cuda: bool) -> str:
+    if precision == "auto":
+        return "fp16" if use_cuda else "fp32"
+    return precision
+
+
+def load_tokenizer(cfg: SFTConfig):
+    # 一定要 Rust 實作的 fast tokenizer，載到 Python 版直接報錯
+    tokenizer = require_fast_tokenizer(AutoTokenizer.from_pretrained(cfg.model.model_id, use_fast=True))
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+def make_tokenize_fn(cfg: SFTConfig, tokenizer) -> SFTTokenizeFn:
+    data = cfg.data
+    return SFTTokenizeFn(
+        tokenizer,
+        max_length=data.max_length,
+        response_marker=RESPONSE_MARKER if data.response_only_loss else None,
+        tokens=TOKENS,
+    )
+
+
+def load_train_dataset(cfg: SFTConfig, tokenizer):
+    data = cfg.data
+    tokenize_fn = make_tokenize_fn(cfg, tokenizer)
+
+    cache_parts = {
+        "model_id": cfg.model.model_id,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "tokens": asdict(TOKENS),
+        "build_text": function_fingerprint(build_texts),
+        "max_length": data.max_length,
+        "response_only_loss": data.response_only_loss,
+        "columns": ["input_ids", "attention_mask", "labels", "length"],
+    }
+
+    def load_path(path):
+        if data.use_token_cache:
+            tokenized = load_tokenized(
+                path,
+                tokenize_fn,
+                cache_parts,
+                map_kwargs={"batched": True, "num_proc": data.tokenize_num_proc},
+            )
+        else:
+            dataset = load_dataset("json", data_files=path)["train"]
+            tokenized = dataset.map(
+                tokenize_fn,
+                batched=True,
+                remove_columns=dataset.column_names,
+                num_proc=resolve_num_proc(data.tokenize_num_proc, len(dataset)),
+            )
+        # 整段都算 loss 時 labels 不會全是 -100，不用多掃一遍
+        if data.response_only_loss:
+            tokenized = drop_response_lost(tokenized, data.max_length, name=path)
+        return tokenized
+
+    # 有設 mix_sources 就直接從各來源依權重混合，不讀 data_path
+    if data.mix_sources:
+        sources = [MixSource(**s) for s in data.mix_sources]
+        return load_mixture(
+            sources,
+            load_path,
+            temperature=data.mix_temperature,
+            seed=cfg.train.seed,
+            stopping_strategy=data.mix_stopping_strategy,
+        )
+    return load_path(data.data_path)
+
+
+def load_streaming_dataset(cfg: SFTConfig, tokenizer):
+    data = cfg.data
+    return StreamingSFTDataset(
+        [data.data_path],
+        make_tokenize_fn(cfg, tokenizer),
+        pack_block_size=data.pack_block_size if data.packing else None,
+        pad_token_id=tokenizer.pad_token_id,
+        buffer_size=data.shuffle_buffer,
+        seed=cfg.train.seed,
+    )
+
+
+def build_batching(cfg: SFTConfig, tokenized, tokenizer, mask_dtype):
+    # 回傳 (dataset, collator, batch_sampler)
+    data, batch_size = cfg.data, cfg.train.per_device_batch_size
+    if data.packing:
+        # 若改用 flash_attention_2，mask_dtype 設 None 即可（直接用 position_ids 切文件）
+        collator = PackedDataCollator(mask_dtype=mask_dtype)
+        if data.streaming:
+            # StreamingSFTDataset 邊讀邊打包，順序由它的 shuffle buffer 打散，不用 batch sampler
+            return tokenized, collator, None
+        tokenized = pack_dataset(tokenized, data.pack_block_size, tokenizer.pad_token_id)
+        print(f"packing: {len(tokenized)} 個 block，填充率 {packing_efficiency(tokenized):.1%}")
+        return tokenized, collator, ShuffledBatchSampler(len(tokenized), batch_size, seed=cfg.train.seed)
+
+    # 動態 padding 到 batch 內最長，labels 補 -100
+    collator = DataCollatorForSeq2Seq(
+        tokenizer,
+        padding=True,
+        label_pad_token_id=-100,
+        pad_to_multiple_of=8,
+    )
+    if data.streaming:
+        return tokenized, collator, None
+    if data.batching == "token_budget":
+        lengths = tokenized["length"]
+        baseline = padding_ratio(lengths, sequential_batches(len(lengths), batch_size))
+        max_tokens = data.max_tokens_per_batch or batch_size * data.max_length
+        sampler = TokenBudgetBatchSampler(lengths, max_tokens, seed=cfg.train.seed)
+        print(
+            f"token budget batching: {len(sampler)} 個 batch，"
+            f"padding 比例 {baseline:.1%} -> {sampler.padding_ratio():.1%}"
+        )
+        return tokenized, collator, sampler
+    if data.batching == "none":
+        # 取代 Trainer 預設的 RandomSampler：順序只由 seed + epoch 決定，續跑時才接得上
+        return tokenized, collator, ShuffledBatchSampler(len(tokenized), batch_size, seed=cfg.train.seed)
+    # "length"：HF 內建 group_by_length
+    return tokenized, collator, None
+
+
+def load_model(cfg: SFTConfig, precision: str, use_cuda: bool):
+    m = cfg.model
+    kwargs: Dict[str, Any] = {}
+    if m.quantization == "4bit":
+        kwargs["quantization_config"] = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=DTYPES[precision],
+            bnb_4bit_use_double_quant=True,
+        )
+    elif m.quantization == "8bit":
+        kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+    else:
+        kwargs["torch_dtype"] = DTYPES[precision]
+    if m.device_map:
+        kwargs["device_map"] = m.device_map
+    if m.attn_implementation:
+        kwargs["attn_implementation"] = m.attn_implementation
+
+    print(f"Loading model: {m.model_id}...")
+    model = AutoModelForCausalLM.from_pretrained(m.model_id, **kwargs)
+
+    if m.gradient_checkpointing:
+        model.gradient_checkpointing_enable()
+    if m.quantization:
+        model = prepare_model_for_kbit_training(model, use_gradient_checkpointing=m.gradient_checkpointing)
+
+    lora = cfg.lora
+    model = get_peft_model(model, LoraConfig(
+        r=lora.r,
+        lora_alpha=lora.alpha,
+        target_modules=list(lora.target_modules),
+        lora_dropout=lora.dropout,
+        bias="none",
+        task_type="CAUSAL_LM",
+    ))
+    model.print_trainable_parameters()
+    if use_cuda and not m.device_map and not m.quantization:
+        model.to("cuda")
+    return model
+
+
+def train(cfg: SFTConfig):
+    cfg.validate()
+    t = cfg.train
+    use_cuda = torch.cuda.is_available()
+    print("use_cuda:", use_cuda, "device_count:", torch.cuda.device_count())
+    precision = resolve_precision(cfg.model.precision, use_cuda)
+
+    tokenizer = load_tokenizer(cfg)
+    if cfg.data.streaming:
+        tokenized = load_streaming_dataset(cfg, tokenizer)
+    else:
+        tokenized = load_train_dataset(cfg, tokenizer)
+
+    # prepare_model_for_kbit_training 會把 embedding 轉成 fp32，量化時 packing 的 mask 跟著用 fp32
+    mask_dtype = torch.float32 if cfg.model.quantization else DTYPES[precision]
+    tokenized, data_collator, batch_sampler = build_batching(cfg, tokenized, tokenizer, mask_dtype)
+
+    model = load_model(cfg, precision, use_cuda)
+
+    args = TrainingArguments(
+        output_dir=t.output_dir,
+        per_device_train_batch_size=t.per_device_batch_size,
+        group_by_length=(not cfg.data.packing and cfg.data.batching == "length"),
+        length_column_name="length",
+        gradient_accumulation_steps=t.gradient_accumulation_steps,
+        learning_rate=t.learning_rate,
+        num_train_epochs=t.num_train_epochs,
+        max_steps=t.max_steps,
+        fp16=(precision == "fp16" and use_cuda),
+        bf16=(precision == "bf16"),
+        optim=t.optim,
+        dataloader_pin_memory=use_cuda,
+        dataloader_num_workers=cfg.data.stream_workers if cfg.data.streaming else 0,
+        logging_steps=t.logging_steps,
+        save_strategy="no" if t.async_checkpoint else "steps",
+        save_steps=t.save_steps,
+        save_total_limit=t.save_total_limit,
+        seed=t.seed,
+        report_to="none",
+        ddp_find_unused_parameters=False,
+    )
+
+    callbacks: List[Any] = []
+    checkpointer: Optional[AsyncCheckpointCallback] = None
+    metrics: Optional[TrainMetricsCallback] = None
+    if t.async_checkpoint:
+        checkpointer = AsyncCheckpointCallback(t.output_dir, t.save_steps, t.save_total_limit, batch_sampler)
+        callbacks.append(checkpointer)
+    if t.metrics_path:
+        # 排在 checkpointer 前面，checkpoint 擋住訓練的時間才算得對
+        metrics = TrainMetricsCallback(os.path.join(t.output_dir, t.metrics_path), checkpointer)
+        callbacks.insert(0, metrics)
+
+    trainer = BatchSamplerTrainer(
+        model=model,
+        args=args,
+        train_dataset=tokenized,
+        data_collator=data_collator,
+        batch_sampler=batch_sampler,
+        callbacks=callbacks,
+    )
+    if metrics is not None:
+        metrics.watch_trainer(trainer)
+
+    resume_from = latest_checkpoint(t.output_dir) if t.resume else None
+    if resume_from is not None:
+        # batch 組成和存檔時不同就直接報錯，不要默默從錯的資料位置接下去
+        restore_data_state(resume_from, batch_sampler)
+        print(f"Resuming from {resume_from}...")
+
+    print("Start training...")
+    trainer.train(resume_from_checkpoint=resume_from)
+
+    # 先存最終 adapter，再印統計：印統計出錯也不會丟掉訓練結果
+    print(f"Saving model to {t.output_dir}...")
+    model.save_pretrained(t.output_dir)
+    tokenizer.save_pretrained(t.output_dir)
+    if checkpointer is not None:
+        print(
+            f"checkpoint：訓練 thread 被擋住共 {checkpointer.stall_seconds:.2f}s，"
+            f"背景寫入共 {checkpointer.write_seconds:.2f}s"
+        )
+    print("Training finished.")
+    return trainer
@@ -0,0 +1,74 @@
+import json
+from typing import Dict, Any, List
+
+# =========================================================
+# SFT JSONL 檢查：不載 tokenizer / 模型，只看每一行的格式
+# =========================================================
+#
+# 每一行要是 JSON object，有 instruction / input / output 三個字串欄位，
+# instruction 與 output 不能是空字串；CHECK_OUTPUT_JSON 時 output 還要能 json.loads
+# （三種 SFT 資料的 output 都是 JSON，壞掉的樣本會讓模型學到壞掉的格式）。
+# 檔案用 binary 逐行讀、每行自己 decode：不是合法 UTF-8 的行記成 invalid_utf8，不會讓整個檔案檢查中斷。
+
+REQUIRED_KEYS = ("instruction", "input", "output")
+CHECK_OUTPUT_JSON = True
+MAX_EXAMPLES = 5            # 每種錯誤最多列出幾個行號
+
+ERROR_KINDS = ("invalid_utf8", "invalid_json", "missing_keys", "non_string", "empty", "output_not_json")
+
+
+def check_row(line: str, check_output_json: bool = CHECK_OUTPUT_JSON) -> str:
+    # 回傳錯誤種類，沒問題回傳空字串
+    try:
+        obj = json.loads(line)
+    except ValueError:
+        return "invalid_json"
+    if not isinstance(obj, dict) or not all(k in obj for k in REQUIRED_KEYS):
+        return "missing_keys"
+    if not all(isinstance(obj[k], str) for k in REQUIRED_KEYS):
+        return "non_string"
+    if not obj["instruction"].strip() or not obj["output"].strip():
+        return "empty"
+    if check_output_json:
+        try:
+            json.loads(obj["output"])
+        except ValueError:
+            return "output_not_json"
+    return ""
+
+
+def validate_file(path: str, check_output_json: bool = CHECK_OUTPUT_JSON) -> Dict[str, Any]:
+    counts = {kind: 0 for kind in ERROR_KINDS}
+    examples: Dict[str, List[int]] = {kind: [] for kind in ERROR_KINDS}
+    rows = 0
+    with open(path, "rb") as f:
+        for lineno, raw in enumerate(f, 1):
+            if not raw.strip():
+                continue
+            rows += 1
+            try:
+                line = raw.decode("utf-8")
+            except UnicodeDecodeError:
+                kind = "invalid_utf8"
+            else:
+                kind = check_row(line, check_output_json)
+            if kind:
+                counts[kind] += 1
+                if len(examples[kind]) < MAX_EXAMPLES:
+                    examples[kind].append(lineno)
+    return {
+        "path": path,
+        "rows": rows,
+        "errors": sum(counts.values()),
+        "counts": {k: v for k, v in counts.items() if v},
+        "examples": {k: v for k, v in examples.items() if v},
+    }
+
+
+def print_report(report: Dict[str, Any]):
+    status = "OK" if not report["errors"] else f"{report['errors']} 筆有問題"
+    print(f"{report['path']}：{report['rows']} 筆，{status}")
+    for kind, n in report["counts"].items():
+        shown = report["examples"][kind]
+        more = "…" if n > len(shown) else ""
+        print(f"  {kind}: {n} 筆（第 {', '.join(str(i) for i in shown)}{more} 行）")
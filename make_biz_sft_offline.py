@@ -2,8 +2,18 @@ import json
 import random
 from typing import Dict, Any, List
 
+from sft_runner import run_sharded, describe_output
+
 OUT_PATH = "biz_sft.jsonl"
 N_EXAMPLES = 40  # 想多一點就改大
+NUM_SHARDS = 1      # >1 時輸出 biz_sft-00000-of-000NN.jsonl 等分片
+NUM_WORKERS = None  # None = 用全部 CPU 核心
+SEED = 1234
+
+INSTRUCTION = (
+    "你是一位連鎖餐飲商業顧問，請根據指定行政區的匯總訂單數據與外部市場訊號，"
+    "輸出市場飽和評估與菜單優化建議（JSON 格式）。"
+)
 
 
 DISTRICTS = [
@@ -186,34 +196,36 @@ def build_output(region: str, internal: Dict[str, Any], external: Dict[str, Any]
     }
 
 
+def make_row() -> Dict[str, Any]:
+    region = random.choice(DISTRICTS)
+    internal = random_internal_orders()
+    external = random_external_signals()
+    out_json = build_output(region, internal, external)
+
+    return {
+        "instruction": INSTRUCTION,
+        "input": json.dumps(
+            {
+                "region": region,
+                "internal_order_stats": internal,
+                "external_market_signals": external,
+            },
+            ensure_ascii=False,
+        ),
+        "output": json.dumps(out_json, ensure_ascii=False),
+    }
+
+
 def main():
-    instruction = (
-        "你是一位連鎖餐飲商業顧問，請根據指定行政區的匯總訂單數據與外部市場訊號，"
-        "輸出市場飽和評估與菜單優化建議（JSON 格式）。"
+    stats = run_sharded(
+        make_row,
+        N_EXAMPLES,
+        OUT_PATH,
+        num_shards=NUM_SHARDS,
+        num_workers=NUM_WORKERS,
+        seed=SEED,
     )
-
-    with open(OUT_PATH, "w", encoding="utf-8") as f:
-        for _ in range(N_EXAMPLES):
-            region = random.choice(DISTRICTS)
-            internal = random_internal_orders()
-            external = random_external_signals()
-            out_json = build_output(region, internal, external)
-
-            row = {
-                "instruction": instruction,
-                "input": json.dumps(
-                    {
-                        "region": region,
-                        "internal_order_stats": internal,
-                        "external_market_signals": external,
-                    },
-                    ensure_ascii=False,
-                ),
-                "output": json.dumps(out_json, ensure_ascii=False),
-            }
-            f.write(json.dumps(row, ensure_ascii=False) + "\n")
-
-    print(f"已產生 {N_EXAMPLES} 筆商業顧問 SFT 資料到 {OUT_PATH}")
+    print(f"已產生 {stats['rows']} 筆商業顧問 SFT 資料到 {describe_output(stats)}")
 
 
 if __name__ == "__main__":
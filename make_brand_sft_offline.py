@@ -2,8 +2,18 @@ import json
 import random
 from typing import Dict, Any, List
 
+from sft_runner import run_sharded, describe_output
+
 OUT_PATH = "brand_sft.jsonl"
 N_EXAMPLES = 40
+NUM_SHARDS = 1      # >1 時輸出 brand_sft-00000-of-000NN.jsonl 等分片
+NUM_WORKERS = None  # None = 用全部 CPU 核心
+SEED = 1234
+
+INSTRUCTION = (
+    "你是一位餐飲品牌顧問，請根據使用者的開店想法，"
+    "輸出品牌設定與推薦菜單（JSON 格式）。"
+)
 
 
 BRAND_IDEAS = [
@@ -139,25 +149,27 @@ def build_brand_from_idea(idea: str) -> Dict[str, Any]:
     }
 
 
-def main():
-    instruction = (
-        "你是一位餐飲品牌顧問，請根據使用者的開店想法，"
-        "輸出品牌設定與推薦菜單（JSON 格式）。"
-    )
+def make_row() -> Dict[str, Any]:
+    idea = random.choice(BRAND_IDEAS)
+    out_json = build_brand_from_idea(idea)
 
-    with open(OUT_PATH, "w", encoding="utf-8") as f:
-        for _ in range(N_EXAMPLES):
-            idea = random.choice(BRAND_IDEAS)
-            out_json = build_brand_from_idea(idea)
+    return {
+        "instruction": INSTRUCTION,
+        "input": json.dumps({"idea_zh": idea}, ensure_ascii=False),
+        "output": json.dumps(out_json, ensure_ascii=False),
+    }
 
-            row = {
-                "instruction": instruction,
-                "input": json.dumps({"idea_zh": idea}, ensure_ascii=False),
-                "output": json.dumps(out_json, ensure_ascii=False),
-            }
-            f.write(json.dumps(row, ensure_ascii=False) + "\n")
 
-    print(f"已產生 {N_EXAMPLES} 筆品牌孵化 SFT 資料到 {OUT_PATH}")
+def main():
+    stats = run_sharded(
+        make_row,
+        N_EXAMPLES,
+        OUT_PATH,
+        num_shards=NUM_SHARDS,
+        num_workers=NUM_WORKERS,
+        seed=SEED,
+    )
+    print(f"已產生 {stats['rows']} 筆品牌孵化 SFT 資料到 {describe_output(stats)}")
 
 
 if __name__ == "__main__":
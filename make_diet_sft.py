@@ -1,20 +1,32 @@
 import json
 import random
-from typing import Dict, Any, List
+from typing import Dict, Any, Optional
+
+import numpy as np
+
+from diet_codec import GOAL_ZH, assemble_plan, compact_plan
+from food_db import DishTable, load_or_build
+from meal_planner import MealPlanner
+from sft_runner import run_sharded, describe_output
 
 
 N_EXAMPLES = 50          # 要產生幾筆訓練樣本
 OUT_PATH = "diet_sft.jsonl"
 DATA_PATH = "nutrition_dataset.json"
+DB_DIR = "nutrition_dataset.dishdb"   # 欄位式二進位格式，由 DATA_PATH 自動建立，之後 mmap 讀取
+NUM_SHARDS = 1           # >1 時輸出 diet_sft-00000-of-000NN.jsonl 等分片
+NUM_WORKERS = None       # None = 用全部 CPU 核心
+SEED = 1234              # 同樣的 SEED / NUM_SHARDS 會產生同樣的資料
+# True：output 用精簡格式 {"w": [[dish_id, ...], ...]}（每天吃哪幾道菜），
+# 其餘欄位推論時由 diet_codec.DietExpander 依 input 與菜色資料表還原；詳見 diet_codec.py
+COMPACT_OUTPUT = False
 
+ALLERGENS = ["egg", "milk", "soy", "nuts", "gluten"]
+MAX_PROFILE_TRIES = 20   # 菜色資料表裡排不出符合限制的菜單時，重抽使用者的次數上限
 
-def load_food_db(path: str):
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    restaurants = data["restaurants"]
-    dishes = data["dishes"]
-    rest_by_id = {r["restaurant_id"]: r for r in restaurants}
-    return restaurants, dishes, rest_by_id
+
+def load_food_db(path: str = DATA_PATH, db_dir: str = DB_DIR) -> DishTable:
+    return load_or_build(path, db_dir)
 
 
 def random_user_profile() -> Dict[str, Any]:
@@ -23,6 +35,9 @@ def random_user_profile() -> Dict[str, Any]:
     weight = random.randint(50, 95)
     age = random.randint(18, 40)
     activity = random.choice(["sedentary", "lightly_active", "active"])
+    # 飲食限制：約 15% 吃素，部分使用者有 1～2 種過敏原
+    vegetarian = random.random() < 0.15
+    allergens = random.sample(ALLERGENS, k=random.choice([0, 0, 0, 1, 2]))
 
     return {
         "height_cm": height,
@@ -30,16 +45,14 @@ def random_user_profile() -> Dict[str, Any]:
         "age": age,
         "gender": gender,
         "activity_level": activity,
+        "vegetarian": vegetarian,
+        "allergens": allergens,
     }
 
 
 def random_goal() -> Dict[str, str]:
     # 內部用英文，instruction 用中文
-    choices = [
-        ("減脂", "fat_loss"),
-        ("增肌", "muscle_gain"),
-        ("健康均衡", "general_health"),
-    ]
+    choices = [(zh, internal) for internal, zh in GOAL_ZH.items()]
     return random.choice(choices)
 
 
@@ -57,81 +70,32 @@ def estimate_daily_calories(user: Dict[str, Any], goal_internal: str) -> int:
     return base
 
 
-def pick_candidate_dishes(dishes: List[Dict[str, Any]], goal_internal: str) -> List[Dict[str, Any]]:
-    if goal_internal == "fat_loss":
-        cands = [
-            d for d in dishes
-            if d["calories_kcal"] <= 650 and "減脂友善" in d.get("tags", [])
-        ]
-        return cands or dishes
-    elif goal_internal == "muscle_gain":
-        cands = [
-            d for d in dishes
-            if d["protein_g"] >= 25
-        ]
-        return cands or dishes
-    else:
-        return dishes
+def estimate_daily_protein(user: Dict[str, Any], goal_internal: str) -> int:
+    # 每公斤體重的蛋白質克數：增肌 1.6、減脂 1.2、一般 1.0
+    per_kg = {"muscle_gain": 1.6, "fat_loss": 1.2}.get(goal_internal, 1.0)
+    return int(user["weight_kg"] * per_kg)
 
 
 def build_fake_week_plan(
     user_profile: Dict[str, Any],
     goal_zh: str,
     goal_internal: str,
-    dishes: List[Dict[str, Any]],
+    planner: MealPlanner,
 ) -> Dict[str, Any]:
     target = estimate_daily_calories(user_profile, goal_internal)
-    candidates = pick_candidate_dishes(dishes, goal_internal)
-    if len(candidates) < 30:
-        candidates = dishes
-
-    weekly_menu = []
-
-    for day in range(1, 8):
-        day_meals = []
-        total_cal = 0
-
-        # 每天 2～3 餐
-        n_meals = random.choice([2, 3])
-        meal_types = ["breakfast", "lunch", "dinner"]
-        chosen_meal_types = meal_types[:n_meals]
-
-        for mt in chosen_meal_types:
-            dish = random.choice(candidates)
-            total_cal += dish["calories_kcal"]
-            note_parts = []
-
-            if "高蛋白" in dish.get("tags", []):
-                note_parts.append("高蛋白")
-            if "減脂友善" in dish.get("tags", []):
-                note_parts.append("減脂友善")
-            if dish.get("carbon_footprint_label") == "low":
-                note_parts.append("低碳足跡")
-
-            if not note_parts:
-                note_parts.append("一般建議")
-
-            day_meals.append({
-                "meal_type": mt,
-                "dish_id": dish["dish_id"],
-                "restaurant_id": dish["restaurant_id"],
-                "note": "、".join(note_parts),
-            })
-
-        weekly_menu.append({
-            "day": day,
-            "total_calories": total_cal,
-            "meals": day_meals,
-        })
-
-    result = {
-        "goal": goal_internal,
-        "user_profile": user_profile,
-        "daily_calorie_target": target,
-        "weekly_menu": weekly_menu,
-        "note": f"此菜單為自動產生，用於訓練示範（目標：{goal_zh}）",
-    }
-    return result
+    protein_target = estimate_daily_protein(user_profile, goal_internal)
+    candidates, max_cal = planner.allowed(
+        goal_internal,
+        user_profile.get("allergens", []),
+        user_profile.get("vegetarian", False),
+    )
+    # numpy 的亂數由 global random 衍生，分片 seed 相同就能重現
+    rng = np.random.default_rng(random.getrandbits(64))
+
+    # 每天 2～3 餐；兩餐吃不到目標熱量就排三餐
+    meal_counts = [planner.meals_needed(random.choice([2, 3]), max_cal, target) for _ in range(7)]
+    week = planner.plan_week(rng, candidates, meal_counts, target, protein_target)
+    return assemble_plan(user_profile, goal_zh, goal_internal, target, protein_target, planner, week)
 
 
 def build_instruction(goal_zh: str) -> str:
@@ -143,38 +107,67 @@ def build_instruction(goal_zh: str) -> str:
         return "你是一位飲食管家，依照使用者需求設計一週健康均衡外食菜單，輸出 JSON。"
 
 
+# 每個 worker 行程各自 mmap 一次菜色資料表
+_PLANNER: Optional[MealPlanner] = None
+
+
+def init_worker(db_dir: str = DB_DIR):
+    global _PLANNER
+    _PLANNER = MealPlanner(DishTable.load(db_dir))
+
+
+def sample_user_profile(planner: MealPlanner) -> Dict[str, Any]:
+    # 過敏原 / 素食限制下沒有任何菜可選的使用者直接重抽，不產生違反限制的菜單
+    for _ in range(MAX_PROFILE_TRIES):
+        user_profile = random_user_profile()
+        if planner.has_candidates(user_profile["allergens"], user_profile["vegetarian"]):
+            return user_profile
+    raise ValueError(f"連續 {MAX_PROFILE_TRIES} 個使用者都排不出符合限制的菜單，請檢查菜色資料表")
+
+
+def make_row() -> Dict[str, Any]:
+    user_profile = sample_user_profile(_PLANNER)
+    goal_zh, goal_internal = random_goal()
+
+    # 建 input：主要放目標 + 使用者資料；必要時也可以加部分菜色資訊
+    input_obj = {
+        "goal": goal_internal,
+        "user_profile": user_profile,
+        # 想要也可以加食物樣本，但這裡先不塞，避免 prompt 太長
+        # "food_db_sample": random.sample(dishes, k=min(40, len(dishes))),
+    }
+
+    output_obj = build_fake_week_plan(
+        user_profile=user_profile,
+        goal_zh=goal_zh,
+        goal_internal=goal_internal,
+        planner=_PLANNER,
+    )
+    if COMPACT_OUTPUT:
+        output_obj = compact_plan(output_obj)
+
+    return {
+        "instruction": build_instruction(goal_zh),
+        "input": json.dumps(input_obj, ensure_ascii=False),
+        "output": json.dumps(output_obj, ensure_ascii=False),
+    }
+
+
 def main():
-    restaurants, dishes, rest_by_id = load_food_db(DATA_PATH)
-
-    with open(OUT_PATH, "w", encoding="utf-8") as f:
-        for _ in range(N_EXAMPLES):
-            user_profile = random_user_profile()
-            goal_zh, goal_internal = random_goal()
-
-            # 建 input：主要放目標 + 使用者資料；必要時也可以加部分菜色資訊
-            input_obj = {
-                "goal": goal_internal,
-                "user_profile": user_profile,
-                # 想要也可以加食物樣本，但這裡先不塞，避免 prompt 太長
-                # "food_db_sample": random.sample(dishes, k=min(40, len(dishes))),
-            }
-
-            output_obj = build_fake_week_plan(
-                user_profile=user_profile,
-                goal_zh=goal_zh,
-                goal_internal=goal_internal,
-                dishes=dishes,
-            )
-
-            row = {
-                "instruction": build_instruction(goal_zh),
-                "input": json.dumps(input_obj, ensure_ascii=False),
-                "output": json.dumps(output_obj, ensure_ascii=False),
-            }
-
-            f.write(json.dumps(row, ensure_ascii=False) + "\n")
-
-    print(f"已產生 {N_EXAMPLES} 筆訓練資料到 {OUT_PATH}")
+    # 先在主行程建好（或更新）二進位資料表，worker 只負責讀
+    load_food_db(DATA_PATH, DB_DIR)
+
+    stats = run_sharded(
+        make_row,
+        N_EXAMPLES,
+        OUT_PATH,
+        num_shards=NUM_SHARDS,
+        num_workers=NUM_WORKERS,
+        seed=SEED,
+        initializer=init_worker,
+        initargs=(DB_DIR,),
+    )
+    print(f"已產生 {stats['rows']} 筆訓練資料到 {describe_output(stats)}")
 
 
 if __name__ == "__main__":
@@ -1,5 +1,11 @@
 import json
-import random
+import os
+import time
+from typing import Dict, Any, List, Optional
+
+import numpy as np
+
+from food_db import DishTableWriter, NUMERIC_COLUMNS
 
 AREAS = [
     "台北市大安區", "台北市信義區", "新北市板橋區", "新北市中和區",
@@ -57,147 +63,323 @@ HEALTH_PREFIX = ["低脂", "高蛋白", "減糖", "原型食物", "輕盈"]
 VEG_MARK = ["全素", "蛋奶素", "蔬食"]
 
 
-def random_restaurants(n_rest=50):
-    restaurants = []
-    for rid in range(1, n_rest + 1):
-        prefix = random.choice(["陽光", "元氣", "小巷", "初晨", "良食", "森活", "便當研究所", "深夜"])
-        suffix = random.choice(["食堂", "廚房", "便當", "餐盒", "輕食", "沙拉吧", "咖啡館"])
-        name = prefix + suffix
-
-        restaurants.append({
-            "restaurant_id": rid,
-            "name": name,
-            "area": random.choice(AREAS),
-            "cuisine_type": random.choice(CUISINES),
-            "avg_price": random.randint(120, 260),
-            "tags": random.sample(
-                ["健康", "高蛋白", "低醣", "少油", "素食友善", "外帶方便", "環保餐具"],
-                k=random.randint(2, 4)
-            ),
-            "has_delivery": random.choice([True, False]),
-            "has_b2b_service": random.choice([True, False])
-        })
-    return restaurants
-
-
-def carbon_footprint_for_protein(protein_type: str) -> float:
-    low, high = PROTEIN_TYPES.get(protein_type, PROTEIN_TYPES["mixed"])
-    return round(random.uniform(low, high), 2)
-
-
-def carbon_label(value: float) -> str:
-    if value < 0.8:
-        return "low"
-    elif value < 1.6:
-        return "medium"
-    else:
-        return "high"
-
-
-def gen_macros(calories: int, category: str):
-    if category == "drink":
-        protein = random.randint(2, 8)
-        fat = random.randint(0, 5)
-    elif category == "side":
-        protein = random.randint(4, 15)
-        fat = random.randint(2, 10)
-    else:  # main
-        protein = random.randint(18, 45)
-        fat = random.randint(8, 22)
+RESTAURANT_PREFIX = ["陽光", "元氣", "小巷", "初晨", "良食", "森活", "便當研究所", "深夜"]
+RESTAURANT_SUFFIX = ["食堂", "廚房", "便當", "餐盒", "輕食", "沙拉吧", "咖啡館"]
+RESTAURANT_TAGS = ["健康", "高蛋白", "低醣", "少油", "素食友善", "外帶方便", "環保餐具"]
 
-    remaining = max(calories - (protein * 4 + fat * 9), 40)
-    carbs = max(0, int(remaining / 4))
-    return protein, carbs, fat
+# tags / allergens 以 bitmask 產生，bit 順序就是輸出 list 的順序
+DISH_TAGS = ["高蛋白", "低醣", "減脂友善", "低碳足跡", "辣"]
+ALLERGENS = ["egg", "milk", "soy", "nuts", "gluten"]
+CATEGORIES = ["main", "side", "drink"]
+CARBON_LABELS = ["low", "medium", "high"]
 
+# 各類別的 (熱量, 蛋白質, 脂肪) 範圍，皆為閉區間
+CATEGORY_RANGES = {
+    "main":  ((380, 850), (18, 45), (8, 22)),
+    "side":  ((120, 350), (4, 15), (2, 10)),
+    "drink": ((0, 180), (2, 8), (0, 5)),
+}
 
-def gen_dishes(restaurants, n_dishes=300):
-    dishes = []
-    dish_id = 1
+# =========================================================
+# 大量產生設定
+# =========================================================
+
+SEED = 1234
+N_RESTAURANTS = 50
+N_DISHES = 300
+OUT_PATH = "nutrition_dataset.json"
+
+# None：原本的單一 JSON（給 make_diet_sft.py 用）
+# "jsonl" / "parquet"：分片串流輸出 restaurants + dishes-00000-of-000NN，適合百萬筆以上
+BULK_FORMAT = None
+BULK_OUT_DIR = "nutrition_bulk"
+BULK_CHUNK = 200_000         # 每個 dish shard 的筆數（也是每批產生的筆數）
+BULK_DB_DIR = "nutrition_dataset.dishdb"   # 同時輸出 make_diet_sft.py 直接 mmap 的資料表；None 不輸出
+
+
+def _sample_masks(rng: np.random.Generator, n: int, n_choices: int, k_low: int, k_high: int) -> np.ndarray:
+    # 每列從 n_choices 個選項中不重複抽 k 個（k 在 [k_low, k_high]），回傳 (n, n_choices) 的布林矩陣
+    k = rng.integers(k_low, k_high + 1, n)
+    rank = rng.random((n, n_choices)).argsort(axis=1).argsort(axis=1)
+    return rank < k[:, None]
+
+
+def _bits(mask: np.ndarray) -> np.ndarray:
+    weights = (np.uint64(1) << np.arange(mask.shape[1], dtype=np.uint64))
+    return (mask.astype(np.uint64) * weights).sum(axis=1, dtype=np.uint64)
+
+
+def _mask_lists(mask: np.ndarray, names: List[str]) -> List[List[str]]:
+    return [[names[j] for j in np.flatnonzero(row)] for row in mask]
+
+
+def random_restaurants(rng: np.random.Generator, n_rest: int = N_RESTAURANTS) -> Dict[str, np.ndarray]:
+    names = np.char.add(
+        np.array(RESTAURANT_PREFIX)[rng.integers(0, len(RESTAURANT_PREFIX), n_rest)],
+        np.array(RESTAURANT_SUFFIX)[rng.integers(0, len(RESTAURANT_SUFFIX), n_rest)],
+    )
+    return {
+        "restaurant_id": np.arange(1, n_rest + 1),
+        "name": names,
+        "area": rng.integers(0, len(AREAS), n_rest),
+        "cuisine_type": rng.integers(0, len(CUISINES), n_rest),
+        "avg_price": rng.integers(120, 261, n_rest),
+        "tags": _sample_masks(rng, n_rest, len(RESTAURANT_TAGS), 2, 4),
+        "has_delivery": rng.random(n_rest) < 0.5,
+        "has_b2b_service": rng.random(n_rest) < 0.5,
+    }
 
-    while dish_id <= n_dishes:
-        rest = random.choice(restaurants)
-        base_name, protein_type, category = random.choice(DISH_TEMPLATES)
 
-        name_parts = []
+def restaurant_records(rest: Dict[str, np.ndarray]) -> List[Dict[str, Any]]:
+    tags = _mask_lists(rest["tags"], RESTAURANT_TAGS)
+    return [
+        {
+            "restaurant_id": rid,
+            "name": name,
+            "area": AREAS[area],
+            "cuisine_type": CUISINES[cuisine],
+            "avg_price": price,
+            "tags": tag_list,
+            "has_delivery": delivery,
+            "has_b2b_service": b2b,
+        }
+        for rid, name, area, cuisine, price, tag_list, delivery, b2b in zip(
+            rest["restaurant_id"].tolist(),
+            rest["name"].tolist(),
+            rest["area"].tolist(),
+            rest["cuisine_type"].tolist(),
+            rest["avg_price"].tolist(),
+            tags,
+            rest["has_delivery"].tolist(),
+            rest["has_b2b_service"].tolist(),
+        )
+    ]
+
+
+def carbon_label(value: np.ndarray) -> np.ndarray:
+    # 0 = low (< 0.8)、1 = medium (< 1.6)、2 = high
+    return np.digitize(value, [0.8, 1.6])
+
+
+def gen_dishes(
+    rng: np.random.Generator,
+    restaurants: Dict[str, np.ndarray],
+    n_dishes: int = N_DISHES,
+    start_id: int = 1,
+) -> Dict[str, np.ndarray]:
+    # 一次產生 n_dishes 道菜，全部是 array；規則和原本逐筆產生的版本相同
+    protein_types = list(PROTEIN_TYPES)
+    tmpl_name = np.array([t[0] for t in DISH_TEMPLATES])
+    tmpl_protein = np.array([protein_types.index(t[1]) for t in DISH_TEMPLATES])
+    tmpl_category = np.array([CATEGORIES.index(t[2]) for t in DISH_TEMPLATES])
+    veg_types = np.array([p in ("veg", "tofu", "egg") for p in protein_types])
+    vegan_types = np.array([p in ("veg", "tofu") for p in protein_types])
+    cf_low = np.array([PROTEIN_TYPES[p][0] for p in protein_types])
+    cf_high = np.array([PROTEIN_TYPES[p][1] for p in protein_types])
+
+    rest_idx = rng.integers(0, len(restaurants["restaurant_id"]), n_dishes)
+    tmpl = rng.integers(0, len(DISH_TEMPLATES), n_dishes)
+    protein_type = tmpl_protein[tmpl]
+    category = tmpl_category[tmpl]
+    is_veg = veg_types[protein_type]
+
+    # 菜名：[健康前綴][素食標示][辣度] + 基本菜名
+    health = np.where(
+        rng.random(n_dishes) < 0.4,
+        np.array(HEALTH_PREFIX)[rng.integers(0, len(HEALTH_PREFIX), n_dishes)],
+        "",
+    )
+    veg_mark = np.where(
+        is_veg & (rng.random(n_dishes) < 0.4),
+        np.array(VEG_MARK)[rng.integers(0, len(VEG_MARK), n_dishes)],
+        "",
+    )
+    spicy = rng.random(n_dishes) < 0.25
+    spicy_word = np.where(spicy, np.array(SPICY_WORDS)[rng.integers(0, len(SPICY_WORDS), n_dishes)], "")
+    names = np.char.add(np.char.add(np.char.add(health, veg_mark), spicy_word), tmpl_name[tmpl])
+
+    ranges = np.array([CATEGORY_RANGES[c] for c in CATEGORIES])    # (類別, 3, 2)
+    lo, hi = ranges[category, :, 0], ranges[category, :, 1]
+    values = rng.integers(lo, hi + 1)
+    calories, protein, fat = values[:, 0], values[:, 1], values[:, 2]
+    carbs = np.maximum(calories - (protein * 4 + fat * 9), 40) // 4
+
+    cf = np.round(rng.uniform(cf_low[protein_type], cf_high[protein_type]), 2)
+    cf_label = carbon_label(cf)
+
+    is_main = category == CATEGORIES.index("main")
+    tag_mask = np.stack(
+        [
+            protein >= 25,
+            (carbs <= 40) & is_main,
+            (calories <= 550) & is_main,
+            cf_label == 0,
+            spicy,
+        ],
+        axis=1,
+    )
+
+    return {
+        "dish_id": np.arange(start_id, start_id + n_dishes),
+        "restaurant_id": restaurants["restaurant_id"][rest_idx],
+        "name": names,
+        "category": category,
+        "cuisine_type": restaurants["cuisine_type"][rest_idx],
+        "calories_kcal": calories,
+        "protein_g": protein,
+        "carbs_g": carbs,
+        "fat_g": fat,
+        "carbon_footprint_kg_co2e": cf,
+        "carbon_footprint_label": cf_label,
+        "is_spicy": spicy,
+        "is_vegetarian": is_veg,
+        "is_vegan": vegan_types[protein_type],
+        "tags": tag_mask,
+        "allergens": _sample_masks(rng, n_dishes, len(ALLERGENS), 0, 2),
+    }
 
-        if random.random() < 0.4:
-            name_parts.append(random.choice(HEALTH_PREFIX))
 
-        if protein_type in ("veg", "tofu", "egg") and random.random() < 0.4:
-            name_parts.append(random.choice(VEG_MARK))
+def dish_records(batch: Dict[str, np.ndarray]) -> List[Dict[str, Any]]:
+    cols = {k: v.tolist() for k, v in batch.items() if k not in ("tags", "allergens")}
+    tags = _mask_lists(batch["tags"], DISH_TAGS)
+    allergens = _mask_lists(batch["allergens"], ALLERGENS)
+    records = []
+    for i in range(len(cols["dish_id"])):
+        records.append({
+            "dish_id": cols["dish_id"][i],
+            "restaurant_id": cols["restaurant_id"][i],
+            "name": cols["name"][i],
+            "category": CATEGORIES[cols["category"][i]],
+            "cuisine_type": CUISINES[cols["cuisine_type"][i]],
+            "calories_kcal": cols["calories_kcal"][i],
+            "protein_g": cols["protein_g"][i],
+            "carbs_g": cols["carbs_g"][i],
+            "fat_g": cols["fat_g"][i],
+            "carbon_footprint_kg_co2e": cols["carbon_footprint_kg_co2e"][i],
+            "carbon_footprint_label": CARBON_LABELS[cols["carbon_footprint_label"][i]],
+            "is_spicy": cols["is_spicy"][i],
+            "is_vegetarian": cols["is_vegetarian"][i],
+            "is_vegan": cols["is_vegan"][i],
+            "tags": tags[i],
+            "allergens": allergens[i],
+        })
+    return records
 
-        spicy = False
-        if random.random() < 0.25:
-            spicy = True
-            name_parts.append(random.choice(SPICY_WORDS))
 
-        name_parts.append(base_name)
-        full_name = "".join(name_parts)
+# =========================================================
+# 輸出
+# =========================================================
 
-        if category == "main":
-            calories = random.randint(380, 850)
-        elif category == "side":
-            calories = random.randint(120, 350)
+# 欄位值是詞表 index 的欄位
+DISH_VOCAB = {
+    "category": CATEGORIES,
+    "cuisine_type": CUISINES,
+    "carbon_footprint_label": CARBON_LABELS,
+}
+RESTAURANT_VOCAB = {"area": AREAS, "cuisine_type": CUISINES}
+MASK_VOCAB = {"tags": DISH_TAGS, "allergens": ALLERGENS}
+
+
+def _write_jsonl(path: str, records: List[Dict[str, Any]]):
+    with open(path, "wb") as f:
+        f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode("utf-8"))
+
+
+def _write_parquet(path: str, batch: Dict[str, np.ndarray], vocab: Dict[str, List[str]], masks: Dict[str, List[str]]):
+    # 直接由 array 建 Arrow 欄位，不經過 list of dict
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("BULK_FORMAT='parquet' 需要 pyarrow：pip install pyarrow") from e
+
+    arrays = {}
+    for col, values in batch.items():
+        if col in vocab:
+            arrays[col] = pa.DictionaryArray.from_arrays(values.astype(np.int32), vocab[col])
+        elif col in masks:
+            _, choice = np.nonzero(values)
+            offsets = np.zeros(len(values) + 1, dtype=np.int32)
+            np.cumsum(values.sum(axis=1), out=offsets[1:])
+            arrays[col] = pa.ListArray.from_arrays(offsets, pa.array(np.array(masks[col])[choice]))
         else:
-            calories = random.randint(0, 180)
-
-        protein_g, carbs_g, fat_g = gen_macros(calories, category)
-        cf = carbon_footprint_for_protein(protein_type)
-        cf_label = carbon_label(cf)
-
-        is_veg = protein_type in ("veg", "tofu", "egg")
-        is_vegan = protein_type in ("veg", "tofu")
-
-        tags = []
-        if protein_g >= 25:
-            tags.append("高蛋白")
-        if carbs_g <= 40 and category == "main":
-            tags.append("低醣")
-        if calories <= 550 and category == "main":
-            tags.append("減脂友善")
-        if cf_label == "low":
-            tags.append("低碳足跡")
-        if spicy:
-            tags.append("辣")
-
-        dish = {
-            "dish_id": dish_id,
-            "restaurant_id": rest["restaurant_id"],
-            "name": full_name,
-            "category": category,
-            "cuisine_type": rest["cuisine_type"],
-            "calories_kcal": calories,
-            "protein_g": protein_g,
-            "carbs_g": carbs_g,
-            "fat_g": fat_g,
-            "carbon_footprint_kg_co2e": cf,
-            "carbon_footprint_label": cf_label,
-            "is_spicy": spicy,
-            "is_vegetarian": is_veg,
-            "is_vegan": is_vegan,
-            "tags": tags,
-            "allergens": random.sample(
-                ["egg", "milk", "soy", "nuts", "gluten"],
-                k=random.randint(0, 2)
-            )
-        }
+            arrays[col] = pa.array(values)
+    pq.write_table(pa.table(arrays), path)
+
+
+def _db_columns(batch: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    # 轉成 food_db.DishTable 的欄位（類別是 vocab index、多值欄位是 bitmask）
+    cols = {col: batch[col].astype(dtype) for col, dtype in NUMERIC_COLUMNS.items()}
+    cols["category"] = batch["category"].astype(np.int16)
+    cols["cuisine_type"] = batch["cuisine_type"].astype(np.int16)
+    cols["carbon_footprint_label"] = batch["carbon_footprint_label"].astype(np.int16)
+    cols["tags"] = _bits(batch["tags"])
+    cols["allergens"] = _bits(batch["allergens"])
+    return cols
+
+
+def write_bulk(
+    n_rest: int,
+    n_dishes: int,
+    out_dir: str = BULK_OUT_DIR,
+    fmt: str = "jsonl",
+    chunk: int = BULK_CHUNK,
+    seed: int = SEED,
+    db_dir: Optional[str] = BULK_DB_DIR,
+) -> Dict[str, Any]:
+    if fmt not in ("jsonl", "parquet"):
+        raise ValueError(f"不支援的輸出格式：{fmt}")
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    start = time.perf_counter()
+
+    restaurants = random_restaurants(rng, n_rest)
+    rest_path = os.path.join(out_dir, f"restaurants.{fmt}")
+    if fmt == "jsonl":
+        _write_jsonl(rest_path, restaurant_records(restaurants))
+    else:
+        _write_parquet(rest_path, restaurants, RESTAURANT_VOCAB, {"tags": RESTAURANT_TAGS})
+
+    n_shards = max(1, -(-n_dishes // chunk))
+    # 菜色資料表逐批寫入 memmap，記憶體只和 chunk 有關，不會隨菜色總數成長
+    db = DishTableWriter(db_dir, n_dishes, {**DISH_VOCAB, **MASK_VOCAB}) if db_dir else None
+    for shard in range(n_shards):
+        first = shard * chunk
+        n = min(chunk, n_dishes - first)
+        batch = gen_dishes(rng, restaurants, n, start_id=first + 1)
+        path = os.path.join(out_dir, f"dishes-{shard:05d}-of-{n_shards:05d}.{fmt}")
+        if fmt == "jsonl":
+            _write_jsonl(path, dish_records(batch))
+        else:
+            _write_parquet(path, batch, DISH_VOCAB, MASK_VOCAB)
+        if db is not None:
+            db.append(_db_columns(batch), batch["name"].tolist())
+
+    if db is not None:
+        db.close()
 
-        dishes.append(dish)
-        dish_id += 1
+    return {"shards": n_shards, "seconds": time.perf_counter() - start}
 
-    return dishes
 
+def main(out_path=OUT_PATH):
+    if BULK_FORMAT:
+        stats = write_bulk(N_RESTAURANTS, N_DISHES, BULK_OUT_DIR, BULK_FORMAT)
+        print(
+            f"已產生假資料到 {BULK_OUT_DIR}/：餐廳 {N_RESTAURANTS} 間、菜色 {N_DISHES} 道"
+            f"（{stats['shards']} 個 shard，{N_DISHES / stats['seconds']:.0f} 道/秒）"
+        )
+        return
 
-def main(out_path="nutrition_dataset.json"):
-    restaurants = random_restaurants(50)
-    dishes = gen_dishes(restaurants, 300)
+    rng = np.random.default_rng(SEED)
+    restaurants = random_restaurants(rng, N_RESTAURANTS)
+    dishes = dish_records(gen_dishes(rng, restaurants, N_DISHES))
     data = {
-        "restaurants": restaurants,
+        "restaurants": restaurant_records(restaurants),
         "dishes": dishes
     }
     with open(out_path, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
-    print(f"已產生假資料：{out_path}，餐廳 {len(restaurants)} 間、菜色 {len(dishes)} 道。")
+    print(f"已產生假資料：{out_path}，餐廳 {N_RESTAURANTS} 間、菜色 {len(dishes)} 道。")
 
 
 if __name__ == "__main__":
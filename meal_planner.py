@@ -0,0 +1,180 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from food_db import DishTable
+
+# =========================================================
+# 一日餐點最佳化：在候選菜色中湊出符合熱量 / 蛋白質目標的組合
+# =========================================================
+#
+# 做法（全部向量化）：
+#   1. 一週 7 天一起處理：每天從候選池抽 N_SAMPLES 組隨機組合（days × samples × 餐數 的 array），
+#      算總熱量、總蛋白質，每天取分數最好的一組
+#   2. 還不在容許範圍內的那幾天做 1-opt：每一餐輪流換成候選池中「其他餐不變時」最好的菜，
+#      符合容許範圍的菜有很多道時從中隨機挑一道，讓菜單保有多樣性
+# 分數 = max(熱量誤差 / CAL_TOLERANCE, 蛋白質不足 / PROTEIN_TOLERANCE)，<= 1 代表達標。
+# 過敏原與素食限制在建候選池時就排除，所以不會被選到；限制下完全沒有菜可選時直接報錯，
+# 不會為了湊出菜單而放進含過敏原或葷食的菜（產生資料時用 has_candidates 先檢查、重抽使用者）。
+
+CAL_TOLERANCE = 0.05        # 熱量誤差 ±5%
+PROTEIN_TOLERANCE = 0.10    # 蛋白質最多低於目標 10%
+N_SAMPLES = 256
+MAX_POOL = 4096             # 候選太多時每天隨機取這麼多道來搜尋
+PASSES = 2
+MIN_POOL = 30               # 候選少於這個數量就放寬目標篩選（限制條件仍保留）
+
+
+def meal_notes(dishes: DishTable) -> List[str]:
+    # 每道菜的備註（高蛋白 / 減脂友善 / 低碳足跡），建表時一次算好
+    tags = np.asarray(dishes["tags"])
+    high_protein = (tags & np.uint64(dishes.bit("tags", "高蛋白"))) != 0
+    fat_loss = (tags & np.uint64(dishes.bit("tags", "減脂友善"))) != 0
+    labels = dishes.vocab["carbon_footprint_label"]
+    low_carbon = np.asarray(dishes["carbon_footprint_label"]) == (
+        labels.index("low") if "low" in labels else -1
+    )
+
+    codes = high_protein.astype(np.int8) | fat_loss.astype(np.int8) << 1 | low_carbon.astype(np.int8) << 2
+    table = []
+    for code in range(8):
+        parts = [name for bit, name in enumerate(["高蛋白", "減脂友善", "低碳足跡"]) if code >> bit & 1]
+        table.append("、".join(parts) if parts else "一般建議")
+    return [table[c] for c in codes.tolist()]
+
+
+class MealPlanner:
+    def __init__(
+        self,
+        dishes: DishTable,
+        cal_tolerance: float = CAL_TOLERANCE,
+        protein_tolerance: float = PROTEIN_TOLERANCE,
+        n_samples: int = N_SAMPLES,
+        max_pool: int = MAX_POOL,
+    ):
+        self.dishes = dishes
+        self.cal = np.asarray(dishes["calories_kcal"], dtype=np.float64)
+        self.protein = np.asarray(dishes["protein_g"], dtype=np.float64)
+        self.cal_tolerance = cal_tolerance
+        self.protein_tolerance = protein_tolerance
+        self.n_samples = n_samples
+        self.max_pool = max_pool
+        self._safe: Dict[Tuple[int, bool], np.ndarray] = {}
+        self._allowed: Dict[Tuple[str, int, bool], Tuple[np.ndarray, float]] = {}
+        self.notes = meal_notes(dishes)
+
+    def allergen_bits(self, allergens: List[str]) -> int:
+        bits = 0
+        for a in allergens:
+            bits |= self.dishes.bit("allergens", a)
+        return bits
+
+    def safe(self, allergens: List[str], vegetarian: bool) -> np.ndarray:
+        # 符合過敏原 / 素食限制的列號，依 (過敏原, 素食) 快取
+        allergen_bits = self.allergen_bits(allergens)
+        key = (allergen_bits, vegetarian)
+        if key not in self._safe:
+            ok = (self.dishes["allergens"] & np.uint64(allergen_bits)) == 0
+            if vegetarian:
+                ok &= np.asarray(self.dishes["is_vegetarian"])
+            self._safe[key] = np.flatnonzero(ok)
+        return self._safe[key]
+
+    def has_candidates(self, allergens: List[str], vegetarian: bool) -> bool:
+        return len(self.safe(allergens, vegetarian)) > 0
+
+    def allowed(self, goal_internal: str, allergens: List[str], vegetarian: bool) -> Tuple[np.ndarray, float]:
+        # 回傳 (候選列號, 候選中最高熱量)，依 (目標, 過敏原, 素食) 快取
+        safe = self.safe(allergens, vegetarian)
+        if len(safe) == 0:
+            raise ValueError(
+                f"菜色資料表裡沒有符合限制的菜（過敏原 {allergens}，素食 {vegetarian}），排不出菜單"
+            )
+        key = (goal_internal, self.allergen_bits(allergens), vegetarian)
+
+        if key not in self._allowed:
+            pool = np.intersect1d(self.dishes.candidates(goal_internal), safe, assume_unique=True)
+            if len(pool) < MIN_POOL:
+                # 目標篩選太嚴就放寬目標，限制條件仍保留
+                pool = safe
+            self._allowed[key] = (pool, float(self.cal[pool].max()))
+        return self._allowed[key]
+
+    def score(self, cal, protein, cal_target: float, protein_target: float):
+        cal_err = np.abs(cal - cal_target) / cal_target / self.cal_tolerance
+        protein_short = np.maximum(0.0, protein_target - protein) / protein_target / self.protein_tolerance
+        return np.maximum(cal_err, protein_short)
+
+    def meals_needed(self, n_meals: int, max_cal: float, cal_target: float) -> int:
+        # 兩餐怎麼選都吃不到目標熱量時改成三餐
+        if n_meals < 3 and n_meals * max_cal < cal_target * (1 - self.cal_tolerance):
+            return 3
+        return n_meals
+
+    def plan_week(
+        self,
+        rng: np.random.Generator,
+        pool: np.ndarray,
+        meal_counts: List[int],
+        cal_target: float,
+        protein_target: float,
+    ) -> List[np.ndarray]:
+        # 回傳每天選到的菜色列號（長度 = 當天餐數）
+        if len(pool) > self.max_pool:
+            pool = pool[rng.integers(0, len(pool), self.max_pool)]
+
+        n_days, slots = len(meal_counts), max(meal_counts)
+        active = np.arange(slots)[None, :] < np.asarray(meal_counts)[:, None]    # (days, slots)
+        combos = pool[rng.integers(0, len(pool), (n_days, self.n_samples, slots))]
+        mask = active[:, None, :]
+        scores = self.score(
+            np.where(mask, self.cal[combos], 0.0).sum(axis=-1),
+            np.where(mask, self.protein[combos], 0.0).sum(axis=-1),
+            cal_target,
+            protein_target,
+        )
+        # 同一天不要出現同一道菜
+        for a in range(slots):
+            for b in range(a + 1, slots):
+                scores[(combos[..., a] == combos[..., b]) & mask[..., b]] = np.inf
+
+        best_sample = scores.argmin(axis=1)
+        best = combos[np.arange(n_days), best_sample]
+        best_scores = scores[np.arange(n_days), best_sample]
+
+        week = []
+        for d, n_meals in enumerate(meal_counts):
+            meals = best[d, :n_meals].copy()
+            if best_scores[d] > 1:
+                meals = self._improve(rng, pool, meals, cal_target, protein_target)
+            week.append(meals)
+        return week
+
+    def _improve(
+        self,
+        rng: np.random.Generator,
+        pool: np.ndarray,
+        meals: np.ndarray,
+        cal_target: float,
+        protein_target: float,
+    ) -> np.ndarray:
+        pool_cal = self.cal[pool]
+        pool_protein = self.protein[pool]
+        for _ in range(PASSES):
+            for j in range(len(meals)):
+                rest_cal = self.cal[meals].sum() - self.cal[meals[j]]
+                rest_protein = self.protein[meals].sum() - self.protein[meals[j]]
+                s = self.score(rest_cal + pool_cal, rest_protein + pool_protein, cal_target, protein_target)
+                for k, other in enumerate(meals):
+                    if k != j:
+                        s[pool == other] = np.inf
+                within = np.flatnonzero(s <= 1)
+                meals[j] = pool[rng.choice(within)] if len(within) else pool[int(np.argmin(s))]
+            if self.within_tolerance(meals, cal_target, protein_target):
+                break
+        return meals
+
+    def within_tolerance(self, meals: np.ndarray, cal_target: float, protein_target: float) -> bool:
+        return bool(
+            self.score(self.cal[meals].sum(), self.protein[meals].sum(), cal_target, protein_target) <= 1
+        )
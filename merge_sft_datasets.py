@@ -1,39 +1,244 @@
+import glob
+import hashlib
 import json
-from pathlib import Path
-from typing import List
+import math
+import os
+import re
+import sqlite3
+import tempfile
+from json.decoder import scanstring
+from typing import Dict, List, Optional, Set, Tuple
 
 OUT_PATH = "all_sft.jsonl"
 
+# 支援 glob，分片輸出（diet_sft-00000-of-00016.jsonl）也會被抓進來。
+# 同一個輸出同時有單檔與分片、或不同 NUM_SHARDS 的分片（之前跑過的舊資料）時，
+# 只取最新的那一次產生的檔案，其餘印警告略過（見 expand_sources）
 SOURCES: List[str] = [
-    "diet_sft.jsonl",
-    "biz_sft.jsonl",
-    "brand_sft.jsonl",
+    "diet_sft*.jsonl",
+    "biz_sft*.jsonl",
+    "brand_sft*.jsonl",
 ]
 
+REQUIRED_KEYS = ("instruction", "input", "output")
+
+DEDUP = True                 # 依內容 hash 去除重複樣本（hash 的是 dedup_key 的正規化形式，key 順序、空白不同也算重複）
+EXPECTED_ROWS = 10_000_000   # bloom filter 的預估容量，超過只會讓誤判率變高，不影響正確性
+BLOOM_FP_RATE = 0.001
+STRICT = False               # True：每一行都完整 json.loads 檢查（較慢）
+
+# make_*_sft 寫出的行是 json.dumps(row, ensure_ascii=False)，key 順序固定、三個值都是字串。
+# 整行完全符合這個形狀就直接原樣寫出，不用 parse 再 dump：三個值用 json 的 C 版 scanstring 掃過
+# （未結束的字串、不合法的跳脫、控制字元都會報錯），最後一個字串後面必須正好是結尾的 }。
+# 截斷的行（例如 output 寫到一半）過不了這關，改走 json.loads 判定
+_FAST_PREFIX = '{"instruction": "'
+_FAST_KEYS = (', "input": "', ', "output": "')
+
+# 分片輸出的檔名（sft_runner.shard_path）：<stem>-00003-of-00016<suffix>
+_SHARD_NAME = re.compile(r"^(?P<stem>.+)-(?P<shard>\d{5})-of-(?P<total>\d{5})(?P<suffix>\.[^.]*)?$")
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, fp_rate: float):
+        n_bits = max(8, int(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        self.n_bits = n_bits
+        self.n_hashes = max(1, round(n_bits / capacity * math.log(2)))
+        self.bits = bytearray((n_bits + 7) // 8)
+
+    def _positions(self, digest: bytes):
+        # Kirsch-Mitzenmacher：用兩個 64-bit hash 組出 k 個位置
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        for i in range(self.n_hashes):
+            yield (h1 + i * h2) % self.n_bits
+
+    def add(self, digest: bytes) -> bool:
+        # 回傳加入前是否「可能已存在」
+        seen = True
+        bits = self.bits
+        for pos in self._positions(digest):
+            byte, mask = pos >> 3, 1 << (pos & 7)
+            if not bits[byte] & mask:
+                seen = False
+                bits[byte] |= mask
+        return seen
+
+
+class HashDeduper:
+    # bloom filter 擋掉絕大多數「一定沒看過」的情況；
+    # bloom 說「可能看過」時再去 on-disk 的 sqlite 確認，所以結果是精確的，記憶體用量固定
+    FLUSH_EVERY = 100_000
+
+    def __init__(self, capacity: int = EXPECTED_ROWS, fp_rate: float = BLOOM_FP_RATE, workdir: Optional[str] = None):
+        self.bloom = BloomFilter(capacity, fp_rate)
+        fd, self.db_path = tempfile.mkstemp(prefix="merge_dedup_", suffix=".sqlite", dir=workdir)
+        os.close(fd)
+        self.db = sqlite3.connect(self.db_path)
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE seen (h BLOB PRIMARY KEY) WITHOUT ROWID")
+        self.pending: Set[bytes] = set()
+
+    def _flush(self):
+        if self.pending:
+            self.db.executemany("INSERT OR IGNORE INTO seen VALUES (?)", ((h,) for h in self.pending))
+            self.db.commit()
+            self.pending.clear()
+
+    def is_duplicate(self, digest: bytes) -> bool:
+        if self.bloom.add(digest):
+            if digest in self.pending:
+                return True
+            if self.db.execute("SELECT 1 FROM seen WHERE h = ?", (digest,)).fetchone():
+                return True
+        self.pending.add(digest)
+        if len(self.pending) >= self.FLUSH_EVERY:
+            self._flush()
+        return False
+
+    def close(self):
+        self.db.close()
+        os.remove(self.db_path)
+
+
+def output_generation(path: str) -> Tuple[str, int]:
+    # (輸出檔案, 分片數)：diet_sft-00003-of-00016.jsonl → ("diet_sft.jsonl", 16)，單檔 → (本身, 1)
+    directory, name = os.path.split(path)
+    m = _SHARD_NAME.match(name)
+    if m is None:
+        return path, 1
+    return os.path.join(directory, m.group("stem") + (m.group("suffix") or "")), int(m.group("total"))
+
+
+def latest_generation(matched: List[str]) -> List[str]:
+    # 同一個輸出若混了不同次產生的檔案（單檔 + 分片、或分片數不同），只留最新的一次
+    groups: Dict[str, Dict[int, List[str]]] = {}
+    for path in matched:
+        base, total = output_generation(path)
+        groups.setdefault(base, {}).setdefault(total, []).append(path)
+
+    def describe(total: int) -> str:
+        return "單檔" if total == 1 else f"{total} 個分片"
+
+    kept = []
+    for base, generations in groups.items():
+        total = max(generations, key=lambda t: max(os.path.getmtime(p) for p in generations[t]))
+        for other, paths in generations.items():
+            if other != total:
+                print(
+                    f"警告：{base} 混有不同次產生的檔案，只合併最新的（{describe(total)}），"
+                    f"略過舊的{describe(other)}：{', '.join(paths)}"
+                )
+        if total > 1 and len(generations[total]) != total:
+            print(f"警告：{base} 應有 {total} 個分片，只找到 {len(generations[total])} 個")
+        kept.extend(generations[total])
+    return sorted(kept)
+
+
+def expand_sources(patterns: List[str], exclude: str = OUT_PATH) -> List[str]:
+    paths = []
+    for pattern in patterns:
+        matched = [p for p in sorted(glob.glob(pattern)) if os.path.abspath(p) != os.path.abspath(exclude)]
+        if not matched:
+            print(f"警告：找不到 {pattern}，略過")
+        for path in latest_generation(matched):
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def canonical_row(line: bytes) -> Optional[Dict[str, str]]:
+    # 正好是 {"instruction": "...", "input": "...", "output": "..."}、三個值都是完整的 JSON 字串時回傳解出的 row，否則 None
+    try:
+        text = line.decode("utf-8")
+        if not text.startswith(_FAST_PREFIX):
+            return None
+        row = {}
+        value, end = scanstring(text, len(_FAST_PREFIX))
+        row[REQUIRED_KEYS[0]] = value
+        for name, key in zip(REQUIRED_KEYS[1:], _FAST_KEYS):
+            if not text.startswith(key, end):
+                return None
+            value, end = scanstring(text, end + len(key))
+            row[name] = value
+        if end == len(text) - 1 and text[end] == "}":
+            return row
+        return None
+    except ValueError:
+        # UnicodeDecodeError 與 JSONDecodeError 都是 ValueError
+        return None
+
+
+def dedup_key(row: Dict) -> bytes:
+    # 去重比對的是內容而不是原始 bytes：key 排序、緊湊分隔符號，
+    # 同一筆資料不管 key 順序、空白、\u 跳脫怎麼寫都會得到同一個 key
+    return json.dumps(row, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def normalize_line(line: bytes, strict: bool = STRICT) -> Optional[Tuple[bytes, bytes]]:
+    # 回傳 (要寫出的行（不含換行）, 去重用的 key)；格式不對或缺 key 回傳 None
+    if not strict:
+        row = canonical_row(line)
+        if row is not None:
+            return line, dedup_key(row)
+
+    try:
+        obj = json.loads(line)
+    except ValueError:
+        # JSONDecodeError 或不是合法 UTF-8（UnicodeDecodeError）
+        return None
+    if not isinstance(obj, dict) or not all(k in obj for k in REQUIRED_KEYS):
+        return None
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8"), dedup_key(obj)
+
+
+def merge(
+    sources: List[str],
+    out_path: str = OUT_PATH,
+    dedup: bool = DEDUP,
+    strict: bool = STRICT,
+) -> Dict[str, int]:
+    stats = {"written": 0, "duplicates": 0, "invalid": 0}
+    deduper = HashDeduper(workdir=os.path.dirname(os.path.abspath(out_path))) if dedup else None
+
+    # 先寫暫存檔再換名，訓練端不會讀到寫一半的 all_sft.jsonl
+    tmp_path = out_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as out:
+            for src in sources:
+                print(f"合併資料來源：{src}")
+                with open(src, "rb") as f:
+                    for raw in f:
+                        line = raw.strip()
+                        if not line:
+                            continue
+                        normalized = normalize_line(line, strict)
+                        if normalized is None:
+                            stats["invalid"] += 1
+                            continue
+                        line, key = normalized
+                        if deduper is not None:
+                            digest = hashlib.blake2b(key, digest_size=16).digest()
+                            if deduper.is_duplicate(digest):
+                                stats["duplicates"] += 1
+                                continue
+                        out.write(line + b"\n")
+                        stats["written"] += 1
+        os.replace(tmp_path, out_path)
+    finally:
+        if deduper is not None:
+            deduper.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return stats
+
 
 def main():
-    total = 0
-
-    with open(OUT_PATH, "w", encoding="utf-8") as out:
-        for src in SOURCES:
-            path = Path(src)
-            if not path.exists():
-                print(f"警告：找不到 {src}，略過")
-                continue
-
-            print(f"合併資料來源：{src}")
-            with path.open("r", encoding="utf-8") as f:
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    obj = json.loads(line)
-                    if not all(k in obj for k in ("instruction", "input", "output")):
-                        continue
-                    out.write(json.dumps(obj, ensure_ascii=False) + "\n")
-                    total += 1
-
-    print(f"已合併產生 {OUT_PATH}，共 {total} 筆樣本。")
+    stats = merge(expand_sources(SOURCES))
+    print(
+        f"已合併產生 {OUT_PATH}，共 {stats['written']} 筆樣本"
+        f"（重複 {stats['duplicates']} 筆、格式不符 {stats['invalid']} 筆已略過）。"
+    )
 
 
 if __name__ == "__main__":
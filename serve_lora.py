@@ -0,0 +1,708 @@
+import json
+import os
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional, Tuple
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, DynamicCache
+from peft import PeftModel
+
+from train_all_lora import TOKENS, build_text
+from diet_codec import DietExpander, is_compact
+from json_constrain import JsonAutomaton, JsonConstraint, TokenIndex, constrained_generate, load_schemas
+
+# =========================================================
+# LoRA 推論服務：動態批次（dynamic batching）
+# =========================================================
+#
+# base model 只載一次，上面掛多個 adapter（例如分別用 diet / biz / brand 的 DATA_PATH
+# 跑 train_all_lora.py 得到的 OUTPUT_DIR）。HTTP 請求先進 queue，背景 thread 取第一筆後
+# 最多再等 MAX_WAIT_MS 收集同批請求（上限 MAX_BATCH_SIZE），一次 generate。
+# 同一批可以混用不同 adapter（PEFT 的 adapter_names，每筆各走自己的 LoRA 權重）。
+# 記憶體裡最多留 MAX_LOADED_ADAPTERS 個 adapter，超過就把最久沒用的卸載（LRU），用到再從硬碟讀。
+# prompt 和訓練時 build_text 是同一個 template，生成到 response_end 就停。
+#
+# prefix KV cache：請求幾乎都以少數幾個固定 instruction 開頭，
+# bos + instruction_start + instruction + instruction_end 這段的 key/value 依 (adapter, prefix token)
+# 快取起來（LRU，最多 PREFIX_CACHE_SIZE 組），命中時 prefill 只要算後面的 input。
+# 同一批 prefix 長度不同時，cache 靠右對齊、prefix 與 input 之間補 pad（attention mask 遮掉），
+# position_ids 由 attention mask 算，和不用 cache 時完全一樣。
+#
+# 精簡格式：adapter 用 make_diet_sft.py 的 COMPACT_OUTPUT 資料訓練時，模型只輸出 {"w": [[dish_id, ...], ...]}，
+# 回傳前用 DIET_DB_DIR 的菜色資料表與請求的 input 還原成完整菜單（原本的精簡輸出放在 compact_output）。
+#
+# JSON 約束解碼：instruction 對得到 SCHEMA_PATH（python json_constrain.py 產生）裡的任務時，
+# 用 schema 自動機限制每一步可選的 token，key、標點等固定字串直接快轉，輸出一定是合法 JSON。
+#
+# API：
+#   POST /generate  {"adapter": "diet", "instruction": "...", "input": "...", "max_new_tokens": 256}
+#                   → {"output": "...", "tokens": 123, "latency_ms": 456.7}
+#                   （沒給 adapter 就用 DEFAULT_ADAPTER；可加 "schema": "diet" 指定 schema，
+#                     或 "constrained": false 關掉約束解碼；精簡格式還原後多一個 "compact_output"）
+#   GET  /stats     → 吞吐量、batch 大小、延遲分位數、各 adapter 請求數與載入 / 卸載次數、prefix cache 命中率
+#
+# CPU 上用小模型測試：把 MODEL_ID / ADAPTERS 換成本機的小模型與它訓練出的 adapter 即可。
+
+MODEL_ID = "meta-llama/Llama-3.2-1B"
+ADAPTER_DIR = "./multi-lora"
+
+# adapter 名稱 → 目錄，例：
+#   ADAPTERS = {
+#       "diet": "./lora-diet",
+#       "biz": "./lora-biz",
+#       "brand": "./lora-brand",
+#   }
+# 同一個 base model 訓練出來的 adapter 才能一起掛
+ADAPTERS: Dict[str, str] = {"default": ADAPTER_DIR}
+DEFAULT_ADAPTER = "default"
+MAX_LOADED_ADAPTERS = 4
+HOST = "127.0.0.1"
+PORT = 8000
+
+MAX_BATCH_SIZE = 8
+MAX_WAIT_MS = 20          # 收到第一筆後最多等多久湊 batch
+MAX_NEW_TOKENS = 512      # 單筆請求的上限（也是預設值）
+LATENCY_WINDOW = 1000     # 延遲統計只看最近這麼多筆
+
+PREFIX_CACHE = True
+PREFIX_CACHE_SIZE = 64    # 最多快取幾組 (adapter, prefix)
+MIN_PREFIX_TOKENS = 16    # prefix 太短不值得快取
+
+CONSTRAINED_DECODING = True
+SCHEMA_PATH = "sft_schemas.json"
+CONSTRAINED_MAX_NEW_TOKENS = 2048   # 約束解碼請求的上限（也是預設值），整份 JSON 要生得完
+
+EXPAND_COMPACT_OUTPUT = True
+DIET_DB_DIR = "nutrition_dataset.dishdb"   # make_diet_sft.py 用的菜色資料表；不存在就不還原
+
+
+def build_prompt(example: Dict[str, Any]) -> str:
+    # 訓練用的完整 text 去掉 output 之後的部分，也就是停在 response_start
+    text = build_text({**example, "output": ""})
+    return text[: len(text) - len(TOKENS.response_end + TOKENS.eos)]
+
+
+def build_prefix(instruction: str) -> str:
+    # build_prompt 開頭固定不變的部分（只跟 instruction 有關）
+    return TOKENS.bos + TOKENS.instruction_start + instruction + TOKENS.instruction_end
+
+
+def prefix_token_count(offsets: List[Tuple[int, int]], prefix_chars: int) -> int:
+    # prefix 在整段 tokenize 結果中剛好落在 token 邊界時，回傳 prefix 的 token 數，否則 0。
+    # 用整段 tokenize 的結果切，確保和不用 cache 時的 token 完全相同
+    for i, (start, end) in enumerate(offsets):
+        if end > prefix_chars:
+            return i if start >= prefix_chars else 0
+    return 0
+
+
+def expand_output(expander: DietExpander, result: Dict[str, Any], input_text: str) -> Dict[str, Any]:
+    # 精簡格式的飲食菜單還原成完整格式；其他輸出原樣回傳
+    try:
+        obj = json.loads(result["output"])
+    except ValueError:
+        return result
+    if not is_compact(obj):
+        return result
+    try:
+        full = expander.expand(obj, json.loads(input_text))
+    except (ValueError, KeyError, TypeError) as e:
+        return {**result, "expand_error": f"精簡格式還原失敗：{e}"}
+    return {**result, "output": json.dumps(full, ensure_ascii=False), "compact_output": result["output"]}
+
+
+class LoraGenerator:
+    def __init__(
+        self,
+        model_id: str = MODEL_ID,
+        adapters: Optional[Dict[str, str]] = None,
+        default_adapter: str = DEFAULT_ADAPTER,
+        max_loaded: int = MAX_LOADED_ADAPTERS,
+        prefix_cache_size: int = PREFIX_CACHE_SIZE if PREFIX_CACHE else 0,
+        schema_path: Optional[str] = SCHEMA_PATH if CONSTRAINED_DECODING else None,
+    ):
+        self.adapters = dict(ADAPTERS if adapters is None else adapters)
+        if default_adapter not in self.adapters:
+            raise ValueError(f"DEFAULT_ADAPTER {default_adapter} 不在 ADAPTERS 裡")
+        self.default_adapter = default_adapter
+        self.max_loaded = max(1, max_loaded)
+        # LRU 與計數只由 batcher thread 修改，/stats 的 HTTP thread 會同時讀；
+        # 修改和讀取統計都要拿這個鎖（batcher thread 自己讀不用）
+        self.stats_lock = threading.Lock()
+        self.loaded: "OrderedDict[str, None]" = OrderedDict()    # 最後面是最近用過的
+        self.loads = 0
+        self.evictions = 0
+
+        # (adapter, prefix token ids) → 每層的 (key, value)，shape (1, heads, prefix_len, head_dim)
+        self.prefix_cache_size = prefix_cache_size
+        self.prefix_cache: "OrderedDict[Tuple[str, Tuple[int, ...]], Tuple]" = OrderedDict()
+        self.prefix_hits = 0
+        self.prefix_misses = 0
+        self.prefix_tokens_reused = 0
+
+        # schema 名稱 → schema、instruction → schema 名稱；JsonConstraint 第一次用到才建
+        registry = {"schemas": {}, "instructions": {}}
+        if schema_path and os.path.exists(schema_path):
+            registry = load_schemas(schema_path)
+        self.schemas: Dict[str, Any] = registry["schemas"]
+        self.schema_instructions: Dict[str, str] = registry["instructions"]
+        self.constraints: Dict[str, JsonConstraint] = {}
+        self.token_index: Optional[TokenIndex] = None
+        self.constrained_requests = 0
+
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        dtype = torch.float16 if self.device == "cuda" else torch.float32
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_id)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        # batch 生成要靠左 padding，新 token 才會接在每筆 prompt 的最後面
+        self.tokenizer.padding_side = "left"
+
+        base = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=dtype).to(self.device)
+        self.model = PeftModel.from_pretrained(
+            base, self.adapters[default_adapter], adapter_name=default_adapter
+        ).eval()
+        self.loaded[default_adapter] = None
+        self.loads += 1
+
+    def _load(self, name: str, keep: set):
+        # 載入 adapter（已載入就標成最近用過），超過上限時卸載 keep 以外最久沒用的
+        if name in self.loaded:
+            with self.stats_lock:
+                self.loaded.move_to_end(name)
+            return
+        self.model.load_adapter(self.adapters[name], adapter_name=name)
+        self.model.eval()
+        with self.stats_lock:
+            self.loaded[name] = None
+            self.loads += 1
+        while len(self.loaded) > self.max_loaded:
+            victim = next(n for n in self.loaded if n not in keep)
+            self.model.base_model.delete_adapter(victim)
+            with self.stats_lock:
+                del self.loaded[victim]
+                self.evictions += 1
+                for key in [k for k in self.prefix_cache if k[0] == victim]:
+                    del self.prefix_cache[key]
+
+    def adapter_stats(self) -> Dict[str, Any]:
+        with self.stats_lock:
+            return {"loaded": list(self.loaded), "loads": self.loads, "evictions": self.evictions}
+
+    def schema_for(self, instruction: str) -> Optional[str]:
+        return self.schema_instructions.get(instruction)
+
+    def constraint_stats(self) -> Dict[str, Any]:
+        with self.stats_lock:
+            constraints = list(self.constraints.values())
+            requests = self.constrained_requests
+        return {
+            "schemas": sorted(self.schemas),
+            "requests": requests,
+            "cached_masks": sum(len(c._masks) for c in constraints),
+        }
+
+    def _constraint(self, schema: str) -> JsonConstraint:
+        if schema not in self.constraints:
+            if self.token_index is None:
+                self.token_index = TokenIndex(self.tokenizer, self.model.get_output_embeddings().weight.shape[0])
+            automaton = JsonAutomaton(self.schemas[schema], suffix=TOKENS.response_end)
+            constraint = JsonConstraint(automaton, self.token_index, self.device)
+            with self.stats_lock:
+                self.constraints[schema] = constraint
+        return self.constraints[schema]
+
+    def prefix_stats(self) -> Dict[str, Any]:
+        with self.stats_lock:
+            entries = len(self.prefix_cache)
+            hits, misses, reused = self.prefix_hits, self.prefix_misses, self.prefix_tokens_reused
+        lookups = hits + misses
+        return {
+            "entries": entries,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "tokens_reused": reused,
+        }
+
+    def generate(
+        self,
+        prompts: List[str],
+        max_new_tokens: List[int],
+        adapter_names: Optional[List[str]] = None,
+        prefix_chars: Optional[List[int]] = None,
+        schemas: Optional[List[Optional[str]]] = None,
+    ) -> List[Tuple[str, int]]:
+        # 回傳每筆的 (response 文字, 生成 token 數)；prefix_chars 是每筆可快取 prefix 的字元數（0 表示不用），
+        # schemas 是每筆要套的 schema 名稱（None 表示不約束）
+        adapter_names = adapter_names or [self.default_adapter] * len(prompts)
+        prefix_chars = prefix_chars or [0] * len(prompts)
+        schemas = schemas or [None] * len(prompts)
+
+        # 一批用到的 adapter 超過 MAX_LOADED_ADAPTERS 時，切成幾段依序跑；
+        # 同一個 adapter 的請求排在一起、已載入的先跑，每個 adapter 最多載入一次
+        first_seen: Dict[str, int] = {}
+        for i, name in enumerate(adapter_names):
+            first_seen.setdefault(name, i)
+        order = sorted(
+            range(len(prompts)),
+            key=lambda i: (adapter_names[i] not in self.loaded, first_seen[adapter_names[i]]),
+        )
+        groups: List[List[int]] = [[]]
+        names: set = set()
+        for i in order:
+            name = adapter_names[i]
+            if name not in names and len(names) == self.max_loaded:
+                groups.append([])
+                names = set()
+            groups[-1].append(i)
+            names.add(name)
+
+        results: List[Tuple[str, int]] = [("", 0)] * len(prompts)
+        for group in groups:
+            group_names = [adapter_names[i] for i in group]
+            for name in group_names:
+                self._load(name, keep=set(group_names))
+            # 約束解碼和一般 generate 各自成一批
+            for constrained in (False, True):
+                rows = [i for i in group if (schemas[i] is not None) == constrained]
+                if not rows:
+                    continue
+                args = (
+                    [prompts[i] for i in rows],
+                    [max_new_tokens[i] for i in rows],
+                    [adapter_names[i] for i in rows],
+                    [prefix_chars[i] for i in rows],
+                )
+                if constrained:
+                    outputs = self._generate_constrained(*args, [schemas[i] for i in rows])
+                else:
+                    outputs = self._generate(*args)
+                for i, out in zip(rows, outputs):
+                    results[i] = out
+        return results
+
+    def _prefix_kv(self, adapter: str, prefix_ids: List[int]) -> Tuple:
+        key = (adapter, tuple(prefix_ids))
+        if key in self.prefix_cache:
+            with self.stats_lock:
+                self.prefix_cache.move_to_end(key)
+                self.prefix_hits += 1
+                self.prefix_tokens_reused += len(prefix_ids)
+            return self.prefix_cache[key]
+
+        with self.stats_lock:
+            self.prefix_misses += 1
+        self.model.set_adapter(adapter)
+        out = self.model(
+            input_ids=torch.tensor([prefix_ids], device=self.device),
+            past_key_values=DynamicCache(),
+            use_cache=True,
+        )
+        kv = out.past_key_values.to_legacy_cache()
+        with self.stats_lock:
+            self.prefix_cache[key] = kv
+            while len(self.prefix_cache) > self.prefix_cache_size:
+                self.prefix_cache.popitem(last=False)
+        return kv
+
+    def _cached_inputs(self, prompts: List[str], adapter_names: List[str], prefix_chars: List[int]) -> Optional[Dict[str, Any]]:
+        # 每列排成 [pad][prefix | 已快取] [pad][input ... response_start]；沒有可用 prefix 就回傳 None
+        enc = self.tokenizer(prompts, return_offsets_mapping=True, return_token_type_ids=False)
+        splits = []
+        for offsets, n_chars in zip(enc["offset_mapping"], prefix_chars):
+            n = prefix_token_count(offsets, n_chars) if n_chars else 0
+            splits.append(n if n >= MIN_PREFIX_TOKENS else 0)
+        if not any(splits):
+            return None
+
+        kvs = [
+            self._prefix_kv(name, ids[:n]) if n else None
+            for ids, n, name in zip(enc["input_ids"], splits, adapter_names)
+        ]
+        prefix_len = max(splits)
+        suffix_len = max(len(ids) - n for ids, n in zip(enc["input_ids"], splits))
+        pad = self.tokenizer.pad_token_id
+
+        input_ids, attention_mask = [], []
+        for ids, n in zip(enc["input_ids"], splits):
+            suffix = ids[n:]
+            input_ids.append(
+                [pad] * (prefix_len - n) + ids[:n] + [pad] * (suffix_len - len(suffix)) + suffix
+            )
+            attention_mask.append(
+                [0] * (prefix_len - n) + [1] * n + [0] * (suffix_len - len(suffix)) + [1] * len(suffix)
+            )
+
+        # 各列 prefix 的 key/value 靠右對齊接成一個 batch cache，空位補 0（mask 掉）
+        template = next(kv for kv in kvs if kv is not None)
+        layers = []
+        for layer, (k_ref, v_ref) in enumerate(template):
+            keys, values = [], []
+            for kv, n in zip(kvs, splits):
+                k_shape = (1, k_ref.shape[1], prefix_len - n, k_ref.shape[3])
+                v_shape = (1, v_ref.shape[1], prefix_len - n, v_ref.shape[3])
+                keys.append(torch.cat([k_ref.new_zeros(k_shape)] + ([kv[layer][0]] if kv else []), dim=2))
+                values.append(torch.cat([v_ref.new_zeros(v_shape)] + ([kv[layer][1]] if kv else []), dim=2))
+            layers.append((torch.cat(keys), torch.cat(values)))
+
+        return {
+            "input_ids": torch.tensor(input_ids, device=self.device),
+            "attention_mask": torch.tensor(attention_mask, device=self.device),
+            "past_key_values": DynamicCache.from_legacy_cache(tuple(layers)),
+        }
+
+    @torch.inference_mode()
+    def _generate(
+        self,
+        prompts: List[str],
+        max_new_tokens: List[int],
+        adapter_names: List[str],
+        prefix_chars: List[int],
+    ) -> List[Tuple[str, int]]:
+        enc, kwargs = self._prepare(prompts, adapter_names, prefix_chars)
+        out = self.model.generate(
+            **enc,
+            **kwargs,
+            max_new_tokens=max(max_new_tokens),
+            do_sample=False,
+            stop_strings=[TOKENS.response_end],
+            tokenizer=self.tokenizer,
+            pad_token_id=self.tokenizer.pad_token_id,
+        )
+        new_tokens = out[:, enc["input_ids"].shape[1]:]
+
+        results = []
+        for row, limit in zip(new_tokens.tolist(), max_new_tokens):
+            row = row[:limit]
+            # 先結束的那幾筆後面會被補 pad
+            if self.tokenizer.pad_token_id in row:
+                row = row[: row.index(self.tokenizer.pad_token_id)]
+            results.append(self._decode(row))
+        return results
+
+    @torch.inference_mode()
+    def _generate_constrained(
+        self,
+        prompts: List[str],
+        max_new_tokens: List[int],
+        adapter_names: List[str],
+        prefix_chars: List[int],
+        schemas: List[Optional[str]],
+    ) -> List[Tuple[str, int]]:
+        constraints = [self._constraint(s) for s in schemas]
+        enc, kwargs = self._prepare(prompts, adapter_names, prefix_chars)
+        outputs = constrained_generate(
+            self.model,
+            constraints,
+            enc["input_ids"],
+            enc["attention_mask"],
+            max_new_tokens,
+            self.tokenizer.pad_token_id,
+            past_key_values=enc.get("past_key_values"),
+            model_kwargs=kwargs,
+        )
+        with self.stats_lock:
+            self.constrained_requests += len(prompts)
+        return [self._decode(row) for row in outputs]
+
+    def _prepare(
+        self,
+        prompts: List[str],
+        adapter_names: List[str],
+        prefix_chars: List[int],
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        # 回傳 (model 輸入, adapter 相關參數)
+        enc = None
+        if self.prefix_cache_size > 0 and self.tokenizer.is_fast:
+            enc = self._cached_inputs(prompts, adapter_names, prefix_chars)
+        if enc is None:
+            enc = self.tokenizer(
+                prompts, return_tensors="pt", padding=True, return_token_type_ids=False
+            ).to(self.device)
+        # active adapter 可能剛被卸載（或算 prefix 時被切換），每批都重新指定一次
+        self.model.set_adapter(adapter_names[0])
+        kwargs: Dict[str, Any] = {}
+        if len(set(adapter_names)) > 1:
+            kwargs["adapter_names"] = adapter_names
+        return enc, kwargs
+
+    def _decode(self, row: List[int]) -> Tuple[str, int]:
+        text = self.tokenizer.decode(row, skip_special_tokens=True)
+        end = text.find(TOKENS.response_end)
+        return (text[:end] if end >= 0 else text), len(row)
+
+
+class ServeStats:
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.batches = 0
+        self.tokens = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.latencies: deque = deque(maxlen=window)
+        self.queue_waits: deque = deque(maxlen=window)
+        self.adapter_requests: Counter = Counter()
+
+    def record_batch(
+        self,
+        n_tokens: int,
+        seconds: float,
+        latencies: List[float],
+        queue_waits: List[float],
+        adapters: List[str],
+    ):
+        with self.lock:
+            self.requests += len(latencies)
+            self.adapter_requests.update(adapters)
+            self.batches += 1
+            self.tokens += n_tokens
+            self.busy_seconds += seconds
+            self.latencies.extend(latencies)
+            self.queue_waits.extend(queue_waits)
+
+    def record_error(self, n_requests: int):
+        with self.lock:
+            self.errors += n_requests
+
+    @staticmethod
+    def _percentile(values: List[float], q: float) -> float:
+        if not values:
+            return 0.0
+        values = sorted(values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            elapsed = time.perf_counter() - self.started
+            latencies = list(self.latencies)
+            waits = list(self.queue_waits)
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "batches": self.batches,
+                "avg_batch_size": self.requests / self.batches if self.batches else 0.0,
+                "generated_tokens": self.tokens,
+                "requests_per_sec": self.requests / elapsed,
+                "tokens_per_sec": self.tokens / elapsed,
+                "busy_tokens_per_sec": self.tokens / self.busy_seconds if self.busy_seconds else 0.0,
+                "latency_ms_p50": 1000 * self._percentile(latencies, 0.50),
+                "latency_ms_p95": 1000 * self._percentile(latencies, 0.95),
+                "latency_ms_p99": 1000 * self._percentile(latencies, 0.99),
+                "queue_wait_ms_avg": 1000 * sum(waits) / len(waits) if waits else 0.0,
+                "adapter_requests": dict(self.adapter_requests),
+            }
+
+
+@dataclass
+class _Request:
+    prompt: str
+    max_new_tokens: int
+    adapter: str
+    prefix_chars: int
+    schema: Optional[str]
+    future: Future
+    enqueued: float
+
+
+_STOP = object()
+
+
+class DynamicBatcher:
+    def __init__(
+        self,
+        generator: LoraGenerator,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_wait_ms: float = MAX_WAIT_MS,
+    ):
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = ServeStats()
+        self.queue: "queue.Queue" = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(
+        self,
+        prompt: str,
+        max_new_tokens: int = MAX_NEW_TOKENS,
+        adapter: Optional[str] = None,
+        prefix_chars: int = 0,
+        schema: Optional[str] = None,
+    ) -> Future:
+        future: Future = Future()
+        adapter = adapter or self.generator.default_adapter
+        if adapter not in self.generator.adapters:
+            future.set_exception(KeyError(f"未知的 adapter：{adapter}"))
+            return future
+        if schema is not None and schema not in self.generator.schemas:
+            future.set_exception(KeyError(f"未知的 schema：{schema}"))
+            return future
+        limit = MAX_NEW_TOKENS if schema is None else CONSTRAINED_MAX_NEW_TOKENS
+        n = max(1, min(max_new_tokens, limit))
+        self.queue.put(_Request(prompt, n, adapter, prefix_chars, schema, future, time.perf_counter()))
+        return future
+
+    def close(self):
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def _next_batch(self) -> List[_Request]:
+        first = self.queue.get()
+        if first is _STOP:
+            return []
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                # 這批做完再停
+                self.queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+
+            start = time.perf_counter()
+            try:
+                results = self.generator.generate(
+                    [r.prompt for r in batch],
+                    [r.max_new_tokens for r in batch],
+                    [r.adapter for r in batch],
+                    [r.prefix_chars for r in batch],
+                    [r.schema for r in batch],
+                )
+            except Exception as e:
+                self.stats.record_error(len(batch))
+                for r in batch:
+                    r.future.set_exception(e)
+                continue
+            done = time.perf_counter()
+
+            # 先記統計再回覆，client 收到結果後查 /stats 一定看得到這一批
+            self.stats.record_batch(
+                sum(n for _, n in results),
+                done - start,
+                [done - r.enqueued for r in batch],
+                [start - r.enqueued for r in batch],
+                [r.adapter for r in batch],
+            )
+            for r, (text, n_tokens) in zip(batch, results):
+                r.future.set_result({
+                    "output": text,
+                    "tokens": n_tokens,
+                    "latency_ms": 1000 * (done - r.enqueued),
+                })
+
+
+def make_handler(batcher: DynamicBatcher, expander: Optional[DietExpander] = None):
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, body: Dict[str, Any]):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send_json(200, {
+                    **batcher.stats.snapshot(),
+                    "adapters": batcher.generator.adapter_stats(),
+                    "prefix_cache": batcher.generator.prefix_stats(),
+                    "constrained": batcher.generator.constraint_stats(),
+                })
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/generate":
+                self._send_json(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                req = json.loads(self.rfile.read(length) or b"{}")
+                prompt = build_prompt({"instruction": req["instruction"], "input": req.get("input", "")})
+                prefix_chars = len(build_prefix(req["instruction"]))
+                adapter = req.get("adapter") or batcher.generator.default_adapter
+                schema = req.get("schema")
+                if schema is None and req.get("constrained", True):
+                    schema = batcher.generator.schema_for(req["instruction"])
+                default_tokens = MAX_NEW_TOKENS if schema is None else CONSTRAINED_MAX_NEW_TOKENS
+                max_new_tokens = int(req.get("max_new_tokens", default_tokens))
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {"error": f"請求格式錯誤：{e}"})
+                return
+            if adapter not in batcher.generator.adapters:
+                self._send_json(400, {
+                    "error": f"未知的 adapter：{adapter}",
+                    "available": sorted(batcher.generator.adapters),
+                })
+                return
+            if schema is not None and schema not in batcher.generator.schemas:
+                self._send_json(400, {
+                    "error": f"未知的 schema：{schema}",
+                    "available": sorted(batcher.generator.schemas),
+                })
+                return
+
+            future = batcher.submit(prompt, max_new_tokens, adapter, prefix_chars, schema)
+            try:
+                result = future.result()
+                if expander is not None:
+                    result = expand_output(expander, result, req.get("input", ""))
+                self._send_json(200, result)
+            except Exception as e:
+                self._send_json(500, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    generator = LoraGenerator(MODEL_ID, ADAPTERS, DEFAULT_ADAPTER, MAX_LOADED_ADAPTERS)
+    batcher = DynamicBatcher(generator)
+    expander = None
+    if EXPAND_COMPACT_OUTPUT and os.path.isdir(DIET_DB_DIR):
+        expander = DietExpander.load(DIET_DB_DIR)
+    server = ThreadingHTTPServer((HOST, PORT), make_handler(batcher, expander))
+    print(
+        f"LoRA 推論服務啟動：http://{HOST}:{PORT}（adapter：{', '.join(ADAPTERS)}，"
+        f"記憶體最多 {MAX_LOADED_ADAPTERS} 個，batch 上限 {MAX_BATCH_SIZE}）"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        print("服務統計：", json.dumps(batcher.stats.snapshot(), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
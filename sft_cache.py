@@ -0,0 +1,150 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Any, Callable, Iterator, List, Optional, Tuple
+
+# =========================================================
+# Tokenize 結果快取（Arrow / memory-mapped）
+# =========================================================
+#
+# 快取目錄結構：
+#   <CACHE_DIR>/<設定指紋>/<chunk 內容 hash>/   ← datasets.save_to_disk 的 Arrow shard
+#
+# - 設定指紋：tokenizer、SpecialTokens、max_length、tokenize_fn 原始碼等，
+#   任何一項改變都會換一個目錄，不會讀到過期結果。
+# - JSONL 依「內容」切 chunk（content-defined chunking）：某一行的 hash 命中
+#   邊界條件就切一刀，所以 merge_sft_datasets.py 追加資料或改動部分資料時，
+#   只有受影響的 chunk 需要重新 tokenize，其他 chunk 直接從快取 mmap 讀回。
+# - 沒命中的 chunk 累積到 MAX_PENDING_ROWS 筆再一起 map（num_proc 的行程池只開一次），
+#   完成後再依列範圍切回各個 chunk 存檔。
+
+CACHE_DIR = ".sft_cache"
+CHUNK_ROWS = 20000           # 平均每個 chunk 的行數
+MAX_CHUNK_ROWS = CHUNK_ROWS * 4
+MAX_PENDING_ROWS = 200_000   # 一次 map 最多幾筆（控制記憶體）
+
+
+def fingerprint(parts: Dict[str, Any]) -> str:
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    # fast tokenizer 直接 hash 整份 tokenizer.json；其他情況退回名稱 + 詞表大小
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        return hashlib.sha256(backend.to_str().encode("utf-8")).hexdigest()[:16]
+    return f"{tokenizer.name_or_path}:{len(tokenizer)}"
+
+
+def function_fingerprint(fn: Callable) -> str:
+    # tokenize_fn 內容改了快取就要失效；callable 物件看它的 class（設定值由呼叫端放進 config_parts）
+    if not inspect.isroutine(fn):
+        fn = type(fn)
+    try:
+        source = inspect.getsource(fn)
+    except (OSError, TypeError):
+        source = getattr(fn, "__qualname__", repr(fn))
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+
+def iter_jsonl_chunks(
+    path: str,
+    chunk_rows: int = CHUNK_ROWS,
+    max_chunk_rows: int = MAX_CHUNK_ROWS,
+) -> Iterator[Tuple[str, List[bytes]]]:
+    # 回傳 (chunk hash, 該 chunk 的原始行)；空行略過，不影響 hash
+    lines: List[bytes] = []
+    chunk_hash = hashlib.blake2b(digest_size=16)
+
+    with open(path, "rb") as f:
+        for raw in f:
+            line = raw.strip()
+            if not line:
+                continue
+            line_hash = hashlib.blake2b(line, digest_size=8).digest()
+            lines.append(line)
+            chunk_hash.update(line_hash)
+
+            at_boundary = int.from_bytes(line_hash, "little") % chunk_rows == 0
+            if at_boundary or len(lines) >= max_chunk_rows:
+                yield chunk_hash.hexdigest(), lines
+                lines = []
+                chunk_hash = hashlib.blake2b(digest_size=16)
+
+    if lines:
+        yield chunk_hash.hexdigest(), lines
+
+
+def _tokenize_chunks(
+    pending: List[Tuple[Path, List[bytes]]],
+    tokenize_fn: Callable,
+    map_kwargs: Dict[str, Any],
+):
+    # 多個 chunk 合成一個 Dataset 一起 map，再依列範圍切開，各自寫進自己的 shard 目錄
+    from datasets import Dataset
+    from sft_tokenize import resolve_num_proc
+
+    rows = [json.loads(line) for _, lines in pending for line in lines]
+    ds = Dataset.from_list(rows)
+    kwargs = dict(map_kwargs)
+    kwargs["num_proc"] = resolve_num_proc(kwargs.get("num_proc"), len(ds))
+    tokenized = ds.map(tokenize_fn, remove_columns=ds.column_names, **kwargs)
+
+    start = 0
+    for shard_dir, lines in pending:
+        part = tokenized.select(range(start, start + len(lines)))
+        start += len(lines)
+        tmp_dir = shard_dir.with_name(shard_dir.name + ".tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        part.save_to_disk(str(tmp_dir))
+        os.replace(tmp_dir, shard_dir)
+
+
+def load_tokenized(
+    data_path: str,
+    tokenize_fn: Callable,
+    config_parts: Dict[str, Any],
+    cache_dir: str = CACHE_DIR,
+    chunk_rows: int = CHUNK_ROWS,
+    map_kwargs: Optional[Dict[str, Any]] = None,
+):
+    # 取代 load_dataset(...) + dataset.map(tokenize_fn)：有快取就直接 mmap 讀回
+    from datasets import concatenate_datasets, load_from_disk
+
+    map_kwargs = map_kwargs or {}
+    parts = dict(config_parts)
+    parts["tokenize_fn"] = function_fingerprint(tokenize_fn)
+    parts["map_kwargs"] = {k: v for k, v in map_kwargs.items() if k != "num_proc"}
+    root = Path(cache_dir) / fingerprint(parts)
+    root.mkdir(parents=True, exist_ok=True)
+
+    shard_dirs: List[Path] = []
+    pending: List[Tuple[Path, List[bytes]]] = []
+    pending_rows = 0
+    hits = misses = 0
+    for chunk_hash, lines in iter_jsonl_chunks(data_path, chunk_rows, chunk_rows * 4):
+        shard_dir = root / chunk_hash
+        # 內容完全相同的 chunk 只需要 tokenize 一次
+        if (shard_dir / "dataset_info.json").exists() or shard_dir in shard_dirs:
+            hits += 1
+        else:
+            pending.append((shard_dir, lines))
+            pending_rows += len(lines)
+            misses += 1
+            if pending_rows >= MAX_PENDING_ROWS:
+                _tokenize_chunks(pending, tokenize_fn, map_kwargs)
+                pending, pending_rows = [], 0
+        shard_dirs.append(shard_dir)
+    if pending:
+        _tokenize_chunks(pending, tokenize_fn, map_kwargs)
+
+    shards = [load_from_disk(str(d)) for d in shard_dirs]
+
+    print(f"tokenize 快取：{root}，命中 {hits} 個 chunk，重新 tokenize {misses} 個 chunk")
+    if not shards:
+        raise ValueError(f"{data_path} 沒有任何資料")
+    return concatenate_datasets(shards) if len(shards) > 1 else shards[0]
@@ -0,0 +1,182 @@
+import copy
+import json
+import os
+import random
+import re
+import shutil
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Any, Optional
+
+import numpy as np
+import torch
+from peft import get_peft_model_state_dict
+from safetensors.torch import save_file
+from transformers import TrainerCallback
+
+# =========================================================
+# 非同步、只存 adapter 的 checkpoint，以及資料位置的續跑
+# =========================================================
+#
+# Trainer 內建的 checkpoint 在訓練 thread 上同步寫 adapter + optimizer（LoRA 參數的 2 倍）+ scheduler，
+# 大模型每次都要停下來等硬碟。這裡每 save_steps 步：
+#   1. 訓練 thread 上只做快照：LoRA 權重複製到 CPU、scheduler / RNG / TrainerState / sampler 狀態
+#   2. 背景 thread 寫進 checkpoint-N.tmp/，寫完改名成 checkpoint-N/（中斷時不會留下寫一半的 checkpoint），
+#      再刪掉超過 total_limit 的舊 checkpoint
+# 上一個還沒寫完又到下一次存檔時先等它寫完，記憶體裡最多一份快照。
+#
+# checkpoint 目錄和 Trainer 的格式相同（adapter_model.safetensors、scheduler.pt、rng_state.pth、
+# trainer_state.json），直接 trainer.train(resume_from_checkpoint=...) 續跑；多一個 data_state.json
+# 記錄 batch sampler 狀態，續跑前用 restore_data_state 檢查 batch 組成沒變。
+# 沒有 optimizer.pt：續跑時 Adam 的動量重新累積（LoRA 微調影響很小），學習率排程照常接續。
+
+ADAPTER_WEIGHTS = "adapter_model.safetensors"
+SCHEDULER_FILE = "scheduler.pt"
+RNG_FILE = "rng_state.pth"
+TRAINER_STATE_FILE = "trainer_state.json"
+DATA_STATE_FILE = "data_state.json"
+
+_CHECKPOINT_RE = re.compile(r"^checkpoint-(\d+)$")
+
+
+def list_checkpoints(output_dir: str) -> Dict[int, str]:
+    # step → 目錄；寫到一半的 checkpoint-N.tmp 不算
+    if not os.path.isdir(output_dir):
+        return {}
+    found = {}
+    for name in os.listdir(output_dir):
+        m = _CHECKPOINT_RE.match(name)
+        path = os.path.join(output_dir, name)
+        if m and os.path.isfile(os.path.join(path, TRAINER_STATE_FILE)):
+            found[int(m.group(1))] = path
+    return dict(sorted(found.items()))
+
+
+def latest_checkpoint(output_dir: str) -> Optional[str]:
+    checkpoints = list_checkpoints(output_dir)
+    return checkpoints[max(checkpoints)] if checkpoints else None
+
+
+def rng_snapshot() -> Dict[str, Any]:
+    # 和 Trainer._save_rng_state 相同的格式，續跑時 Trainer 會自己載回去
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "cpu": torch.random.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.random.get_rng_state_all()
+    return state
+
+
+def restore_data_state(checkpoint_dir: str, batch_sampler) -> Optional[Dict[str, Any]]:
+    # 續跑前呼叫：batch sampler 設定和 checkpoint 不同就報錯，相同則回到存檔時的 epoch。
+    # batch 位置由 Trainer 依 global_step 換算，在 index 層級跳過，不會重新讀資料
+    path = os.path.join(checkpoint_dir, DATA_STATE_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        data_state = json.load(f)
+    saved = data_state.get("sampler")
+    if (saved is None) != (batch_sampler is None):
+        raise ValueError(f"{checkpoint_dir} 的批次策略和目前設定不同，無法從同一個資料位置續跑")
+    if batch_sampler is not None:
+        batch_sampler.load_state_dict(saved)
+    return data_state
+
+
+class AsyncCheckpointCallback(TrainerCallback):
+    def __init__(
+        self,
+        output_dir: str,
+        save_steps: int,
+        total_limit: Optional[int] = None,
+        batch_sampler=None,
+    ):
+        self.output_dir = output_dir
+        self.save_steps = save_steps
+        self.total_limit = total_limit
+        self.batch_sampler = batch_sampler
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self._pending: Optional[Future] = None
+        self.stall_seconds = 0.0     # 訓練 thread 被 checkpoint 擋住的時間（快照 + 等上一次寫完）
+        self.write_seconds = 0.0
+
+    @property
+    def snapshot_seconds(self) -> float:
+        # 舊名稱，留著讓讀這個欄位的程式不會壞
+        return self.stall_seconds
+
+    def on_step_end(self, args, state, control, model=None, lr_scheduler=None, **kwargs):
+        if state.global_step % self.save_steps == 0:
+            self.save(args, state, model, lr_scheduler)
+        return control
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.wait()
+        self._executor.shutdown()
+        return control
+
+    def wait(self):
+        # 等背景寫完；寫入失敗的例外在這裡丟出來
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def save(self, args, state, model, lr_scheduler):
+        if not state.is_world_process_zero:
+            return
+        start = time.perf_counter()
+        self.wait()
+
+        adapter = model.active_adapter
+        weights = {
+            k: v.detach().to("cpu", copy=True).contiguous()
+            for k, v in get_peft_model_state_dict(model, adapter_name=adapter).items()
+        }
+        data_state = {
+            "global_step": state.global_step,
+            "num_train_epochs": args.num_train_epochs,
+            "gradient_accumulation_steps": args.gradient_accumulation_steps,
+            "sampler": None if self.batch_sampler is None else self.batch_sampler.state_dict(),
+        }
+        snapshot = {
+            "weights": weights,
+            "peft_config": model.peft_config[adapter],
+            "scheduler": copy.deepcopy(lr_scheduler.state_dict()) if lr_scheduler is not None else None,
+            "rng": rng_snapshot(),
+            "trainer_state": copy.deepcopy(state),
+            "data_state": data_state,
+        }
+        self.stall_seconds += time.perf_counter() - start
+
+        ckpt_dir = os.path.join(self.output_dir, f"checkpoint-{state.global_step}")
+        self._pending = self._executor.submit(self._write, ckpt_dir, snapshot)
+
+    def _write(self, ckpt_dir: str, snapshot: Dict[str, Any]):
+        start = time.perf_counter()
+        tmp_dir = ckpt_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        save_file(snapshot["weights"], os.path.join(tmp_dir, ADAPTER_WEIGHTS), metadata={"format": "pt"})
+        snapshot["peft_config"].save_pretrained(tmp_dir)
+        if snapshot["scheduler"] is not None:
+            torch.save(snapshot["scheduler"], os.path.join(tmp_dir, SCHEDULER_FILE))
+        torch.save(snapshot["rng"], os.path.join(tmp_dir, RNG_FILE))
+        with open(os.path.join(tmp_dir, DATA_STATE_FILE), "w", encoding="utf-8") as f:
+            json.dump(snapshot["data_state"], f, ensure_ascii=False, indent=2)
+        # trainer_state.json 最後寫：list_checkpoints 以它判斷 checkpoint 是否完整
+        snapshot["trainer_state"].save_to_json(os.path.join(tmp_dir, TRAINER_STATE_FILE))
+
+        shutil.rmtree(ckpt_dir, ignore_errors=True)
+        os.replace(tmp_dir, ckpt_dir)
+        self._rotate()
+        self.write_seconds += time.perf_counter() - start
+
+    def _rotate(self):
+        if not self.total_limit:
+            return
+        checkpoints = list(list_checkpoints(self.output_dir).values())
+        for path in checkpoints[: max(0, len(checkpoints) - self.total_limit)]:
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,262 @@
+import json
+import os
+import platform
+import time
+from collections import deque
+from typing import Dict, Any, List, Optional
+
+import torch
+from transformers import TrainerCallback
+
+# =========================================================
+# 每步訓練指標：真實 token 吞吐量、pad 比例、時間拆解、記憶體、checkpoint 延遲
+# =========================================================
+#
+# 每個 optimizer step 寫一行 JSON 到 path（JSONL），訓練結束時再加一行 {"summary": {...}} 並印出摘要。
+# 一步的時間拆成：
+#   data_wait_s    上一步結束（扣掉 checkpoint）到這一步開始：等 dataloader 取資料 / collate（也含 log）
+#   compute_s      這一步所有 micro batch 的 forward + backward（含梯度裁剪）
+#   optimizer_s    optimizer.step + scheduler + zero_grad
+#   checkpoint_s   這一步之後訓練被 checkpoint 擋住的時間（Trainer 內建的同步存檔，
+#                  或 sft_checkpoint.AsyncCheckpointCallback 的快照 + 等上一次寫完）
+# GPU 上每個分界點都會 synchronize，時間才對得上（會損失一點點重疊）。
+#
+# token 數由 watch_trainer 包住的 Trainer.training_step 在主行程計算（每個 micro batch 一次），
+# dataloader_num_workers > 0（例如串流模式）collate 在子行程執行也照樣算得到；
+# 一般 batch 用 attention_mask，packing 的 block 用 position_ids（結尾補的 pad 之前都算真實 token）。
+# 搭配 AsyncCheckpointCallback 時，callbacks 裡這個要排在它前面，快照時間才會算進 checkpoint_s。
+
+IGNORE_INDEX = -100
+
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:   # Windows 沒有 resource
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 單位是 KB，macOS 是 bytes
+    return peak / 2**20 if platform.system() == "Darwin" else peak / 2**10
+
+
+def batch_token_counts(batch: Dict[str, Any]) -> Dict[str, int]:
+    input_ids = batch["input_ids"]
+    total = input_ids.numel()
+    mask = batch.get("attention_mask")
+    if mask is not None and mask.dim() == 2:
+        real = int(mask.sum())
+    elif "position_ids" in batch:
+        # packing：pad 都補在 block 結尾且 position_ids 為 0，最後一個 position > 0 的位置之前都是真實 token
+        positions = batch["position_ids"]
+        idx = torch.arange(positions.shape[-1], device=positions.device).expand_as(positions)
+        real = int(torch.where(positions > 0, idx + 1, 0).max(dim=-1).values.sum())
+    else:
+        real = total
+    labels = batch.get("labels")
+    trained = int((labels != IGNORE_INDEX).sum()) if labels is not None else real
+    return {"tokens": total, "real_tokens": real, "label_tokens": trained}
+
+
+class TrainMetricsCallback(TrainerCallback):
+    def __init__(self, path: str, checkpointer=None, sync_cuda: bool = True):
+        self.path = path
+        self.checkpointer = checkpointer
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self._counts: deque = deque()
+        self._records: List[Dict[str, Any]] = []
+        self._current: Optional[Dict[str, Any]] = None
+        self._last: Optional[Dict[str, Any]] = None
+        self._micro_batches = 0
+        self._stall_seen = 0.0
+        self._mark = 0.0
+        self._train_start = 0.0
+        self._file = None
+
+    def watch_trainer(self, trainer):
+        training_step = trainer.training_step
+
+        def counting_step(model, inputs, *args, **kwargs):
+            self._counts.append(batch_token_counts(inputs))
+            return training_step(model, inputs, *args, **kwargs)
+
+        trainer.training_step = counting_step
+        return trainer
+
+    def _now(self) -> float:
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _checkpoint_stall(self) -> float:
+        if self.checkpointer is None:
+            return 0.0
+        stall = self.checkpointer.stall_seconds - self._stall_seen
+        self._stall_seen = self.checkpointer.stall_seconds
+        return stall
+
+    # ---------------------------------------------------------
+    # Trainer callback
+    # ---------------------------------------------------------
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        if state.is_world_process_zero:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        if self.checkpointer is not None:
+            self._stall_seen = self.checkpointer.stall_seconds
+        self._train_start = self._mark = self._now()
+        return control
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        now = self._now()
+        checkpoint = self._finish_last()
+        if self.sync_cuda:
+            torch.cuda.reset_peak_memory_stats()
+        self._current = {
+            "step": state.global_step + 1,
+            "data_wait_s": max(0.0, now - self._mark - checkpoint),
+            "_begin": now,
+        }
+        self._micro_batches = 1
+        return control
+
+    def on_substep_end(self, args, state, control, **kwargs):
+        self._micro_batches += 1
+        return control
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        if self._current is not None:
+            self._current["_pre_optimizer"] = self._now()
+        return control
+
+    def on_step_end(self, args, state, control, **kwargs):
+        rec = self._current
+        if rec is None:
+            return control
+        now = self._now()
+        begin = rec.pop("_begin")
+        pre_optimizer = rec.pop("_pre_optimizer", now)
+        rec["epoch"] = round(state.epoch or 0.0, 4)
+        rec["compute_s"] = pre_optimizer - begin
+        rec["optimizer_s"] = now - pre_optimizer
+        rec["step_s"] = rec["data_wait_s"] + rec["compute_s"] + rec["optimizer_s"]
+        rec["micro_batches"] = self._micro_batches
+
+        counts = [self._counts.popleft() for _ in range(min(self._micro_batches, len(self._counts)))]
+        if counts:
+            tokens = sum(c["tokens"] for c in counts)
+            real = sum(c["real_tokens"] for c in counts)
+            rec["tokens"] = tokens
+            rec["real_tokens"] = real
+            rec["label_tokens"] = sum(c["label_tokens"] for c in counts)
+            rec["pad_fraction"] = 1 - real / tokens if tokens else 0.0
+            rec["tokens_per_s"] = real / rec["step_s"] if rec["step_s"] > 0 else 0.0
+        if self.sync_cuda:
+            rec["gpu_peak_mb"] = torch.cuda.max_memory_allocated() / 2**20
+        rec["rss_peak_mb"] = _peak_rss_mb()
+        rec["checkpoint_s"] = 0.0
+
+        self._current = None
+        self._last = rec
+        self._mark = now
+        return control
+
+    def on_save(self, args, state, control, **kwargs):
+        # Trainer 內建的 checkpoint：on_step_end 之後同步存檔，存完才呼叫 on_save
+        if self._last is not None:
+            now = self._now()
+            self._last["checkpoint_s"] += now - self._mark
+            self._mark = now
+        return control
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if self._last is not None and logs:
+            for key in ("loss", "learning_rate", "grad_norm"):
+                if key in logs:
+                    self._last[key] = logs[key]
+        return control
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self._finish_last()
+        if self.checkpointer is not None:
+            # 等最後一個 checkpoint 寫完，摘要裡的背景寫入時間才完整
+            self.checkpointer.wait()
+        summary = self.summary(self._now() - self._train_start)
+        if self._file is not None:
+            self._file.write(json.dumps({"summary": summary}, ensure_ascii=False) + "\n")
+            self._file.close()
+            self._file = None
+            print_summary(summary, self.path)
+        return control
+
+    def _finish_last(self) -> float:
+        # 上一步的 checkpoint 時間要等到下一步開始（或訓練結束）才知道，到那時才寫出去
+        stall = self._checkpoint_stall()
+        rec, self._last = self._last, None
+        if rec is None:
+            return stall
+        rec["checkpoint_s"] += stall
+        self._records.append(rec)
+        if self._file is not None:
+            self._file.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self._file.flush()
+        return stall
+
+    # ---------------------------------------------------------
+    # 摘要
+    # ---------------------------------------------------------
+
+    def summary(self, wall_s: float) -> Dict[str, Any]:
+        records = self._records
+        totals = {
+            key: sum(r[key] for r in records)
+            for key in ("data_wait_s", "compute_s", "optimizer_s", "checkpoint_s")
+        }
+        real = sum(r.get("real_tokens", 0) for r in records)
+        tokens = sum(r.get("tokens", 0) for r in records)
+        checkpoints = [r["checkpoint_s"] for r in records if r["checkpoint_s"] > 0]
+        gpu_peaks = [r["gpu_peak_mb"] for r in records if "gpu_peak_mb" in r]
+
+        summary: Dict[str, Any] = {
+            "steps": len(records),
+            "wall_s": wall_s,
+            "real_tokens": real,
+            "tokens": tokens,
+            "pad_fraction": 1 - real / tokens if tokens else 0.0,
+            "tokens_per_s": real / wall_s if wall_s > 0 else 0.0,
+            "time_s": totals,
+            "time_share": {key: value / wall_s if wall_s > 0 else 0.0 for key, value in totals.items()},
+            "bottleneck": max(totals, key=totals.get)[: -len("_s")] if records else None,
+            "checkpoints": len(checkpoints),
+            "checkpoint_mean_s": sum(checkpoints) / len(checkpoints) if checkpoints else 0.0,
+            "checkpoint_max_s": max(checkpoints, default=0.0),
+            "gpu_peak_mb": max(gpu_peaks, default=None),
+            "rss_peak_mb": _peak_rss_mb(),
+        }
+        if self.checkpointer is not None:
+            summary["checkpoint_background_write_s"] = self.checkpointer.write_seconds
+        return summary
+
+
+def print_summary(summary: Dict[str, Any], path: str):
+    share = summary["time_share"]
+    print(
+        f"訓練指標（{path}）：{summary['steps']} 步，{summary['wall_s']:.1f}s，"
+        f"真實 token {summary['real_tokens']}（{summary['tokens_per_s']:.0f} tokens/s），"
+        f"pad 比例 {summary['pad_fraction']:.1%}"
+    )
+    print(
+        f"  時間佔比：等資料 {share['data_wait_s']:.1%}、forward/backward {share['compute_s']:.1%}、"
+        f"optimizer {share['optimizer_s']:.1%}、checkpoint {share['checkpoint_s']:.1%}"
+        f"（瓶頸：{summary['bottleneck']}）"
+    )
+    if summary["checkpoints"]:
+        print(
+            f"  checkpoint {summary['checkpoints']} 次，平均擋住訓練 {summary['checkpoint_mean_s']:.2f}s，"
+            f"最久 {summary['checkpoint_max_s']:.2f}s"
+        )
+    memory = [f"RSS {summary['rss_peak_mb']:.0f} MB"] if summary["rss_peak_mb"] is not None else []
+    if summary["gpu_peak_mb"] is not None:
+        memory.insert(0, f"GPU {summary['gpu_peak_mb']:.0f} MB")
+    if memory:
+        print(f"  記憶體峰值：{'，'.join(memory)}")
@@ -0,0 +1,96 @@
+import glob
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+# =========================================================
+# 多來源依權重交錯混合
+# =========================================================
+#
+# 原本 merge_sft_datasets.py 依序串接 diet → biz → brand，訓練看到的順序是整段整段的，
+# 想改比例也得重新產生 all_sft.jsonl。這裡讓訓練端直接讀各來源 JSONL
+# （各自走 tokenize 快取），再用 datasets.interleave_datasets 依機率交錯：
+# 改比例只是換一組 index mapping，不用重寫任何檔案。
+#
+# 預設 stopping_strategy="all_exhausted"：每個來源的每一筆都至少用到一次，權重和資料量不成比例時
+# 靠重複取樣小來源補足比例。"first_exhausted" 任一來源取完就停，比例最準、不重複，
+# 但其他來源剩下的列整批被丟掉。兩種都會印出每個來源實際取樣幾次、有幾筆沒用到。
+
+STOPPING_STRATEGIES = ("all_exhausted", "first_exhausted")
+SOURCE_COLUMN = "_mix_source"
+
+
+@dataclass
+class MixSource:
+    name: str
+    pattern: str                     # JSONL 路徑，支援 glob（分片）
+    weight: Optional[float] = None   # None：依資料筆數
+    max_rows: Optional[int] = None   # 此來源最多取幾筆
+
+
+def source_paths(source: MixSource) -> List[str]:
+    paths = sorted(glob.glob(source.pattern))
+    if not paths:
+        raise FileNotFoundError(f"混合來源 {source.name} 找不到檔案：{source.pattern}")
+    return paths
+
+
+def mixture_probabilities(weights: List[float], temperature: float = 1.0) -> List[float]:
+    # temperature sampling：p_i ∝ w_i^(1/T)；T > 1 讓小來源比例變大，T = 1 就是原始權重
+    if temperature <= 0:
+        raise ValueError("temperature 必須大於 0")
+    scaled = [w ** (1.0 / temperature) if w > 0 else 0.0 for w in weights]
+    total = sum(scaled)
+    if total <= 0:
+        raise ValueError("混合權重總和必須大於 0")
+    return [s / total for s in scaled]
+
+
+def load_mixture(
+    sources: List[MixSource],
+    load_path: Callable[[str], Any],
+    temperature: float = 1.0,
+    seed: int = 42,
+    stopping_strategy: str = "all_exhausted",
+):
+    # load_path(path) 回傳單一 JSONL 檔 tokenize 後的 datasets.Dataset
+    import numpy as np
+    from datasets import concatenate_datasets, interleave_datasets
+
+    if stopping_strategy not in STOPPING_STRATEGIES:
+        raise ValueError(f"stopping_strategy 只能是 {STOPPING_STRATEGIES}，收到 {stopping_strategy!r}")
+
+    datasets = []
+    for source in sources:
+        parts = [load_path(path) for path in source_paths(source)]
+        ds = concatenate_datasets(parts) if len(parts) > 1 else parts[0]
+        if source.max_rows is not None and len(ds) > source.max_rows:
+            ds = ds.shuffle(seed=seed).select(range(source.max_rows))
+        datasets.append(ds)
+
+    weights = [
+        float(len(ds)) if source.weight is None else source.weight
+        for source, ds in zip(sources, datasets)
+    ]
+    probabilities = mixture_probabilities(weights, temperature)
+
+    # 每列標上來源編號，混合後才數得出各來源實際取了幾次
+    tagged = [ds.add_column(SOURCE_COLUMN, [i] * len(ds)) for i, ds in enumerate(datasets)]
+    mixed = interleave_datasets(
+        tagged,
+        probabilities=probabilities,
+        seed=seed,
+        stopping_strategy=stopping_strategy,
+    )
+    counts = np.bincount(mixed.with_format("numpy")[SOURCE_COLUMN], minlength=len(datasets))
+    mixed = mixed.remove_columns(SOURCE_COLUMN)
+
+    summary: Dict[str, str] = {}
+    unused_total = 0
+    for source, ds, p, used in zip(sources, datasets, probabilities, counts):
+        unused = max(len(ds) - int(used), 0)
+        unused_total += unused
+        summary[source.name] = f"{len(ds)} 筆 / p={p:.2f} / 取樣 {int(used)} 次 / 未用到 {unused} 筆"
+    print(f"混合資料來源（{stopping_strategy}）：{summary}，混合後 {len(mixed)} 筆")
+    if unused_total:
+        print(f"注意：有 {unused_total} 筆樣本這一輪沒用到（權重和資料量不成比例），可改用 all_exhausted 或調整權重")
+    return mixed
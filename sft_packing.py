@@ -0,0 +1,138 @@
+from dataclasses import dataclass
+from typing import Dict, Any, List, Optional
+
+# =========================================================
+# Sequence packing：把多筆 tokenize 後的樣本塞進固定長度 block
+# =========================================================
+#
+# 每個 block 內的文件邊界用 position_ids 重新從 0 開始標記，
+# collator 再依 position_ids 組出 block-diagonal 的因果 attention mask，
+# 同一個 block 裡的不同樣本彼此看不到（沒有跨樣本污染）。
+# 若模型使用 flash_attention_2，transformers 會直接從 position_ids
+# 判斷文件邊界（varlen），此時不需要 4D mask。
+
+IGNORE_INDEX = -100
+
+
+def _first_fit_decreasing(lengths: List[int], block_size: int) -> List[List[int]]:
+    # 由長到短放進第一個放得下的 block，回傳每個 block 內的樣本 index
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    blocks: List[List[int]] = []
+    free: List[int] = []
+
+    for i in order:
+        n = lengths[i]
+        for b, space in enumerate(free):
+            if n <= space:
+                blocks[b].append(i)
+                free[b] -= n
+                break
+        else:
+            blocks.append([i])
+            free.append(block_size - n)
+
+    # block 內維持原本順序，讓結果只和輸入有關
+    for block in blocks:
+        block.sort()
+    return blocks
+
+
+def pack_examples(
+    batch: Dict[str, List[List[int]]],
+    block_size: int,
+    pad_token_id: int,
+) -> Dict[str, List[List[int]]]:
+    # 給 dataset.map(batched=True) 用：輸入 input_ids / labels，輸出打包後的 block
+    all_input_ids = batch["input_ids"]
+    all_labels = batch.get("labels") or all_input_ids
+
+    # 超過 block_size 的樣本直接截斷（tokenize 時通常已經截過）
+    lengths = [min(len(ids), block_size) for ids in all_input_ids]
+    packed: Dict[str, List[List[int]]] = {
+        "input_ids": [],
+        "labels": [],
+        "position_ids": [],
+        "length": [],
+    }
+
+    for block in _first_fit_decreasing(lengths, block_size):
+        input_ids: List[int] = []
+        labels: List[int] = []
+        position_ids: List[int] = []
+
+        for i in block:
+            n = lengths[i]
+            input_ids.extend(all_input_ids[i][:n])
+            doc_labels = list(all_labels[i][:n])
+            # 文件第一個 token 不能拿前一個文件的最後一個 token 來預測
+            doc_labels[0] = IGNORE_INDEX
+            labels.extend(doc_labels)
+            position_ids.extend(range(n))
+
+        used = len(input_ids)
+        pad = block_size - used
+        # padding 的 position_ids 全部是 0：每個 pad token 自成一個文件，不會被其他 token 看到
+        input_ids.extend([pad_token_id] * pad)
+        labels.extend([IGNORE_INDEX] * pad)
+        position_ids.extend([0] * pad)
+
+        packed["input_ids"].append(input_ids)
+        packed["labels"].append(labels)
+        packed["position_ids"].append(position_ids)
+        packed["length"].append(used)
+
+    return packed
+
+
+def pack_dataset(dataset, block_size: int, pad_token_id: int, batch_size: int = 1000):
+    # 對 tokenize 後的 datasets.Dataset 做打包；batch_size 越大 block 填得越滿
+    return dataset.map(
+        pack_examples,
+        batched=True,
+        batch_size=batch_size,
+        fn_kwargs={"block_size": block_size, "pad_token_id": pad_token_id},
+        remove_columns=dataset.column_names,
+    )
+
+
+def packing_efficiency(packed) -> float:
+    # 真實 token 佔全部 block token 的比例
+    lengths = packed["length"]
+    if not lengths:
+        return 0.0
+    block_size = len(packed[0]["input_ids"])
+    return sum(lengths) / (len(lengths) * block_size)
+
+
+def block_diagonal_causal_mask(position_ids, dtype):
+    import torch
+
+    # position_ids == 0 的地方是新文件的開頭，累加後得到每個 token 所屬的文件編號
+    doc_ids = torch.cumsum(position_ids == 0, dim=-1)
+    same_doc = doc_ids[:, :, None] == doc_ids[:, None, :]
+    seq_len = position_ids.shape[-1]
+    causal = torch.ones(seq_len, seq_len, dtype=torch.bool, device=position_ids.device).tril()
+    allowed = same_doc & causal
+
+    # transformers 對 4D mask 的約定：已經是「加到 attention score 上」的形式
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=position_ids.device)
+    mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+    return mask[:, None, :, :]
+
+
+@dataclass
+class PackedDataCollator:
+    # mask_dtype=None 表示不產生 4D mask（flash_attention_2 直接吃 position_ids）
+    mask_dtype: Optional[Any] = None
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, Any]:
+        import torch
+
+        batch = {
+            "input_ids": torch.tensor([f["input_ids"] for f in features], dtype=torch.long),
+            "labels": torch.tensor([f["labels"] for f in features], dtype=torch.long),
+            "position_ids": torch.tensor([f["position_ids"] for f in features], dtype=torch.long),
+        }
+        if self.mask_dtype is not None:
+            batch["attention_mask"] = block_diagonal_causal_mask(batch["position_ids"], self.mask_dtype)
+        return batch
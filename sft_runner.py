@@ -0,0 +1,97 @@
+import json
+import os
+import random
+import time
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+# =========================================================
+# make_*_sft 共用的平行 / 分片產生器
+# =========================================================
+#
+# - 每個 shard 由一個 worker 產生並直接寫自己的檔案（diet_sft-00000-of-00016.jsonl）
+# - 每個 shard 的亂數種子只由 (seed, shard 編號) 決定，和 worker 數量無關，
+#   所以同樣的 SEED / NUM_SHARDS 不管用幾核心跑，產出都一模一樣
+# - 產生器沿用 global random，這裡在 worker 裡對它重新 seed
+# - Windows 預設用 spawn 啟動子行程：make_row / initializer 必須是模組層級的函數
+
+WRITE_BATCH = 1000
+
+
+def shard_path(out_path: str, shard: int, num_shards: int) -> str:
+    if num_shards == 1:
+        return out_path
+    p = Path(out_path)
+    return str(p.with_name(f"{p.stem}-{shard:05d}-of-{num_shards:05d}{p.suffix}"))
+
+
+def shard_sizes(n_rows: int, num_shards: int) -> List[int]:
+    base, extra = divmod(n_rows, num_shards)
+    return [base + (1 if i < extra else 0) for i in range(num_shards)]
+
+
+def _write_shard(task: Tuple[Callable[[], Dict[str, Any]], str, int, int, int]) -> Tuple[int, int]:
+    make_row, path, seed, shard, n_rows = task
+    random.seed(f"{seed}-{shard}")
+
+    written = 0
+    n_bytes = 0
+    with open(path, "wb") as f:
+        buf: List[str] = []
+        for i in range(n_rows):
+            buf.append(json.dumps(make_row(), ensure_ascii=False) + "\n")
+            if len(buf) >= WRITE_BATCH or i == n_rows - 1:
+                data = "".join(buf).encode("utf-8")
+                f.write(data)
+                n_bytes += len(data)
+                written += len(buf)
+                buf = []
+    return written, n_bytes
+
+
+def run_sharded(
+    make_row: Callable[[], Dict[str, Any]],
+    n_rows: int,
+    out_path: str,
+    num_shards: int = 1,
+    num_workers: Optional[int] = None,
+    seed: int = 0,
+    initializer: Optional[Callable] = None,
+    initargs: tuple = (),
+) -> Dict[str, Any]:
+    num_workers = min(num_workers or os.cpu_count() or 1, num_shards)
+    paths = [shard_path(out_path, i, num_shards) for i in range(num_shards)]
+    tasks = [
+        (make_row, paths[i], seed, i, n)
+        for i, n in enumerate(shard_sizes(n_rows, num_shards))
+    ]
+
+    start = time.perf_counter()
+    if num_workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        results = [_write_shard(t) for t in tasks]
+    else:
+        with Pool(num_workers, initializer=initializer, initargs=initargs) as pool:
+            results = list(pool.imap_unordered(_write_shard, tasks))
+    elapsed = time.perf_counter() - start
+
+    rows = sum(r for r, _ in results)
+    return {
+        "rows": rows,
+        "bytes": sum(b for _, b in results),
+        "seconds": elapsed,
+        "rows_per_sec": rows / elapsed if elapsed > 0 else float("inf"),
+        "paths": paths,
+        "num_workers": num_workers,
+    }
+
+
+def describe_output(stats: Dict[str, Any]) -> str:
+    paths = stats["paths"]
+    where = paths[0] if len(paths) == 1 else f"{paths[0]} … 等 {len(paths)} 個 shard"
+    return (
+        f"{where}（{stats['num_workers']} 個 worker，"
+        f"{stats['seconds']:.1f} 秒，{stats['rows_per_sec']:.0f} 筆/秒）"
+    )
@@ -0,0 +1,176 @@
+import hashlib
+import random
+from typing import Dict, Any, List, Optional, Iterator, Sequence
+
+import numpy as np
+
+# =========================================================
+# 依長度分桶、以 token 總量組 batch 的 batch sampler
+# =========================================================
+#
+# 長的飲食週菜單和短的品牌資料混在同一個 batch，padding 會吃掉大半算力。
+# 這裡先把樣本依長度排序，再以「batch 內最長長度 × 筆數 ≤ max_tokens」切 batch，
+# 短樣本一個 batch 可以塞很多筆、長樣本就少幾筆；每個 epoch 只打亂 batch 的順序。
+# batch 的組成固定，所以 len(sampler) 每個 epoch 都一樣，Trainer 算 step 數不會錯。
+#
+# 兩種 sampler 的順序都只由 seed + epoch 決定：從 checkpoint 續跑時 Trainer 只在 index 層級跳過
+# 已訓練的 batch（不讀資料），剩下的順序和沒中斷時完全相同。state_dict() 存進 checkpoint 的
+# data_state.json，load_state_dict() 續跑時檢查 batch 組成沒變。
+
+
+def token_budget_batches(
+    lengths: Sequence[int],
+    max_tokens: int,
+    max_batch_size: Optional[int] = None,
+    seed: int = 42,
+) -> List[List[int]]:
+    rng = random.Random(seed)
+    # 同長度的樣本用亂數打散，避免每次都是同一批鄰居
+    order = sorted(range(len(lengths)), key=lambda i: (lengths[i], rng.random()))
+
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    longest = 0
+    for i in order:
+        n = lengths[i]
+        new_longest = max(longest, n)
+        too_many_tokens = new_longest * (len(batch) + 1) > max_tokens
+        too_many_rows = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (too_many_tokens or too_many_rows):
+            batches.append(batch)
+            batch, new_longest = [], n
+        batch.append(i)
+        longest = new_longest
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def padding_ratio(lengths: Sequence[int], batches: Sequence[Sequence[int]]) -> float:
+    # padding token 佔全部 token（batch 內補齊到最長後）的比例
+    padded = real = 0
+    for batch in batches:
+        batch_lengths = [lengths[i] for i in batch]
+        padded += max(batch_lengths) * len(batch_lengths)
+        real += sum(batch_lengths)
+    return 1.0 - real / padded if padded else 0.0
+
+
+def sequential_batches(n_rows: int, batch_size: int) -> List[List[int]]:
+    # 對照組：不分桶、固定筆數的 batch
+    return [list(range(i, min(i + batch_size, n_rows))) for i in range(0, n_rows, batch_size)]
+
+
+def batch_plan_hash(batches: Sequence[Sequence[int]]) -> str:
+    # batch 組成的指紋：樣本 index 與每個 batch 的大小
+    h = hashlib.sha1()
+    h.update(np.array([len(b) for b in batches], dtype=np.int64).tobytes())
+    for b in batches:
+        h.update(np.asarray(b, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+def _check_state(own: Dict[str, Any], saved: Dict[str, Any]):
+    # epoch 以外的欄位都要相同，否則同一個 batch 位置對應到的是不同資料
+    diff = [k for k in own if k != "epoch" and saved.get(k) != own[k]]
+    if diff:
+        raise ValueError(
+            f"batch sampler 設定和 checkpoint 不同（{', '.join(diff)}），無法從同一個資料位置續跑；"
+            f"資料或批次設定有改的話請重新訓練"
+        )
+
+
+class TokenBudgetBatchSampler:
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        max_tokens: int,
+        max_batch_size: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 42,
+    ):
+        if max_tokens < max(lengths, default=0):
+            raise ValueError(f"max_tokens={max_tokens} 小於最長樣本長度 {max(lengths)}")
+        self.lengths = lengths
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.batches = token_budget_batches(lengths, max_tokens, max_batch_size, seed)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def padding_ratio(self) -> float:
+        return padding_ratio(self.lengths, self.batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        order = list(range(len(self.batches)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        for b in order:
+            yield self.batches[b]
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {
+            "type": "token_budget",
+            "seed": self.seed,
+            "shuffle": self.shuffle,
+            "num_batches": len(self.batches),
+            "plan": batch_plan_hash(self.batches),
+            "epoch": self.epoch,
+        }
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        _check_state(self.state_dict(), state)
+        self.epoch = state["epoch"]
+
+
+class ShuffledBatchSampler:
+    # 固定筆數的隨機 batch，取代 Trainer 預設的 RandomSampler（它的順序續跑後接不上）
+    def __init__(
+        self,
+        n_rows: int,
+        batch_size: int,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        seed: int = 42,
+    ):
+        self.n_rows = n_rows
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return self.n_rows // self.batch_size
+        return (self.n_rows + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self) -> Iterator[List[int]]:
+        order = list(range(self.n_rows))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        for b in range(len(self)):
+            yield order[b * self.batch_size : (b + 1) * self.batch_size]
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {
+            "type": "shuffled",
+            "seed": self.seed,
+            "shuffle": self.shuffle,
+            "n_rows": self.n_rows,
+            "batch_size": self.batch_size,
+            "drop_last": self.drop_last,
+            "epoch": self.epoch,
+        }
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        _check_state(self.state_dict(), state)
+        self.epoch = state["epoch"]
@@ -0,0 +1,144 @@
+import glob
+import json
+import random
+from typing import Dict, Any, Callable, Iterator, List, Optional
+
+from torch.utils.data import IterableDataset, get_worker_info
+
+from sft_packing import pack_examples
+from sft_tokenize import drop_response_lost_rows
+
+# =========================================================
+# 串流訓練資料：逐行讀 JSONL，邊讀邊 tokenize / packing，不先轉成 Arrow
+# =========================================================
+#
+# load_dataset("json") 要把整個檔案讀完、轉成 Arrow 才能開始訓練，資料越大越慢、也越佔磁碟。
+# 這裡每個 DataLoader worker 只讀分到的分片（分片比 worker 少時改成依行號輪流分），
+# 每 CHUNK_ROWS 行整批 tokenize（packing 時同一批內 first-fit 打包），
+# 再經過 shuffle buffer 打散後送出，訓練開始的時間和資料大小無關（第一步只等 buffer 裝滿）。
+#
+# 資料無限循環（每輪用 seed + epoch 重新排分片順序），訓練長度由 max_steps 決定。
+# 同樣的 seed / 分片 / worker 數產生同樣的順序；續跑時 Trainer 會把已訓練的 batch 讀過一遍再跳過，
+# 位置正確，但要花重讀那一段的時間。
+
+CHUNK_ROWS = 1000          # 一次 tokenize / packing 的行數（packing 時越大 block 填得越滿）
+SHUFFLE_BUFFER = 2_000     # 每個 worker 的 buffer 筆數（packing 時是 block 數）；越大越亂，第一步也等越久
+
+
+def expand_shards(patterns: List[str]) -> List[str]:
+    paths: List[str] = []
+    for pattern in patterns:
+        matched = sorted(glob.glob(pattern))
+        if not matched:
+            raise FileNotFoundError(f"找不到訓練資料：{pattern}")
+        paths.extend(p for p in matched if p not in paths)
+    return paths
+
+
+def has_rows(path: str) -> bool:
+    with open(path, "r", encoding="utf-8") as f:
+        return any(line.strip() for line in f)
+
+
+def shuffle_buffer(items: Iterator[Any], size: int, rng: random.Random) -> Iterator[Any]:
+    # 先裝滿 buffer，之後每進來一筆就隨機送出 buffer 裡的一筆；size <= 0 不打散
+    if size <= 0:
+        yield from items
+        return
+    buffer: List[Any] = []
+    for item in items:
+        if len(buffer) < size:
+            buffer.append(item)
+            continue
+        i = rng.randrange(size)
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class StreamingSFTDataset(IterableDataset):
+    # tokenize_fn：欄位 dict（instruction / input / output 各一個 list）→ tokenize 結果，
+    # 和 dataset.map(batched=True) 用的是同一個函式
+    def __init__(
+        self,
+        patterns: List[str],
+        tokenize_fn: Callable[[Dict[str, List[Any]]], Dict[str, List[Any]]],
+        pack_block_size: Optional[int] = None,
+        pad_token_id: int = 0,
+        buffer_size: int = SHUFFLE_BUFFER,
+        chunk_rows: int = CHUNK_ROWS,
+        seed: int = 42,
+    ):
+        self.paths = expand_shards(patterns)
+        if not any(has_rows(p) for p in self.paths):
+            raise ValueError(f"訓練資料沒有任何一筆樣本：{', '.join(self.paths)}")
+        self.tokenize_fn = tokenize_fn
+        self.pack_block_size = pack_block_size
+        self.pad_token_id = pad_token_id
+        self.buffer_size = buffer_size
+        self.chunk_rows = chunk_rows
+        self.seed = seed
+
+    def _lines(self, epoch: int, worker_id: int, num_workers: int) -> Iterator[str]:
+        paths = list(self.paths)
+        random.Random(self.seed + epoch).shuffle(paths)
+        if len(paths) >= num_workers:
+            # 分片夠多：每個 worker 讀自己的分片，不用看別人的行
+            for path in paths[worker_id::num_workers]:
+                with open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip():
+                            yield line
+            return
+        index = 0
+        for path in paths:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    if index % num_workers == worker_id:
+                        yield line
+                    index += 1
+
+    def _chunks(self, lines: Iterator[str]) -> Iterator[Dict[str, List[Any]]]:
+        columns: Dict[str, List[Any]] = {"instruction": [], "input": [], "output": []}
+        for line in lines:
+            row = json.loads(line)
+            columns["instruction"].append(row["instruction"])
+            columns["input"].append(row.get("input", ""))
+            columns["output"].append(row["output"])
+            if len(columns["instruction"]) >= self.chunk_rows:
+                yield columns
+                columns = {"instruction": [], "input": [], "output": []}
+        if columns["instruction"]:
+            yield columns
+
+    def _examples(self, worker_id: int, num_workers: int) -> Iterator[Dict[str, List[int]]]:
+        epoch = 0
+        while True:
+            produced = lost = 0
+            for columns in self._chunks(self._lines(epoch, worker_id, num_workers)):
+                tokens = self.tokenize_fn(columns)
+                # response 被 max_length 截光的列不送出（和非串流的 sft_tokenize.drop_response_lost 相同）
+                lost += drop_response_lost_rows(tokens)
+                if self.pack_block_size:
+                    tokens = pack_examples(tokens, self.pack_block_size, self.pad_token_id)
+                    keys = ("input_ids", "labels", "position_ids")
+                else:
+                    keys = ("input_ids", "attention_mask", "labels")
+                for i in range(len(tokens["input_ids"])):
+                    produced += 1
+                    yield {k: tokens[k][i] for k in keys}
+            if lost:
+                print(f"警告：串流 worker {worker_id} 第 {epoch} 輪略過 {lost} 筆 response 整段被 max_length 截掉的資料")
+            if not produced:
+                # 資料比 worker 少、這個 worker 分不到任何一行，交給其他 worker
+                return
+            epoch += 1
+
+    def __iter__(self) -> Iterator[Dict[str, List[int]]]:
+        info = get_worker_info()
+        worker_id, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        rng = random.Random(self.seed * 1000 + worker_id)
+        return shuffle_buffer(self._examples(worker_id, num_workers), self.buffer_size, rng)
@@ -0,0 +1,60 @@
+import os
+import warnings
+from typing import Optional
+
+import torch
+from torch.utils.data import DataLoader
+from transformers import Trainer
+from transformers.trainer import OPTIMIZER_NAME, SCHEDULER_NAME
+
+# =========================================================
+# Trainer 擴充：自訂 batch sampler
+# =========================================================
+
+
+class BatchSamplerTrainer(Trainer):
+    # 傳入 batch_sampler（例如 TokenBudgetBatchSampler）就用它組 batch，
+    # 否則行為和原本的 Trainer 一樣；log 時順便帶上 padding_ratio
+    def __init__(self, *args, batch_sampler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_sampler = batch_sampler
+        self.padding_ratio: Optional[float] = None
+        if batch_sampler is not None and hasattr(batch_sampler, "padding_ratio"):
+            self.padding_ratio = batch_sampler.padding_ratio()
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.batch_sampler is None:
+            return super().get_train_dataloader()
+
+        train_dataset = self._remove_unused_columns(self.train_dataset, description="training")
+        dataloader = DataLoader(
+            train_dataset,
+            batch_sampler=self.batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            persistent_workers=self.args.dataloader_persistent_workers,
+        )
+        return self.accelerator.prepare(dataloader)
+
+    def _load_optimizer_and_scheduler(self, checkpoint):
+        super()._load_optimizer_and_scheduler(checkpoint)
+        # 只存 adapter 的 checkpoint（sft_checkpoint.AsyncCheckpointCallback）沒有 optimizer.pt，
+        # Trainer 就連 scheduler 也不載；這裡補載 scheduler，學習率接著原本的排程
+        if (
+            checkpoint is None
+            or os.path.isfile(os.path.join(checkpoint, OPTIMIZER_NAME))
+            or not os.path.isfile(os.path.join(checkpoint, SCHEDULER_NAME))
+        ):
+            return
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            self.lr_scheduler.load_state_dict(torch.load(os.path.join(checkpoint, SCHEDULER_NAME)))
+        # optimizer 是新建的，學習率要等下一次 scheduler.step() 才會更新，先直接設好
+        for group, lr in zip(self.optimizer.param_groups, self.lr_scheduler.get_last_lr()):
+            group["lr"] = lr
+
+    def log(self, logs, *args, **kwargs):
+        if self.padding_ratio is not None:
+            logs["padding_ratio"] = round(self.padding_ratio, 4)
+        super().log(logs, *args, **kwargs)
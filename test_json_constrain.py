@@ -0,0 +1,269 @@
+import json
+from types import SimpleNamespace
+from typing import Dict, Any, List, Optional, Tuple
+
+import pytest
+
+import json_constrain as jc
+from json_constrain import JsonAutomaton, JsonConstraint, SCHEMA_SOURCES, TokenIndex, infer_schema, sample_rows
+from lora_sft.text import TOKENS
+
+# =========================================================
+# json_constrain：schema 推論、自動機、快轉
+# =========================================================
+#
+# schema 用 make_*_sft 取樣推出，再拿另一個 seed 的樣本（held-out）檢查；
+# diet 的菜色資料表用 write_bulk 在暫存目錄產生一個小表，不需要 nutrition_dataset.json。
+# 快轉的測試用在樣本上訓練的小 byte-level BPE tokenizer，和一個照著目標文字「預測」的假模型。
+
+HELD_OUT_SEED = jc.SEED + 1
+HELD_OUT_ROWS = 100
+DB_DISHES = 300
+VOCAB_SIZE = 1000
+
+
+@pytest.fixture(scope="module")
+def outputs(tmp_path_factory) -> Dict[str, Tuple[List[Any], List[str]]]:
+    # 任務名稱 → (推 schema 用的 output 物件, held-out 的 output 字串)
+    import make_diet_sft
+    from make_nutrition_dataset import N_RESTAURANTS, write_bulk
+
+    tmp = tmp_path_factory.mktemp("dishes")
+    db_dir = str(tmp / "dishes.dishdb")
+    write_bulk(N_RESTAURANTS, DB_DISHES, str(tmp / "src"), fmt="jsonl", seed=jc.SEED, db_dir=db_dir)
+    result = {}
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(make_diet_sft, "DATA_PATH", str(tmp / "missing.json"))
+        mp.setattr(make_diet_sft, "DB_DIR", db_dir)
+        for name, module_name in SCHEMA_SOURCES.items():
+            train = sample_rows(module_name, jc.SCHEMA_SAMPLES)
+            held_out = sample_rows(module_name, HELD_OUT_ROWS, seed=HELD_OUT_SEED)
+            result[name] = ([json.loads(r["output"]) for r in train], [r["output"] for r in held_out])
+    return result
+
+
+@pytest.fixture(scope="module")
+def automata(outputs) -> Dict[str, JsonAutomaton]:
+    return {
+        name: JsonAutomaton(infer_schema(train), suffix=TOKENS.response_end)
+        for name, (train, _) in outputs.items()
+    }
+
+
+@pytest.fixture(scope="module")
+def index(outputs) -> TokenIndex:
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tok = Tokenizer(models.BPE())
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=VOCAB_SIZE,
+        special_tokens=["<pad>", "<bos>", "<eos>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    texts = [json.dumps(obj, ensure_ascii=False) + TOKENS.response_end for train, _ in outputs.values() for obj in train]
+    tok.train_from_iterator(texts, trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tok, pad_token="<pad>", bos_token="<bos>", eos_token="<eos>")
+    return TokenIndex(tokenizer)
+
+
+def walk(automaton: JsonAutomaton, data: bytes) -> Optional[Tuple]:
+    # 吃完 data 之後的狀態；中途不合法回傳 None
+    state: Optional[Tuple] = automaton.start()
+    for b in data:
+        state = automaton.step(state, b)
+        if state is None:
+            return None
+    return state
+
+
+def target_bytes(output: str) -> bytes:
+    return (output + TOKENS.response_end).encode("utf-8")
+
+
+# ---------------------------------------------------------
+# schema 與自動機
+# ---------------------------------------------------------
+
+@pytest.mark.parametrize("name", list(SCHEMA_SOURCES))
+def test_held_out_outputs_accepted(name, outputs, automata):
+    automaton = automata[name]
+    rejected = [o for o in outputs[name][1] if walk(automaton, target_bytes(o)) != ()]
+    assert not rejected, rejected[0]
+
+
+@pytest.mark.parametrize("name", list(SCHEMA_SOURCES))
+def test_every_prefix_of_a_valid_output_stays_open(name, outputs, automata):
+    automaton = automata[name]
+    data = target_bytes(outputs[name][1][0])
+    state = automaton.start()
+    for i, b in enumerate(data):
+        assert state != (), f"第 {i} 個 byte 之前就結束了"
+        state = automaton.step(state, b)
+        assert state is not None, data[: i + 1].decode("utf-8", "replace")
+    assert state == ()
+
+
+def _malformed(obj: Dict[str, Any]) -> Dict[str, str]:
+    text = json.dumps(obj, ensure_ascii=False)
+    keys = list(obj)
+    cases = {
+        "compact_separators": json.dumps(obj, ensure_ascii=False, separators=(",", ":")),
+        "indented": json.dumps(obj, ensure_ascii=False, indent=2),
+        "single_quotes": "{'" + text[2:],
+        "unknown_key": '{"unknown_key": 1, ' + text[1:],
+        "extra_key_at_end": json.dumps({**obj, "unknown_key": 1}, ensure_ascii=False),
+        "trailing_comma": text[:-1] + ", }",
+        "not_an_object": "[" + text,
+        "after_end": text + " ",
+        "suffix_typo": text + TOKENS.response_end[:-1] + "x",
+    }
+    if len(keys) > 1:
+        cases["reordered_keys"] = json.dumps({k: obj[k] for k in reversed(keys)}, ensure_ascii=False)
+    return cases
+
+
+@pytest.mark.parametrize("name", list(SCHEMA_SOURCES))
+def test_malformed_prefixes_rejected(name, outputs, automata):
+    automaton = automata[name]
+    obj = json.loads(outputs[name][1][0])
+    for case, text in _malformed(obj).items():
+        data = text.encode("utf-8")
+        if not case.startswith("suffix") and case != "after_end":
+            data += TOKENS.response_end.encode("utf-8")
+        assert walk(automaton, data) is None, case
+
+
+@pytest.mark.parametrize("name", list(SCHEMA_SOURCES))
+def test_truncated_output_is_not_complete(name, outputs, automata):
+    automaton = automata[name]
+    data = target_bytes(outputs[name][1][0])
+    for cut in (1, len(data) // 2, len(data) - 1):
+        state = walk(automaton, data[:cut])
+        assert state is not None and state != ()
+
+
+# ---------------------------------------------------------
+# 快轉
+# ---------------------------------------------------------
+
+@pytest.mark.parametrize("name", list(SCHEMA_SOURCES))
+def test_fast_forward_matches_forced_spans(name, outputs, automata, index):
+    # 在真實 output 的每個位置，快轉接上的 token 要剛好是 output 接下來的那段 bytes，狀態也和逐 byte 走的相同
+    automaton = automata[name]
+    constraint = JsonConstraint(automaton, index)
+    forwarded = 0
+    for output in outputs[name][1][:10]:
+        data = target_bytes(output)
+        states = [automaton.start()]
+        for b in data:
+            states.append(automaton.step(states[-1], b))
+        assert states[-1] == ()
+        for pos, state in enumerate(states[:-1]):
+            ids, after = constraint.fast_forward(state)
+            if ids:
+                span = b"".join(index.bytes[i] for i in ids)
+                assert data[pos:pos + len(span)] == span
+                assert states[pos + len(span)] == after
+                forwarded += 1
+    assert forwarded > 0
+
+
+class OracleModel:
+    # 假的 causal LM：每列照著目標 bytes「預測」，下一個 token 是剩下的目標開頭能對上的最長 token
+    def __init__(self, index: TokenIndex, targets: List[bytes]):
+        self.index = index
+        self.targets = targets
+        self.generated = [b""] * len(targets)
+        self.calls = 0
+
+    def _next_token(self, row: int) -> int:
+        remaining = self.targets[row][len(self.generated[row]):]
+        node, best = self.index.trie, self.index.tokenizer.eos_token_id
+        for b in remaining:
+            node = node[0].get(b)
+            if node is None:
+                break
+            if node[1]:
+                best = node[1][0]
+        return best
+
+    def __call__(self, input_ids, attention_mask, **kwargs):
+        import torch
+
+        self.calls += 1
+        feed_mask = attention_mask[:, -input_ids.shape[1]:]
+        logits = torch.zeros(len(self.targets), 1, self.index.vocab_size)
+        for row in range(len(self.targets)):
+            for tid, keep in zip(input_ids[row].tolist(), feed_mask[row].tolist()):
+                if keep:
+                    self.generated[row] += self.index.bytes[tid] or b""
+            logits[row, 0, self._next_token(row)] = 1.0
+        return SimpleNamespace(logits=logits)
+
+
+def _greedy(index: TokenIndex, target: bytes, bos: int) -> Tuple[bytes, int]:
+    # 不加約束、不快轉，一次一個 token
+    import torch
+
+    model = OracleModel(index, [target])
+    tid, out = bos, b""
+    while out != target and len(out) <= len(target):
+        logits = model(input_ids=torch.tensor([[tid]]), attention_mask=torch.ones(1, 1 + len(out), dtype=torch.long))
+        tid = int(logits.logits[0, -1].argmax())
+        out += index.bytes[tid] or b""
+    return out, model.calls
+
+
+@pytest.mark.parametrize("name", list(SCHEMA_SOURCES))
+def test_constrained_generate_matches_unconstrained_decoding(name, outputs, automata, index):
+    import torch
+
+    targets = [target_bytes(o) for o in outputs[name][1][:3]]
+    bos = index.tokenizer.bos_token_id
+    constraints = [JsonConstraint(automata[name], index) for _ in targets]
+    model = OracleModel(index, targets)
+    generated = jc.constrained_generate(
+        model,
+        constraints,
+        torch.tensor([[bos]] * len(targets)),
+        torch.ones(len(targets), 1, dtype=torch.long),
+        [len(t) for t in targets],
+        pad_token_id=index.tokenizer.pad_token_id,
+    )
+    unconstrained_calls = 0
+    for target, ids in zip(targets, generated):
+        plain, calls = _greedy(index, target, bos)
+        unconstrained_calls = max(unconstrained_calls, calls)
+        assert b"".join(index.bytes[i] for i in ids) == plain == target
+    # 快轉過的固定片段不用再跑 model
+    assert model.calls < unconstrained_calls
+
+
+def test_caches_are_capped(outputs, automata, index, monkeypatch):
+    # 上限調小：長時間服務下各個依狀態的快取都要清掉重建，結果和不設上限時相同
+    cap = 16
+    name = list(SCHEMA_SOURCES)[0]
+    reference = JsonConstraint(automata[name], index)
+    states = []
+    for output in outputs[name][1][:5]:
+        states.append(reference.start())
+        for b in target_bytes(output):
+            states.append(reference.automaton.step(states[-1], b))
+    assert len(set(states)) > cap
+    expected = [(reference.automaton.allowed_bytes(s), reference.fast_forward(s), reference.mask(s)) for s in states]
+
+    monkeypatch.setattr(jc, "MASK_CACHE_SIZE", cap)
+    monkeypatch.setattr(jc, "STATE_CACHE_SIZE", cap)
+    automaton = JsonAutomaton(infer_schema(outputs[name][0]), suffix=TOKENS.response_end)
+    constraint = JsonConstraint(automaton, index)
+    for state, (allowed, forward, mask) in zip(states, expected):
+        assert automaton.allowed_bytes(state) == allowed
+        assert constraint.fast_forward(state) == forward
+        assert bool((constraint.mask(state) == mask).all())
+        for cache in (automaton._candidates, automaton._allowed, constraint._forward, constraint._masks):
+            assert len(cache) <= cap
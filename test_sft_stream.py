@@ -0,0 +1,89 @@
+import itertools
+import json
+import pickle
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from lora_sft.config import SFTConfig
+from lora_sft.train import make_tokenize_fn
+from sft_stream import StreamingSFTDataset
+from sft_tokenize import IGNORE_INDEX
+
+# =========================================================
+# sft_stream：串流 dataset 要能 pickle（spawn 啟動的 DataLoader worker 會 pickle 整個 dataset）
+# =========================================================
+
+N_ROWS = 40
+TAKE = 8
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tok = Tokenizer(models.BPE())
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=300,
+        special_tokens=["<pad>", "<bos>", "<eos>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tok.train_from_iterator([f"第 {i} 筆 {{\"value\": {i}}}" for i in range(N_ROWS)], trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tok, pad_token="<pad>", bos_token="<bos>", eos_token="<eos>")
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    path = tmp_path / "stream_sft.jsonl"
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(N_ROWS):
+            row = {"instruction": f"第 {i} 筆", "input": "", "output": json.dumps({"value": i})}
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    return str(path)
+
+
+def _dataset(data_path, tokenizer, packing: bool, max_length: int = 1024) -> StreamingSFTDataset:
+    cfg = SFTConfig()
+    cfg.data.response_only_loss = True
+    cfg.data.max_length = max_length
+    return StreamingSFTDataset(
+        [data_path],
+        make_tokenize_fn(cfg, tokenizer),
+        pack_block_size=64 if packing else None,
+        pad_token_id=tokenizer.pad_token_id,
+        buffer_size=4,
+        chunk_rows=10,
+    )
+
+
+@pytest.mark.parametrize("packing", [False, True])
+def test_streaming_dataset_pickles(data_path, tokenizer, packing):
+    dataset = _dataset(data_path, tokenizer, packing)
+    restored = pickle.loads(pickle.dumps(dataset))
+    assert list(itertools.islice(restored, TAKE)) == list(itertools.islice(dataset, TAKE))
+
+
+def test_spawn_dataloader_worker(data_path, tokenizer):
+    # 和 Windows / macOS 上的 DataLoader 一樣用 spawn 啟動 worker
+    dataset = _dataset(data_path, tokenizer, packing=False)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=1, multiprocessing_context="spawn")
+    assert list(itertools.islice(loader, TAKE)) == list(itertools.islice(dataset, TAKE))
+
+
+def test_response_lost_rows_dropped(tmp_path, tokenizer):
+    # 奇數列的 instruction 長到 prompt 就超過 max_length，response 整段被截掉，不該送出 labels 全是 -100 的列
+    path = tmp_path / "long_prompt_sft.jsonl"
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(N_ROWS):
+            instruction = f"第 {i} 筆 " * (40 if i % 2 else 1)
+            f.write(json.dumps({"instruction": instruction, "input": "", "output": json.dumps({"value": i})}, ensure_ascii=False) + "\n")
+    dataset = _dataset(str(path), tokenizer, packing=False, max_length=128)
+    examples = list(itertools.islice(dataset, N_ROWS))
+    assert all(any(label != IGNORE_INDEX for label in ex["labels"]) for ex in examples)
+    # 一輪只剩偶數列，取 N_ROWS 筆剛好是兩輪
+    assert len({tuple(ex["input_ids"]) for ex in examples}) == N_ROWS // 2